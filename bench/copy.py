@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""copy.py
+
+Benchmark for files.copy_file: throughput copying a file with each of
+the ways the data can be copied (copy_file_range, sendfile, readinto),
+compared with shutil.copy2.
+
+Usage:\tpython bench/copy.py [-s size_mb] [-r runs] [-d destdir] [path]
+
+If path is not given a temporary file of size_mb MB is created and removed
+at end. Copies are written in destdir, default the directory of path, so
+use another filesystem to measure copies between devices.
+Page cache is not dropped, run as root with -c to do it before every copy.
+"""
+
+
+import os, os.path
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lfm'))
+import files
+
+
+######################################################################
+def create_file(path, size):
+    fd, filename = tempfile.mkstemp(prefix='lfm-bench-', dir=path)
+    block = os.urandom(files.COPY_BUFSIZE)
+    for i in xrange(size * 1024 * 1024 / len(block)):
+        os.write(fd, block)
+    os.close(fd)
+    return filename
+
+
+def drop_caches():
+    os.system('sync')
+    try:
+        open('/proc/sys/vm/drop_caches', 'w').write('3\n')
+    except IOError:
+        pass
+
+
+def run(label, func, src, dest, runs, dropcaches):
+    best = None
+    for i in xrange(runs):
+        if dropcaches:
+            drop_caches()
+        t0 = time.time()
+        func(src, dest)
+        t = time.time() - t0
+        os.unlink(dest)
+        best = t if best is None else min(best, t)
+    size = os.path.getsize(src)
+    print '%-16s %8.3f s  %9.1f MB/s' % \
+        (label, best, float(size)/1024/1024/max(best, 1e-6))
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:r:d:ch')
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(-1)
+    size, runs, destdir, dropcaches = 1024, 3, None, False
+    for o, a in opts:
+        if o == '-s':
+            size = int(a)
+        elif o == '-r':
+            runs = int(a)
+        elif o == '-d':
+            destdir = a
+        elif o == '-c':
+            dropcaches = True
+        elif o == '-h':
+            print __doc__
+            sys.exit(0)
+    if args:
+        src, tmp = os.path.abspath(args[0]), False
+    else:
+        src, tmp = create_file(destdir or tempfile.gettempdir(), size), True
+    dest = os.path.join(destdir or os.path.dirname(src),
+                        'lfm-bench-copy.%d' % os.getpid())
+    try:
+        run('shutil.copy2', shutil.copy2, src, dest, runs, dropcaches)
+        for engine in files.COPY_ENGINES:
+            run(engine, lambda src, dest: files.copy_file(src, dest, (engine, )),
+                src, dest, runs, dropcaches)
+        run('copy_file', files.copy_file, src, dest, runs, dropcaches)
+    finally:
+        if tmp:
+            os.unlink(src)
+
+
+if __name__ == '__main__':
+    main()
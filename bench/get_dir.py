@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""get_dir.py
+
+Benchmark for files.get_dir: time and system calls issued per entry,
+compared with the old os.listdir + get_fileinfo loop, and with the stat
+calls done by several threads as on network filesystems.
+
+Usage:\tpython bench/get_dir.py [-n num_files] [-l latency_ms] [-j threads] [path]
+
+If path is not given a temporary directory with num_files entries
+(regular files, directories and symlinks) is created and removed at end.
+latency_ms is added to every stat call, to simulate a NFS or CIFS mount.
+"""
+
+
+import os, os.path
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lfm'))
+import files
+
+
+######################################################################
+##### syscall counters
+counters = {}
+latency = 0.0
+
+def count(module, name, key):
+    func = getattr(module, name)
+    def wrapper(*args, **kwargs):
+        counters[key] = counters.get(key, 0) + 1
+        if latency and key in ('lstat', 'stat'):
+            time.sleep(latency)
+        return func(*args, **kwargs)
+    setattr(module, name, wrapper)
+
+count(os, 'lstat', 'lstat')
+count(os, 'stat', 'stat')
+count(os, 'listdir', 'getdents')
+count(os, 'readlink', 'readlink')
+count(files.users, 'byid', 'nss')
+count(files.groups, 'byid', 'nss')
+if hasattr(files, '_readdir64'):
+    count(files, '_readdir64', 'readdir')
+
+
+######################################################################
+##### listing engines
+def old_get_dir(path):
+    res = {}
+    for f in os.listdir(path):
+        res[f] = files.get_fileinfo(os.path.join(path, f))
+    return len(res), res
+
+
+def new_get_dir(path, nthreads=1):
+    fstype = files.get_fstype(path)
+    old = files.STAT_CONCURRENCY.get(fstype)
+    files.STAT_CONCURRENCY[fstype] = nthreads
+    try:
+        return files.get_dir(path)
+    finally:
+        if old is None:
+            del files.STAT_CONCURRENCY[fstype]
+        else:
+            files.STAT_CONCURRENCY[fstype] = old
+
+
+######################################################################
+def create_tree(num):
+    path = tempfile.mkdtemp(prefix='lfm-bench-')
+    for i in xrange(num):
+        f = os.path.join(path, u'file_%07d.txt' % i)
+        if i % 10 == 0:
+            os.mkdir(f)
+        elif i % 10 == 1:
+            os.symlink(u'file_%07d.txt' % (i-1), f)
+        else:
+            open(f, 'w').close()
+    return path
+
+
+def run(label, func, path):
+    counters.clear()
+    files.users.clear()
+    files.groups.clear()
+    t0 = time.time()
+    n, res = func(path)
+    t = time.time() - t0
+    calls = sum([v for k, v in counters.items() if k not in ('nss', 'readdir')])
+    print '%-12s %8d entries  %8.3f s  %7.1f us/entry  %5.2f syscalls/entry  %5.2f nss/entry' % \
+        (label, n, t, 1000000*t/max(n, 1),
+         float(calls)/max(n, 1), float(counters.get('nss', 0))/max(n, 1))
+    print '             %s' % ', '.join(['%s=%d' % kv for kv in sorted(counters.items())])
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:l:j:h')
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(-1)
+    global latency
+    num, nthreads = 20000, 8
+    for o, a in opts:
+        if o == '-n':
+            num = int(a)
+        elif o == '-l':
+            latency = float(a) / 1000
+        elif o == '-j':
+            nthreads = int(a)
+        elif o == '-h':
+            print __doc__
+            sys.exit(0)
+    if args:
+        path, tmp = os.path.abspath(args[0]).decode('utf-8'), False
+    else:
+        path, tmp = create_tree(num), True
+    try:
+        run('listdir', old_get_dir, path)
+        run('get_dir', new_get_dir, path)
+        run('get_dir -j%d' % nthreads,
+            lambda path: new_get_dir(path, nthreads), path)
+    finally:
+        if tmp:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,6 @@ This module contains the actions to execute when keys are pressed.
 
 import os, os.path
 import sys
-from glob import glob
 from time import tzname, ctime
 import datetime
 import difflib
@@ -124,12 +123,14 @@ keytable = {
     ord('@'): 'action_on_file',
     0xF1: 'special_regards',    # special regards
     ord('/'): 'find_grep',
+    ord('f'): 'quick_filter',
     ord('t'): 'touch_file',
     ord('T'): 'touch_file',
     ord('l'): 'create_link',
     ord('L'): 'edit_link',
     0x0F: 'open_shell',         # Ctrl-O
     0x18: 'show_cli',           # Ctrl-X
+    0x03: 'stop_loading',       # Ctrl-C
 
     # main functions
     curses.KEY_F2: 'rename',
@@ -160,6 +161,22 @@ keytable = {
 }
 
 
+# actions which only move the cursor: when keys are queued, consecutive
+# movements are applied together and the screen is updated once
+movement_actions = ('cursor_up', 'cursor_down', 'page_previous',
+                    'page_next', 'home', 'end', 'cursor_center',
+                    'cursor_quarter_up', 'cursor_quarter_down',
+                    'cursor_up_otherpane', 'cursor_down_otherpane',
+                    'page_previous_otherpane', 'page_next_otherpane',
+                    'home_otherpane', 'end_otherpane',
+                    'cursor_quarter_up_otherpane',
+                    'cursor_quarter_down_otherpane')
+
+
+def is_movement(ch):
+    return keytable.get(ch) in movement_actions
+
+
 def do(tab, ch):
     try:
         act = 'ret = %s(tab)'  % keytable[ch]
@@ -377,6 +394,59 @@ def goto_file(tab):
         tab.file_i = tab.sorted.index(f)
         tab.fix_limits()
 
+def quick_filter(tab):
+    """show only the files whose name contains the text typed.
+    Tab toggles fuzzy matching, Enter keeps the filter, Ctrl-C or
+    ESC remove it. Wildcards (*?[) make it a glob pattern"""
+
+    def show_prompt():
+        app.act_pane.display(update=False)
+        win = app.statusbar.win
+        win.erase()
+        prompt = fuzzy and 'Fuzzy filter: ' or 'Filter: '
+        count = ' [%d]' % (tab.nfiles - (tab.sorted[0] == os.pardir))
+        w = app.maxw - len(prompt) - len(count) - 2
+        buf = (len(text)>w) and '~' + text[-(w-1):] or text
+        win.addstr(0, 1, prompt, curses.A_BOLD)
+        win.addstr(encode(buf))
+        win.addstr(count)
+        win.noutrefresh()
+        curses.doupdate()
+
+    text = tab.filter and tab.filter.text or u''
+    fuzzy = tab.filter and tab.filter.fuzzy or False
+    win = tab.pane.win
+    win.nodelay(0)
+    try:
+        while True:
+            show_prompt()
+            ch = win.getch()
+            if ch in (0x03, 0x1B):      # Ctrl-C, ESC
+                tab.set_filter(u'')
+                break
+            elif ch in (10, 13):
+                break
+            elif ch == ord('\t'):
+                newtext, newfuzzy = text, not fuzzy
+            elif ch in (curses.KEY_BACKSPACE, 0x7F, 0x08):
+                newtext, newfuzzy = text[:-1], fuzzy
+            elif ch in (curses.KEY_UP, curses.KEY_DOWN,
+                        curses.KEY_PPAGE, curses.KEY_NPAGE):
+                do(tab, ch)
+                continue
+            elif 0x20 <= ch <= 0xFF:
+                newtext = text + messages.get_char(win, ch)
+                newfuzzy = fuzzy
+            else:
+                curses.beep()
+                continue
+            if tab.set_filter(newtext, newfuzzy):
+                text, fuzzy = newtext, newfuzzy
+            else:
+                curses.beep()
+    finally:
+        win.nodelay(1)
+
 def tree(tab):
     if tab.vfs:
         return
@@ -519,35 +589,25 @@ def right_tab(tab):
 def select_item(tab):
     filename = tab.get_file()
     if filename != os.pardir:
-        try:
-            tab.selections.index(filename)
-        except ValueError:
-            tab.selections.append(filename)
-        else:
-            tab.selections.remove(filename)
+        tab.selections.toggle(filename)
     tab.file_i += 1
     tab.fix_limits()
 
 def select_group(tab):
     pattern = doEntry(tab.path, 'Select group', 'Type pattern', '*', with_history='glob')
     if pattern:
-        fullpath = os.path.join(tab.path, pattern)
-        for f in [os.path.basename(f) for f in glob(fullpath)]:
-            if f not in tab.selections:
-                tab.selections.append(f)
+        tab.selections.add_matching(tab.sorted, pattern)
 
 def deselect_group(tab):
     pattern = doEntry(tab.path, 'Deselect group', 'Type pattern', '*', with_history='glob')
     if pattern:
-        fullpath = os.path.join(tab.path, pattern)
-        for f in [os.path.basename(f) for f in glob(fullpath)]:
-            if f in tab.selections:
-                tab.selections.remove(f)
+        tab.selections.discard_matching(tab.sorted, pattern)
 
 def invert_select(tab):
-    selections_old = tab.selections[:]
-    tab.selections = [f for f in tab.sorted if f not in selections_old and \
-                          f != os.pardir]
+    selections_old = tab.selections
+    tab.selections = files.Selections([f for f in tab.sorted
+                                       if f not in selections_old and \
+                                           f != os.pardir])
 
 
 # misc
@@ -653,7 +713,7 @@ def show_cli(tab):
 # main functions
 def __rename_backup_helper(tab):
     if tab.selections:
-        fs = tab.selections[:]
+        fs = list(tab.selections)
     else:
         filename = tab.get_file()
         if filename == os.pardir:
@@ -666,7 +726,7 @@ def rename(tab):
     if fs is None:
         return
     res = ProcessLoopRename('Rename files', files.do_rename, fs, tab.path).run()
-    tab.selections = []
+    tab.selections.clear()
     tab.refresh()
     app.regenerate()
 
@@ -674,15 +734,9 @@ def backup_file(tab):
     fs = __rename_backup_helper(tab)
     if fs is None:
         return
-    try:
-        # pc is not used, just to check files have valid encoding
-        pc = files.PathContents(fs, tab.path)
-    except UnicodeError:
-        messages.error('Cannot backup files\nFiles with invalid encoding, convert first')
-        return
     res = ProcessLoopBackup('Backup files', files.do_backup, fs, tab.path,
                             app.prefs.misc['backup_extension']).run()
-    tab.selections = []
+    tab.selections.clear()
     tab.refresh()
     app.regenerate()
 
@@ -777,7 +831,7 @@ def copy(tab):
     destdir = app.noact_pane.act_tab.path + os.sep
     if tab.selections:
         buf = 'Copy %d items to' % len(tab.selections)
-        fs = tab.selections[:]
+        fs = list(tab.selections)
     else:
         filename = tab.get_file()
         if filename == os.pardir:
@@ -797,14 +851,14 @@ def copy(tab):
             return
         res = ProcessLoopCopy('Copy files', files.do_copy, pc,
                               destdir, rename_dir).run()
-        tab.selections = []
+        tab.selections.clear()
         app.regenerate()
 
 def move(tab):
     destdir = app.noact_pane.act_tab.path + os.sep
     if tab.selections:
         buf = 'Move %d items to' % len(tab.selections)
-        fs = tab.selections[:]
+        fs = list(tab.selections)
     else:
         filename = tab.get_file()
         if filename == os.pardir:
@@ -822,6 +876,7 @@ def move(tab):
             app.display()
             messages.error('Cannot move files\nFiles with invalid encoding, convert first')
             return
+        pc.record() # delete only what has been copied
         res = ProcessLoopCopy('Move files', files.do_copy, pc,
                               destdir, rename_dir).run()
         if res != -1: # stopped by user
@@ -831,7 +886,7 @@ def move(tab):
             app.prefs.confirmations['delete'] = 0
             res = ProcessLoopDelete('Move files', files.do_delete, pc).run()
             app.prefs.confirmations['delete'] = tmp_delete_all
-        tab.selections = []
+        tab.selections.clear()
         tab.refresh()
 
 def make_dir(tab):
@@ -847,7 +902,7 @@ def make_dir(tab):
 
 def delete(tab):
     if tab.selections:
-        fs = tab.selections[:]
+        fs = list(tab.selections)
     else:
         filename = tab.get_file()
         if filename == os.pardir:
@@ -859,7 +914,7 @@ def delete(tab):
         messages.error('Cannot delete files\nFiles with invalid encoding, convert first')
         return
     res = ProcessLoopDelete('Delete files', files.do_delete, pc).run()
-    tab.selections = []
+    tab.selections.clear()
     tab.refresh()
 
 
@@ -972,10 +1027,14 @@ def general_menu(tab):
         os.system('%s \"%s\"' % (app.prefs.progs['editor'], app.prefs.file))
         curses.curs_set(0)
         app.prefs.load()
+        app.lpane.invalidate()
+        app.rpane.invalidate()
     elif cmd == 'r':
         app.prefs.check_progs()
         app.prefs.save()
         app.prefs.load()
+        app.lpane.invalidate()
+        app.rpane.invalidate()
         messages.win('Configuration', 'Regenerating programs... OK')
     elif cmd == 'h':
         files.delete_bulk(messages.HISTORY_FILE)
@@ -984,12 +1043,23 @@ def general_menu(tab):
 
 # window resize
 def resize_window(tab):
-    app.resize()
+    app.resize(debounce=True)
+    return RET_NO_UPDATE
+
+
+# stop reading directory in background
+def stop_loading(tab):
+    if tab.reader is None:
+        curses.beep()
+        return RET_NO_UPDATE
+    tab.stop_loading()
 
 
 #refresh screen
 def refresh_screen(tab):
-    app.regenerate()
+    app.regenerate(force=True)
+    app.win.clearok(1)       # repaint the whole terminal
+    app.win.noutrefresh()
 
 
 # exit
@@ -1029,14 +1099,16 @@ def do_show_dirs_size(filename, path):
 
 def show_dirs_size(tab):
     if tab.selections:
-        lst = tab.selections
+        lst = list(tab.selections)
     else:
         lst = tab.files.keys()
+    tab.load_pending(lst)
     dirs = [d for d in lst if tab.files[d][files.FT_TYPE] in \
                 (files.FTYPE_DIR, files.FTYPE_LNK2DIR) and d != os.pardir]
     res = ProcessLoopDirSize('Calculate Directories Size',
                              do_show_dirs_size, dirs, tab.path).run()
     if res is not None and isinstance(res, list) and len(res):
+        tab.detach_snapshot()
         for i, d in enumerate(dirs):
             try:
                 tab.files[d] = res[i]
@@ -1049,21 +1121,19 @@ def do_sort(tab):
     sorttypes = { 'o': files.SORTTYPE_None, 'O': files.SORTTYPE_None,
                   'n': files.SORTTYPE_byName, 'N': files.SORTTYPE_byName_rev,
                   's': files.SORTTYPE_bySize, 'S': files.SORTTYPE_bySize_rev,
-                  'd': files.SORTTYPE_byDate, 'D': files.SORTTYPE_byDate_rev }
+                  'd': files.SORTTYPE_byDate, 'D': files.SORTTYPE_byDate_rev,
+                  'e': files.SORTTYPE_byExt, 'E': files.SORTTYPE_byExt_rev,
+                  'v': files.SORTTYPE_byNatural,
+                  'V': files.SORTTYPE_byNatural_rev }
     while True:
         ch = messages.get_a_key('Sorting mode',
-                                'N(o), by (n)ame, by (s)ize, by (d)ate,\nuppercase if reverse order, Ctrl-C to quit')
+                                'N(o), by (n)ame, by (s)ize, by (d)ate,\nby (e)xtension, by (v)ersion number,\nuppercase if reverse order, Ctrl-C to quit')
         if ch == -1:                 # Ctrl-C
-            break
+            return
         elif 32 <= ch < 256 and chr(ch) in sorttypes.keys():
             app.prefs.options['sort'] = sorttypes[chr(ch)]
             break
-    old_filename = tab.get_file()
-    old_selections = tab.selections[:]
-    tab.init(tab.path)
-    tab.file_i = tab.sorted.index(old_filename)
-    tab.fix_limits()
-    tab.selections = old_selections
+    app.resort()
 
 
 # do special view file
@@ -1144,7 +1214,7 @@ def do_something_on_file(tab):
             for f in tab.selections:
                 os.system('cd \"%s\"; %s' % (encode(tab.path),
                                              get_escaped_command(cmd, f)))
-            tab.selections = []
+            tab.selections.clear()
         else:
             os.system('cd \"%s\"; %s' % (encode(tab.path),
                                          get_escaped_command(cmd, tab.sorted[tab.file_i])))
@@ -1156,6 +1226,7 @@ def do_something_on_file(tab):
 def do_show_file_info(tab):
     def show_info(tab, file):
         fullfilename = os.path.join(tab.path, file)
+        tab.load_pending([file])
         fd = tab.files[file]
         fde = files.get_fileinfo_extended(fullfilename)
         buf = []
@@ -1198,7 +1269,7 @@ def do_show_file_info(tab):
     if tab.selections:
         for f in tab.selections:
             show_info(tab, f)
-        tab.selections = []
+        tab.selections.clear()
     else:
         show_info(tab, tab.sorted[tab.file_i])
 
@@ -1219,6 +1290,7 @@ def __do_change_perms(filename, perms, owner, group, recursive):
 
 
 def do_change_perms(tab):
+    tab.load_pending(tab.selections or [tab.get_file()])
     if tab.selections:
         change_all = False
         for i, f in enumerate(tab.selections):
@@ -1233,7 +1305,7 @@ def do_change_perms(tab):
                     change_all = True
             filename = os.path.join(tab.path, f)
             __do_change_perms(filename, *ret[:-1])
-        tab.selections = []
+        tab.selections.clear()
     else:
         filename = tab.get_file()
         if filename == os.pardir:
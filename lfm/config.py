@@ -7,6 +7,8 @@ This module contains the configuration class for lfm.
 
 
 import os, os.path
+import re
+import fnmatch
 import codecs
 from ConfigParser import ConfigParser
 
@@ -83,7 +85,10 @@ options = { 'save_conf_at_exit': 1,
             'manage_otherpane': 0,
             'automatic_file_encoding_conversion': 0, # ask
             'grep_ignorecase': 1,
-            'grep_regex': 1 }
+            'grep_regex': 1,
+            'lazy_listing_threshold': 10000,
+            'background_listing': 1,
+            'low_bandwidth': 0 }
 misc = { 'backup_extension': '.bak', 'diff_type': 'unified' }
 confirmations = { 'delete': 1,
                   'overwrite': 1,
@@ -125,6 +130,10 @@ files_ext  = { 'temp_files': ('.tmp', '.$$$', '~', '.bak'),
                'data_files': ('.dta', '.nc', '.dbf', '.mdn', '.db', '.mdb', '.dat',
                               '.fox', '.dbx', '.mdx', '.sql', '.mssql', '.msql',
                               '.ssql', '.pgsql', '.cdx', '.dbi', '.sqlite') }
+# files_ext types, by priority if an extension is in several of them
+FILES_EXT_TYPES = ('temp_files', 'document_files', 'media_files',
+                   'archive_files', 'source_files', 'graphics_files',
+                   'data_files')
 
 
 ######################################################################
@@ -146,6 +155,7 @@ class Config(object):
         self.misc = misc
         self.confirmations = confirmations
         self.files_ext = files_ext
+        self.compile_files_ext()
 
 
     def check_progs(self):
@@ -265,6 +275,45 @@ class Config(object):
         for typ, exts in cfg.items('Files'):
             lst = [t.strip() for t in exts.split(',')]
             self.files_ext[typ] = tuple(lst)
+        self.compile_files_ext()
+
+
+    def compile_files_ext(self):
+        """build the tables to find the files_ext type of a file: a dict
+        for the extensions, and regular expressions for the rest,
+        f.e. '~' for backup files or 'core*'"""
+
+        self.files_ext_map = {}        # extension -> index in FILES_EXT_TYPES
+        self.files_ext_patterns = []   # (index, regex), by index
+        for i, typ in enumerate(FILES_EXT_TYPES):
+            for ext in self.files_ext.get(typ, ()):
+                ext = ext.lower()
+                if not ext:
+                    continue
+                elif ext[0] == '.' and not re.search(r'[.*?[]', ext[1:]):
+                    self.files_ext_map.setdefault(ext, i)
+                else:
+                    if not re.search(r'[*?[]', ext):
+                        ext = '*' + ext  # suffix, f.e. '.tar.gz' or '~'
+                    regex = re.compile(fnmatch.translate(ext))
+                    self.files_ext_patterns.append((i, regex))
+
+
+    def get_files_ext_type(self, f):
+        """return the files_ext type of f, or None"""
+
+        f = f.lower()
+        best = self.files_ext_map.get(os.path.splitext(f)[1],
+                                      len(FILES_EXT_TYPES))
+        for i, regex in self.files_ext_patterns:
+            if i >= best:
+                break
+            if regex.match(f):
+                best = i
+                break
+        if best < len(FILES_EXT_TYPES):
+            return FILES_EXT_TYPES[best]
+        return None
 
 
     def save(self):
@@ -299,7 +348,8 @@ class Config(object):
         buf += '\n[Options]\n'
         buf += '# automatic_file_encoding_conversion: never = -1, ask = 0, always = 1\n'
         buf += '# sort:\tNone = 0, byName = 1, byName_rev = 2, bySize = 3,\n'
-        buf += '# \tbySize_rev = 4, byDate = 5, byDate_rev = 6\n'
+        buf += '# \tbySize_rev = 4, byDate = 5, byDate_rev = 6, byExt = 7,\n'
+        buf += '# \tbyExt_rev = 8, byNatural = 9, byNatural_rev = 10\n'
         args = self.options if hasattr(self, 'options') else options
         for k, v in sorted(args.items()):
             buf += '%s: %s\n' % (k, v)
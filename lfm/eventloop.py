@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""eventloop.py
+
+This module contains the main loop: it waits for keys, other file
+descriptors and timers with select, so lfm doesn't wake up while there
+is nothing to do and keys are handled as soon as they are pressed.
+"""
+
+
+import os
+import time
+import errno
+import fcntl
+import select
+import heapq
+import threading
+
+
+######################################################################
+##### EventLoop
+class EventLoop(object):
+    """Wait for file descriptors to be readable or timers to expire, and
+    run their callbacks.
+    Other threads can post callbacks to be run in the main thread, a
+    pipe wakes the loop up"""
+
+    def __init__(self):
+        self.readers = {}         # fd -> callback
+        self.timers = []          # heap of [when, seq, callback]
+        self.seq = 0
+        self.__posted = []
+        self.__lock = threading.Lock()
+        self.__rfd, self.__wfd = os.pipe()
+        for fd in (self.__rfd, self.__wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.add_reader(self.__rfd, self.__run_posted)
+
+    def close(self):
+        rfd, wfd, self.__wfd = self.__rfd, self.__wfd, None
+        os.close(rfd)
+        os.close(wfd)
+        self.readers, self.timers = {}, []
+
+    def add_reader(self, fd, callback):
+        """call callback() when fd is readable"""
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def call_later(self, delay, callback):
+        """call callback() after delay seconds, return the timer"""
+        self.seq += 1
+        timer = [time.time()+delay, self.seq, callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def post(self, callback=None):
+        """run callback() in the main loop, or just wake it up.
+        This can be called from any thread"""
+        if callback is not None:
+            self.__lock.acquire()
+            self.__posted.append(callback)
+            self.__lock.release()
+        if self.__wfd is None: # closed, f.e. a thread ending after quit
+            return
+        try:
+            os.write(self.__wfd, '\0')
+        except OSError, (err, strerror):
+            if err != errno.EAGAIN: # full pipe: loop will wake up anyway
+                raise
+
+    def __run_posted(self):
+        try:
+            while os.read(self.__rfd, 4096):
+                pass
+        except OSError, (err, strerror):
+            if err != errno.EAGAIN:
+                raise
+        self.__lock.acquire()
+        posted, self.__posted = self.__posted, []
+        self.__lock.release()
+        for callback in posted:
+            callback()
+
+    def __run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, callback = heapq.heappop(self.timers)
+            if callback is not None:
+                callback()
+
+    def run_once(self, timeout=None):
+        """wait until some fd is readable, a timer expires, or timeout
+        seconds if not None, and run the callbacks"""
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        if self.timers:
+            delay = max(self.timers[0][0]-time.time(), 0)
+            if timeout is None or delay < timeout:
+                timeout = delay
+        try:
+            ready = select.select(self.readers.keys(), [], [], timeout)[0]
+        except select.error, (err, strerror):
+            if err != errno.EINTR: # f.e. SIGWINCH
+                raise
+            ready = []
+        for fd in ready:
+            callback = self.readers.get(fd)
+            if callback is not None:
+                callback()
+        self.__run_timers()
+
+
+######################################################################
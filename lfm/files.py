@@ -9,12 +9,21 @@ This module defines files utilities for lfm.
 import sys
 import os
 import os.path
+import re
+import fnmatch
 import stat
+import errno
+import io
+import itertools
+import array
+import bisect
 import time
 import pwd
 import grp
 import shutil
 import tempfile
+import threading
+import weakref
 
 from utils import get_shell_output, get_shell_output2, encode, decode, \
                   ask_convert_invalid_encoding_filename
@@ -35,41 +44,772 @@ FILETYPES = { FTYPE_DIR: (os.sep, 'Directory'),
               FTYPE_EXE: ('*', 'Executable'), FTYPE_REG: (' ', 'File'),
               FTYPE_UNKNOWN: ('?', 'Unknown') }
 
-(FT_TYPE, FT_PERMS, FT_OWNER, FT_GROUP, FT_SIZE, FT_MTIME) = xrange(6)
+# File info: FT_RDEV is the device number for char and block devices, else 0
+(FT_TYPE, FT_PERMS, FT_OWNER, FT_GROUP, FT_SIZE, FT_MTIME, FT_RDEV) = xrange(7)
 
-# Sort Type:    None, byName, bySize, byDate, byType
+# Sort Type:    None, byName, bySize, byDate, byExtension, byNatural
+#               (numbers in names compared as such, as versions).
+#               Ties are sorted by name
 (SORTTYPE_None, SORTTYPE_byName, SORTTYPE_byName_rev, SORTTYPE_bySize,
- SORTTYPE_bySize_rev, SORTTYPE_byDate, SORTTYPE_byDate_rev) = xrange(7)
+ SORTTYPE_bySize_rev, SORTTYPE_byDate, SORTTYPE_byDate_rev,
+ SORTTYPE_byExt, SORTTYPE_byExt_rev, SORTTYPE_byNatural,
+ SORTTYPE_byNatural_rev) = xrange(11)
+SORTTYPES_REVERSE = (SORTTYPE_byName_rev, SORTTYPE_bySize_rev,
+                     SORTTYPE_byDate_rev, SORTTYPE_byExt_rev,
+                     SORTTYPE_byNatural_rev)
+# those which only need the names, not the stat of the files
+SORTTYPES_BYNAME = (SORTTYPE_None, SORTTYPE_byName, SORTTYPE_byName_rev,
+                    SORTTYPE_byExt, SORTTYPE_byExt_rev,
+                    SORTTYPE_byNatural, SORTTYPE_byNatural_rev)
+
+# filetype -> '\0' if directory, '\1' if not. Used to sort
+NOTDIR_TABLE = ''.join([chr(t not in (FTYPE_DIR, FTYPE_LNK2DIR))
+                        for t in xrange(256)])
 
 SYSTEM_PROGRAMS = []
 
+# Concurrent lstat calls by filesystem type. On network filesystems each
+# call is a round trip, so several are done in parallel threads (lstat
+# releases the GIL). Local filesystems are read sequentially.
+STAT_CONCURRENCY = { 'nfs': 16, 'nfs4': 16, 'cifs': 8, 'smb3': 8,
+                     'smbfs': 8, 'ncpfs': 8, 'afs': 8, 'ceph': 16,
+                     'fuse.glusterfs': 8, 'fuse.sshfs': 8, '9p': 8 }
+STAT_CONCURRENCY_MIN_ENTRIES = 32
+
 
 ########################################################################
-##### general functions
-# HACK: checks for st_rdev in stat_result, falling back to
-#       "ls -la %s" hack if Python before 2.2 or without st_rdev
+##### directory reading
+# d_type values from <dirent.h>, DT_UNKNOWN if filesystem doesn't fill it
+(DT_UNKNOWN, DT_FIFO, DT_CHR, DT_DIR, DT_BLK, DT_REG, DT_LNK, DT_SOCK) = \
+    (0, 1, 2, 4, 6, 8, 10, 12)
+
+# file type we can deduce from d_type without stat, links could be
+# FTYPE_LNK2DIR or FTYPE_NLNK too, and regular files FTYPE_EXE
+DTYPE2FTYPE = { DT_DIR: FTYPE_DIR, DT_LNK: FTYPE_LNK, DT_REG: FTYPE_REG,
+                DT_CHR: FTYPE_CDEV, DT_BLK: FTYPE_BDEV, DT_FIFO: FTYPE_FIFO,
+                DT_SOCK: FTYPE_SOCKET }
+
+# HACK: python has no scandir, so we read directory entries with
+#       opendir/readdir from libc via ctypes to get d_type for free.
+#       struct dirent64 layout is only known for linux, elsewhere (or if
+#       ctypes is not available) fallback to os.listdir and DT_UNKNOWN
 try:
-    os.stat_result.st_rdev
-except AttributeError:
-    def get_rdev(f):
-        """'ls -la' to get mayor and minor number of devices"""
+    if not sys.platform.startswith('linux'):
+        raise ImportError
+    import ctypes
+    import ctypes.util
+
+    class _Dirent64(ctypes.Structure):
+        _fields_ = [('d_ino', ctypes.c_uint64),
+                    ('d_off', ctypes.c_int64),
+                    ('d_reclen', ctypes.c_ushort),
+                    ('d_type', ctypes.c_ubyte),
+                    ('d_name', ctypes.c_char * 256)]
+
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _opendir = _libc.opendir
+    _opendir.argtypes = [ctypes.c_char_p]
+    _opendir.restype = ctypes.c_void_p
+    _readdir64 = _libc.readdir64
+    _readdir64.argtypes = [ctypes.c_void_p]
+    _readdir64.restype = ctypes.POINTER(_Dirent64)
+    _closedir = _libc.closedir
+    _closedir.argtypes = [ctypes.c_void_p]
+    _closedir.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError):
+    def iter_dir(path):
+        """yield (name, d_type) for every entry in path, except . and .."""
+        for f in os.listdir(path):
+            yield f, DT_UNKNOWN
+else:
+    def iter_dir(path):
+        """yield (name, d_type) for every entry in path, except . and ..
+        Names are returned as unicode if they can be decoded with the
+        filesystem encoding, as str otherwise, like os.listdir does"""
+        fs_encoding = sys.getfilesystemencoding() or 'utf-8'
+        bpath = path.encode(fs_encoding) if isinstance(path, unicode) else path
+        dirp = _opendir(bpath)
+        if not dirp:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
         try:
-            buf = get_shell_output('ls -la %s' % encode(f))
-        except:
-            return 0
+            while True:
+                ctypes.set_errno(0)
+                ent = _readdir64(dirp)
+                if not ent:
+                    err = ctypes.get_errno()
+                    if err:
+                        raise OSError(err, os.strerror(err), path)
+                    break
+                ent = ent.contents
+                name = ent.d_name
+                if name in ('.', '..'):
+                    continue
+                if isinstance(path, unicode):
+                    try:
+                        name = name.decode(fs_encoding)
+                    except UnicodeDecodeError:
+                        pass
+                yield name, ent.d_type
+        finally:
+            _closedir(dirp)
+
+
+########################################################################
+##### file copy
+COPY_BUFSIZE = 1024 * 1024        # buffer for read/write copies
+COPY_CHUNK = 16 * 1024 * 1024     # bytes asked to the kernel in each call
+
+# HACK: python 2 has no os.copy_file_range nor os.sendfile, so we call
+#       them from libc via ctypes. The kernel copies the data without
+#       passing it through userspace (copy_file_range can even clone it
+#       or copy it in the server). Any of them could be missing (old libc,
+#       not linux...), the data is read and written then
+try:
+    if not sys.platform.startswith('linux'):
+        raise ImportError
+    import ctypes
+    import ctypes.util
+    _libc_copy = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                             use_errno=True)
+except (ImportError, OSError):
+    _libc_copy = None
+_copy_file_range = getattr(_libc_copy, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+_sendfile = getattr(_libc_copy, 'sendfile64', None)
+if _sendfile is not None:
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+# errors meaning the kernel can't copy these files, try next way
+COPY_FALLBACK_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EBADF, errno.EPERM,
+                        errno.ETXTBSY)
+COPY_ENGINES = ('copy_file_range', 'sendfile', 'readinto')
+
+__copy_buffer = threading.local()
+
+
+def __copy_kernel(call, progress=None):
+    """copy from current positions until end of file, calling call()
+    which returns the bytes copied by the kernel. Return bytes copied,
+    or None if it can't copy these files"""
+    copied = 0
+    while True:
+        n = call()
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if copied == 0 and err in COPY_FALLBACK_ERRNOS:
+                return None
+            raise OSError(err, os.strerror(err))
+        if n == 0:
+            # some files (/proc...) say 0 bytes but have contents, read them
+            return copied or None
+        copied += n
+        if progress:
+            progress(copied)
+
+
+def __copy_readinto(fdin, fdout, progress=None):
+    """copy from current positions until end of file through a buffer
+    reused for all the files. Return bytes copied"""
+    buf = getattr(__copy_buffer, 'buf', None)
+    if buf is None:
+        buf = __copy_buffer.buf = bytearray(COPY_BUFSIZE)
+    view = memoryview(buf)
+    fin = io.FileIO(fdin, 'r', closefd=False)
+    copied = 0
+    while True:
+        n = fin.readinto(buf)
+        if not n:
+            return copied
+        i = 0
+        while i < n:
+            i += os.write(fdout, view[i:n])
+        copied += n
+        if progress:
+            progress(copied)
+
+
+def copy_data(fdin, fdout, engines=COPY_ENGINES, progress=None):
+    """copy the data from file descriptor fdin to fdout, from their
+    current positions, with the first way in engines which works.
+    progress(bytes copied) is called after every chunk.
+    Return (bytes copied, engine used)"""
+    for engine in engines:
+        if engine == 'copy_file_range' and _copy_file_range is not None:
+            n = __copy_kernel(lambda: _copy_file_range(fdin, None, fdout, None,
+                                                       COPY_CHUNK, 0),
+                              progress)
+        elif engine == 'sendfile' and _sendfile is not None:
+            n = __copy_kernel(lambda: _sendfile(fdout, fdin, None, COPY_CHUNK),
+                              progress)
+        elif engine == 'readinto':
+            n = __copy_readinto(fdin, fdout, progress)
         else:
+            continue
+        if n is not None:
+            return n, engine
+    raise OSError(errno.ENOSYS, 'No way to copy the data')
+
+
+def copy_file(src, dest, engines=COPY_ENGINES, progress=None):
+    """copy regular file src to dest, with its mode and times like
+    shutil.copy2 does, but src is stat'ed only once and data is copied
+    by the kernel if possible. Return the number of bytes copied.
+    dest is not truncated if it is src itself, reached through a link"""
+    fdin = os.open(src, os.O_RDONLY)
+    try:
+        st = os.fstat(fdin)
+        fdout = os.open(dest, os.O_WRONLY | os.O_CREAT, 0600)
+        try:
+            st_dest = os.fstat(fdout)
+            if (st_dest.st_dev, st_dest.st_ino) == (st.st_dev, st.st_ino):
+                raise OSError(0, 'Source and destination are the same file')
+            os.ftruncate(fdout, 0)
+            copied = copy_data(fdin, fdout, engines, progress)[0]
+            os.fchmod(fdout, stat.S_IMODE(st.st_mode))
+        finally:
+            os.close(fdout)
+    finally:
+        os.close(fdin)
+    os.utime(dest, (st.st_atime, st.st_mtime))
+    return copied
+
+
+########################################################################
+##### users and groups names cache
+class NameCache(object):
+    """Process-wide cache for id <-> name lookups of users or groups.
+    With LDAP or SSSD every getpwuid/getgrgid could be a network round trip,
+    so answers are remembered, failed lookups too (negative cache).
+    Everything is forgotten when the system database file (/etc/passwd,
+    /etc/group) changes or after ttl seconds, for remote databases"""
+
+    def __init__(self, byid, byname, getall, dbfile, ttl=600):
+        self.byid = byid           # function: id -> struct
+        self.byname = byname       # function: name -> struct
+        self.getall = getall       # function: -> [struct, ...]
+        self.dbfile = dbfile       # local database file, used to invalidate
+        self.ttl = ttl
+        self.__loader = None
+        self.__lock = threading.Lock()
+        self.__generation = 0      # incremented by clear
+        self.clear()
+
+    def clear(self):
+        self.__lock.acquire()
+        # a background load started before is not stored
+        self.__generation += 1
+        self.__loader = None
+        self.__names = {}          # id -> name, or unicode(id) if unknown
+        self.__ids = {}            # name -> id, or None if unknown
+        self.__all = None          # all names, loaded on demand
+        self.__stamp = self.__get_dbfile_mtime()
+        self.__time = time.time()
+        self.__lock.release()
+
+    def __get_dbfile_mtime(self):
+        try:
+            return os.stat(self.dbfile)[stat.ST_MTIME]
+        except OSError:
+            return 0
+
+    def check(self):
+        """invalidate cache if database has been modified or it is too old"""
+        if time.time() - self.__time > self.ttl or \
+                self.__get_dbfile_mtime() != self.__stamp:
+            self.clear()
+
+    def get_name(self, id_):
+        try:
+            return self.__names[id_]
+        except KeyError:
             try:
-                return int(buf[4][:-1]), int(buf[5])
-            except:
-                # HACK: found 0xff.. encoded device numbers, ignore them...
-                return 0, 0
-else:
-    def get_rdev(f):
-        """mayor and minor number of devices"""
-        r = os.stat(f).st_rdev
-        return r >> 8, r & 255
+                name = self.byid(id_)[0]
+            except (KeyError, OverflowError):
+                name = unicode(id_)
+            else:
+                self.__ids[name] = id_
+            self.__names[id_] = name
+            return name
+
+    def get_id(self, name):
+        """return the id for name, None if it doesn't exist"""
+        try:
+            return self.__ids[name]
+        except KeyError:
+            try:
+                id_ = self.byname(name)[2]
+            except (KeyError, TypeError):
+                id_ = None
+            else:
+                self.__names[id_] = name
+            self.__ids[name] = id_
+            return id_
+
+    def __load_all(self, generation):
+        """load all names, they are stored only if cache has not been
+        cleared since generation. Return them anyway"""
+        names = [e[0] for e in self.getall()]
+        self.__lock.acquire()
+        if generation == self.__generation:
+            self.__all = names
+            self.__loader = None
+        self.__lock.release()
+        return names
+
+    def preload(self):
+        """start loading the list of all names in background"""
+        self.check()
+        self.__lock.acquire()
+        try:
+            if self.__all is not None or self.__loader is not None:
+                return
+            self.__loader = threading.Thread(target=self.__load_all,
+                                             args=(self.__generation, ))
+            self.__loader.setDaemon(True)
+            self.__loader.start()
+        finally:
+            self.__lock.release()
+
+    def get_all(self):
+        """return a list with all names, waiting for background load"""
+        self.preload()
+        loader = self.__loader
+        if loader is not None:
+            loader.join()
+        names = self.__all
+        if names is None: # cleared while loading
+            names = self.__load_all(self.__generation)
+        return names[:]
+
+
+users = NameCache(pwd.getpwuid, pwd.getpwnam, pwd.getpwall, '/etc/passwd')
+groups = NameCache(grp.getgrgid, grp.getgrnam, grp.getgrall, '/etc/group')
+
+
+########################################################################
+##### symbolic links cache
+class LinkCache(object):
+    """Symbolic links resolved while reading directories, so they don't
+    need to be resolved again to show, enter or copy them.
+    For every link: (target, target_stat, dangling), target is read
+    only when asked for. Entries are grouped by directory, those of a
+    directory are forgotten when it is read again"""
+
+    def __init__(self, maxdirs=256):
+        self.maxdirs = maxdirs
+        self.__dirs = {}           # path -> {filename: [key, target, st]}
+
+    def forget_dir(self, path):
+        self.__dirs.pop(path, None)
+
+    def __add(self, f, lst):
+        try:
+            st = os.stat(f)
+        except OSError:
+            st = None
+        path, filename = os.path.split(f)
+        d = self.__dirs.get(path)
+        if d is None:
+            if len(self.__dirs) >= self.maxdirs:
+                self.__dirs.clear()
+            d = self.__dirs[path] = {}
+        # a link can't be modified, only replaced by other inode
+        e = d[filename] = [(lst[stat.ST_INO], lst.st_ctime), None, st]
+        return e
+
+    def resolve(self, f, lst):
+        """stat f link, whose lstat is lst, and remember it.
+        Return (target_stat, dangling)"""
+        st = self.__add(f, lst)[2]
+        return st, st is None
+
+    def get(self, f, lst=None):
+        """return (target, target_stat, dangling) for f link.
+        Cached value is checked with lst, the lstat of f, which is done
+        if not given: the link could have been replaced.
+        Raise OSError if f can't be read"""
+        if lst is None:
+            lst = os.lstat(f)
+        path, filename = os.path.split(f)
+        e = self.__dirs.get(path, {}).get(filename)
+        if e is None or e[0] != (lst[stat.ST_INO], lst.st_ctime):
+            e = self.__add(f, lst)
+        if e[1] is None:
+            e[1] = os.readlink(f)
+        return e[1], e[2], e[2] is None
+
+    def get_target(self, f, lst=None):
+        return self.get(f, lst)[0]
+
+
+links = LinkCache()
+
+
+########################################################################
+##### files listing
+class FileList(object):
+    """Files information of a directory. It behaves as a dict
+    filename -> (filetype, perms, owner, group, size, mtime, rdev), but values
+    are kept in columns: typed arrays for the numbers, and owner and
+    group as indexes in a table of strings. So a huge directory doesn't
+    need a tuple and its objects per file, and can be sorted by columns.
+    Deleted rows are left as holes (None name) until they are too many"""
+
+    def __init__(self, files_dict=None):
+        self.names = []                   # row -> filename or None
+        self.index = {}                   # filename -> row
+        self.types = array.array('B')
+        self.perms = array.array('H')
+        self.owners = array.array('I')    # index in strings
+        self.groups = array.array('I')    # index in strings
+        self.sizes = array.array('d')     # no 64 bits integers in array
+        self.mtimes = array.array('d')
+        self.rdevs = {}                   # row -> rdev, only for devices
+        self.strings = []                 # owner and group names
+        self.__strings_ids = {}
+        self.__holes = 0
+        self.__keys = {}                  # sort keys by kind, per row
+        if files_dict is not None:
+            for f, v in files_dict.iteritems():
+                self[f] = v
+
+    def __string_id(self, s):
+        try:
+            return self.__strings_ids[s]
+        except KeyError:
+            i = self.__strings_ids[s] = len(self.strings)
+            self.strings.append(s)
+            return i
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, f):
+        return f in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, f):
+        return self.get_row(self.index[f])
+
+    def __setitem__(self, f, v):
+        typ, perms, owner, group, size, mtime, rdev = v
+        owner, group = self.__string_id(owner), self.__string_id(group)
+        i = self.index.get(f)
+        if rdev:
+            self.rdevs[len(self.names) if i is None else i] = rdev
+        elif i is not None:
+            self.rdevs.pop(i, None)
+        if i is None:
+            self.index[f] = len(self.names)
+            self.names.append(f)
+            self.types.append(typ)
+            self.perms.append(perms)
+            self.owners.append(owner)
+            self.groups.append(group)
+            self.sizes.append(size)
+            self.mtimes.append(mtime)
+        else:
+            self.types[i], self.perms[i] = typ, perms
+            self.owners[i], self.groups[i] = owner, group
+            self.sizes[i], self.mtimes[i] = size, mtime
+
+    def __delitem__(self, f):
+        self.names[self.index.pop(f)] = None
+        self.__holes += 1
+        if self.__holes > len(self.index):
+            self.__compact()
+
+    def __compact(self):
+        rows = [i for i, f in enumerate(self.names) if f is not None]
+        for attr in ('names', 'types', 'perms', 'owners', 'groups',
+                     'sizes', 'mtimes'):
+            col = getattr(self, attr)
+            new = col[:0]
+            new.extend(map(col.__getitem__, rows))
+            setattr(self, attr, new)
+        self.rdevs = dict([(i, self.rdevs[j]) for i, j in enumerate(rows)
+                           if j in self.rdevs])
+        self.index = dict(zip(self.names, xrange(len(self.names))))
+        self.__holes = 0
+        self.__keys = {}
+
+    def get_row(self, i):
+        return (self.types[i], self.perms[i],
+                self.strings[self.owners[i]], self.strings[self.groups[i]],
+                int(self.sizes[i]), int(self.mtimes[i]), self.rdevs.get(i, 0))
+
+    def get(self, f, default=None):
+        i = self.index.get(f)
+        return default if i is None else self.get_row(i)
+
+    def keys(self):
+        return self.index.keys()
+
+    def iterkeys(self):
+        return iter(self.index)
+
+    def iteritems(self):
+        for f, i in self.index.iteritems():
+            yield f, self.get_row(i)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [v for f, v in self.iteritems()]
+
+    def copy(self):
+        new = FileList()
+        for attr in ('names', 'types', 'perms', 'owners', 'groups',
+                     'sizes', 'mtimes', 'strings'):
+            setattr(new, attr, getattr(self, attr)[:])
+        new.index = self.index.copy()
+        new.rdevs = self.rdevs.copy()
+        new.__strings_ids = self.__strings_ids.copy()
+        new.__holes = self.__holes
+        new.__keys = dict([(k, v[:]) for k, v in self.__keys.iteritems()])
+        return new
+
+    def __get_keys(self, kind):
+        """return the list of kind sort keys for all rows, computed only
+        for rows added since last call"""
+        if kind == 'name':
+            return self.names
+        keys = self.__keys.setdefault(kind, [])
+        if len(keys) < len(self.names):
+            keyfunc = SORT_KEYFUNCS[kind]
+            keys.extend([keyfunc(f) if f is not None else None
+                         for f in self.names[len(keys):]])
+        return keys
+
+    def __get_sort_columns(self, sortmode, sort_mix_cases):
+        """return the primary and name (for ties) keys columns"""
+        if sortmode == SORTTYPE_None:
+            return None, None
+        names = self.__get_keys(sort_mix_cases and 'lname' or 'name')
+        if sortmode in (SORTTYPE_bySize, SORTTYPE_bySize_rev):
+            return self.sizes, names
+        elif sortmode in (SORTTYPE_byDate, SORTTYPE_byDate_rev):
+            return self.mtimes, names
+        elif sortmode in (SORTTYPE_byExt, SORTTYPE_byExt_rev):
+            return self.__get_keys('ext'), names
+        elif sortmode in (SORTTYPE_byNatural, SORTTYPE_byNatural_rev):
+            return self.__get_keys(sort_mix_cases and 'lnatural' or 'natural'), names
+        else:
+            return None, names
+
+    def get_sort_key(self, f, sortmode, sort_mix_dirs, sort_mix_cases):
+        """return the key f is sorted by, as a tuple:
+        (not dir, primary key, name key)"""
+        i = self.index[f]
+        primary, names = self.__get_sort_columns(sortmode, sort_mix_cases)
+        group = not sort_mix_dirs and self.types[i] not in (FTYPE_DIR, FTYPE_LNK2DIR)
+        return (group, primary[i] if primary is not None else 0,
+                names[i] if names is not None else 0)
+
+    def sort(self, sortmode, sort_mix_dirs, sort_mix_cases):
+        """return the list of files sorted by mode, directories first
+        if not sort_mix_dirs. Sorting is done by the columns and the
+        cached sort keys, with no python code per file"""
+
+        names = self.names
+        if self.__holes:
+            rows = [i for i, f in enumerate(names) if f is not None]
+        else:
+            rows = range(len(names))
+        # stable sorts, from the least significant key
+        primary, namekeys = self.__get_sort_columns(sortmode, sort_mix_cases)
+        reverse = sortmode in SORTTYPES_REVERSE
+        if namekeys is not None:
+            rows.sort(key=namekeys.__getitem__, reverse=reverse)
+        if primary is not None:
+            rows.sort(key=primary.__getitem__, reverse=reverse)
+        if not sort_mix_dirs:
+            # stable sort by a '\0' (dir) or '\1' (not dir) per row
+            notdirs = self.types.tostring().translate(NOTDIR_TABLE)
+            rows.sort(key=notdirs.__getitem__)
+        i = self.index.get(os.pardir)
+        if i is not None: # move pardir to top
+            rows.remove(i)
+            rows.insert(0, i)
+        return map(names.__getitem__, rows)
+
+
+########################################################################
+##### selections
+class Selections(object):
+    """Selected files of a tab: a set which keeps the order in which
+    files were selected. Removed files are left as holes in the order
+    list until they are too many, like in FileList"""
+
+    def __init__(self, fs=()):
+        self.__order = []       # filename or None
+        self.__pos = {}         # filename -> index in order
+        self.update(fs)
+
+    def __len__(self):
+        return len(self.__pos)
+
+    def __contains__(self, f):
+        return f in self.__pos
+
+    def __iter__(self):
+        for f in self.__order:
+            if f is not None:
+                yield f
+
+    def add(self, f):
+        if f not in self.__pos:
+            self.__pos[f] = len(self.__order)
+            self.__order.append(f)
+
+    def discard(self, f):
+        i = self.__pos.pop(f, None)
+        if i is None:
+            return
+        self.__order[i] = None
+        if len(self.__order) > 2*len(self.__pos) + 32:
+            self.__order = list(self)
+            self.__pos = dict(zip(self.__order, xrange(len(self.__order))))
+
+    def toggle(self, f):
+        if f in self.__pos:
+            self.discard(f)
+        else:
+            self.add(f)
+
+    def update(self, fs):
+        for f in fs:
+            self.add(f)
+
+    def difference_update(self, fs):
+        for f in fs:
+            self.discard(f)
+
+    def intersection_update(self, fs):
+        """keep only the selected files which are in fs (a dict or set),
+        f.e. after the listing has been read again"""
+        for f in [f for f in self.__pos if f not in fs]:
+            self.discard(f)
+
+    def clear(self):
+        self.__order, self.__pos = [], {}
+
+    def copy(self):
+        return Selections(self)
+
+    def add_matching(self, names, pattern):
+        self.update(match_names(names, pattern))
+
+    def discard_matching(self, names, pattern):
+        self.difference_update(match_names(names, pattern))
 
 
+def match_names(names, pattern):
+    """names matching a shell pattern, dotfiles only if the pattern
+    starts with a dot, as glob does"""
+    fs = fnmatch.filter([f for f in names if f != os.pardir], pattern)
+    if not pattern.startswith('.'):
+        fs = [f for f in fs if not f.startswith('.')]
+    return fs
+
+
+########################################################################
+##### quick filter
+class NameFilter(object):
+    """Filter of a sorted listing: the names which contain a text, match
+    it as a glob pattern if it has wildcards, or if fuzzy, contain its
+    characters in the same order. Case is ignored. pardir always passes.
+    Lowercase names are computed once, and when the text grows only the
+    names which matched the shorter text are checked again"""
+
+    def __init__(self, names):
+        self.names = names        # the whole listing
+        self.text = u''
+        self.fuzzy = False
+        self.__lows = None        # lowercase names, when needed
+        self.__stack = []         # (text, fuzzy, names, lows) while typing
+        self.__check = None
+
+    def __get_check(self, text, fuzzy):
+        """return a function which returns a list of flags for the names
+        matching text from a list of lowercase names"""
+        text = text.lower()
+        if re.search(r'[*?[]', text):
+            match = re.compile(fnmatch.translate(text), re.UNICODE).match
+        elif fuzzy:
+            match = re.compile(u'.*?'.join(map(re.escape, text)),
+                               re.UNICODE).search
+        else:
+            return lambda lows: [text in l for l in lows]
+        return lambda lows: map(match, lows)
+
+    def __get_all(self):
+        if self.__lows is None:
+            self.__lows = [f.lower() for f in self.names]
+        if self.names and self.names[0] == os.pardir:
+            return self.names[1:], self.__lows[1:]
+        return self.names, self.__lows
+
+    def set_text(self, text, fuzzy=False):
+        """set the text to filter by, return the matching names"""
+        self.text, self.fuzzy = text, fuzzy
+        self.__check = self.__get_check(text, fuzzy)
+        narrow = not re.search(r'[*?[]', text)
+        # names which matched a shorter text typed before
+        while self.__stack:
+            t, fz, ns, ls = self.__stack[-1]
+            if narrow and fz == fuzzy and text.startswith(t):
+                break
+            self.__stack.pop()
+        if self.__stack:
+            t, fz, ns, ls = self.__stack[-1]
+        else:
+            ns, ls = self.__get_all()
+            t = None
+        if t != text:
+            flags = self.__check(ls)
+            ns = list(itertools.compress(ns, flags))
+            ls = list(itertools.compress(ls, flags))
+            if narrow:
+                self.__stack.append((text, fuzzy, ns, ls))
+        if self.names and self.names[0] == os.pardir:
+            return [os.pardir] + ns
+        return ns[:]
+
+    def filter_names(self, fs):
+        """return the names in fs which match"""
+        return [f for f, ok in zip(fs, self.__check([f.lower() for f in fs]))
+                if ok or f == os.pardir]
+
+    def extend(self, fs):
+        """fs have been appended to names, return those which match"""
+        if self.__lows is not None:
+            self.__lows.extend([f.lower() for f in fs])
+        self.__stack = []
+        return self.filter_names(fs)
+
+    def names_changed(self):
+        """names has been modified in place, or replaced"""
+        self.__lows = None
+        self.__stack = []
+
+
+########################################################################
+##### general functions
 def __get_size(f):
     """return the size of the directory or file via 'du -sk' command"""
 
@@ -82,7 +822,7 @@ def get_realpath(path, filename, filetype):
 
     if filetype in (FTYPE_LNK2DIR, FTYPE_LNK, FTYPE_NLNK):
         try:
-            return '-> ' + os.readlink(os.path.join(path, filename))
+            return '-> ' + links.get_target(os.path.join(path, filename))
         except os.error:
             return os.path.join(path, filename)
     else:
@@ -92,7 +832,7 @@ def get_realpath(path, filename, filetype):
 def get_linkpath(path, filename):
     """return absolute path to the destination of a link"""
 
-    link_dest = os.readlink(os.path.join(path, filename))
+    link_dest = links.get_target(os.path.join(path, filename))
     return os.path.normpath(os.path.join(path, link_dest))
 
 
@@ -102,18 +842,18 @@ def join(directory, f):
     return os.path.join(directory, f)
 
 
-def __get_filetype(lmode, f):
-    """get the type of the file. See listed types above"""
+def __get_filetype(lst, f):
+    """get the type of the file from its lstat. See listed types above"""
 
+    lmode = lst[stat.ST_MODE]
     if stat.S_ISDIR(lmode):
         return FTYPE_DIR
     if stat.S_ISLNK(lmode):
-        try:
-            mode = os.stat(f)[stat.ST_MODE]
-        except OSError:
+        st, dangling = links.resolve(f, lst)
+        if dangling:
             return FTYPE_NLNK
         else:
-            return FTYPE_LNK2DIR if stat.S_ISDIR(mode) else FTYPE_LNK
+            return FTYPE_LNK2DIR if stat.S_ISDIR(st[stat.ST_MODE]) else FTYPE_LNK
     if stat.S_ISCHR(lmode):
         return FTYPE_CDEV
     if stat.S_ISBLK(lmode):
@@ -128,36 +868,33 @@ def __get_filetype(lmode, f):
         return FTYPE_REG       # if no other type, regular file
 
 
-def get_fileinfo(f, pardir_flag=False, show_dirs_size=False):
-    """return information about a file, with format:
-    (filetype, perms, owner, group, size, mtime)"""
+def __stat2fileinfo(st, f, pardir_flag=False, show_dirs_size=False):
+    """build the (filetype, perms, owner, group, size, mtime, rdev) tuple
+    from an already done lstat, so the caller doesn't need to stat again"""
 
-    f = os.path.abspath(f)
-    try:
-        st = os.lstat(f)
-    except OSError:
-        return (FTYPE_UNKNOWN, 0, 'root', 'root', 0, 0)
-    typ = __get_filetype(st[stat.ST_MODE], f)
+    typ = __get_filetype(st, f)
+    rdev = 0
     if typ in (FTYPE_DIR, FTYPE_LNK2DIR) and not pardir_flag and show_dirs_size:
         size = __get_size(f)
     elif typ in (FTYPE_CDEV, FTYPE_BDEV):
-        # HACK: it's too time consuming to calculate all files' rdevs
-        #       in a directory, so we just calculate what we need
-        #       at show time
-        # maj_red, min_rdev = get_rdev(file)
-        size = 0
+        size, rdev = 0, st.st_rdev
     else:
         size = st[stat.ST_SIZE]
+    return (typ, stat.S_IMODE(st[stat.ST_MODE]),
+            users.get_name(st[stat.ST_UID]), groups.get_name(st[stat.ST_GID]),
+            size, st[stat.ST_MTIME], rdev)
+
+
+def get_fileinfo(f, pardir_flag=False, show_dirs_size=False):
+    """return information about a file, with format:
+    (filetype, perms, owner, group, size, mtime, rdev)"""
+
+    f = os.path.abspath(f)
     try:
-        owner = pwd.getpwuid(st[stat.ST_UID])[0]
-    except:
-        owner = unicode(st[stat.ST_UID])
-    try:
-        group = grp.getgrgid(st[stat.ST_GID])[0]
-    except:
-        group = unicode(st[stat.ST_GID])
-    return (typ, stat.S_IMODE(st[stat.ST_MODE]), owner, group,
-            size, st[stat.ST_MTIME])
+        st = os.lstat(f)
+    except OSError:
+        return (FTYPE_UNKNOWN, 0, 'root', 'root', 0, 0, 0)
+    return __stat2fileinfo(st, f, pardir_flag, show_dirs_size)
 
 
 def get_fileinfo_extended(f):
@@ -197,13 +934,9 @@ def get_fileinfo_dict(path, filename, filevalues):
     typ = filevalues[FT_TYPE]
     res['type_chr'] = FILETYPES[typ][0]
     if typ in (FTYPE_CDEV, FTYPE_BDEV):
-        # HACK: it's too time consuming to calculate all files' rdevs
-        #       in a directory, so we just calculate needed ones here
-        #       at show time
-        maj_rdev, min_rdev = get_rdev(os.path.join(path, filename))
         res['size'] = 0
-        res['maj_rdev'] = maj_rdev
-        res['min_rdev'] = min_rdev
+        res['maj_rdev'] = os.major(filevalues[FT_RDEV])
+        res['min_rdev'] = os.minor(filevalues[FT_RDEV])
         res['dev'] = 1
     else:
         size = filevalues[FT_SIZE]
@@ -232,32 +965,129 @@ def get_fileinfo_dict(path, filename, filevalues):
     return res
 
 
+def read_dir(path, show_dotfiles=1):
+    """return a list of (filename, d_type) for the entries in path,
+    without stat'ing them"""
+
+    lst = []
+    for f, d_type in iter_dir(path):
+        if not show_dotfiles and f[0] == '.':
+            continue
+        lst.append((check_filename_encoding(path, f), d_type))
+    return lst
+
+
+def check_filename_encoding(path, f):
+    """return f file name as unicode. If it has an invalid encoding
+    the file is renamed, if user wants"""
+
+    if not isinstance(f, unicode):
+        newf = decode(f)
+        if ask_convert_invalid_encoding_filename(newf):
+            convert_filename_encoding(path, f, newf)
+        f = newf
+    return f
+
+
 def get_dir(path, show_dotfiles=1):
-    """return a dict whose elements are formed by file name as key
-    and a (filetype, perms, owner, group, size, mtime) tuple as value"""
+    """return a FileList, a dict whose elements are formed by file name
+    as key and a (filetype, perms, owner, group, size, mtime, rdev) tuple
+    as value"""
 
     # bug in python: os.path.normpath(u'/') returns str instead of unicode,
     #                so convert to unicode anyway
     path = decode(os.path.normpath(path))
-    files_dict = {}
+    files_dict = FileList()
+    links.forget_dir(path)
+    users.check()
+    groups.check()
     if path != os.sep:
         files_dict[os.pardir] = get_fileinfo(os.path.dirname(path), 1)
-    files_list = os.listdir(path)
-    if not show_dotfiles:
-        files_list = [f for f in files_list if f[0] != '.']
-    for f in files_list:
-        if not isinstance(f, unicode):
-            newf = decode(f)
-            if ask_convert_invalid_encoding_filename(newf):
-                convert_filename_encoding(path, f, newf)
-            f = newf
-        files_dict[f] = get_fileinfo(os.path.join(path, f))
+    # d_type is not used here: the lstat is needed anyway for perms, owner,
+    # size and mtime. get_dir_lazy uses it to delay the lstat
+    fs = [f for f, d_type in read_dir(path, show_dotfiles)]
+    stat_dir_entries(path, files_dict, fs)
     return len(files_dict), files_dict
 
 
+def get_dir_lazy(path, show_dotfiles=1, min_entries=0, stat_links=True):
+    """like get_dir, but if there are more than min_entries files
+    they are not stat'ed, their values are a placeholder deduced from
+    d_type. Links (if stat_links) and files whose type is unknown are
+    always stat'ed, as their type is needed to sort.
+    return nfiles, files_dict and a set with the files pending to stat,
+    to be loaded later with stat_dir_entries"""
+
+    path = decode(os.path.normpath(path))
+    entries = read_dir(path, show_dotfiles)
+    files_dict = FileList()
+    links.forget_dir(path)
+    users.check()
+    groups.check()
+    if path != os.sep:
+        files_dict[os.pardir] = get_fileinfo(os.path.dirname(path), 1)
+    if len(entries) <= min_entries:
+        stat_dir_entries(path, files_dict, [f for f, d_type in entries])
+        return len(files_dict), files_dict, set()
+    pending, tostat = set(), []
+    for f, d_type in entries:
+        typ = DTYPE2FTYPE.get(d_type)
+        if typ is None or (typ == FTYPE_LNK and stat_links):
+            tostat.append(f)
+        else:
+            files_dict[f] = (typ, 0, '', '', 0, 0, 0)
+            pending.add(f)
+    stat_dir_entries(path, files_dict, tostat)
+    return len(files_dict), files_dict, pending
+
+
+def stat_dir_entries(path, files_dict, fs):
+    """stat fs files in path and store their information in files_dict"""
+
+    for f, info in zip(fs, get_dir_entries(path, fs)):
+        files_dict[f] = info or (FTYPE_UNKNOWN, 0, 'root', 'root', 0, 0, 0)
+
+
+def get_dir_entry(path, f):
+    """return information about f file in path directory, as get_dir,
+    or None if it does not exist"""
+
+    fullpath = os.path.join(path, f)
+    try:
+        st = os.lstat(fullpath)
+    except OSError:
+        return None
+    return __stat2fileinfo(st, fullpath)
+
+
+def get_dir_entries(path, fs):
+    """return a list with get_dir_entry results for fs files in path.
+    On network filesystems several threads are used, the number depends
+    on the filesystem type, see STAT_CONCURRENCY"""
+
+    nthreads = 1
+    if len(fs) >= STAT_CONCURRENCY_MIN_ENTRIES:
+        nthreads = STAT_CONCURRENCY.get(get_fstype(path), 1)
+    res = [None] * len(fs)
+    def get_entries(start):
+        for i in xrange(start, len(fs), nthreads):
+            res[i] = get_dir_entry(path, fs[i])
+    if nthreads == 1:
+        get_entries(0)
+        return res
+    threads = [threading.Thread(target=get_entries, args=(i, ))
+               for i in xrange(nthreads)]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return res
+
+
 def get_owners():
     """get a list with the users defined in the system"""
-    return [e[0] for e in pwd.getpwall()]
+    return users.get_all()
 
 
 def get_user_fullname(user):
@@ -270,7 +1100,7 @@ def get_user_fullname(user):
 
 def get_groups():
     """get a list with the groups defined in the system"""
-    return [e[0] for e in grp.getgrall()]
+    return groups.get_all()
 
 
 def set_perms(f, perms, recursive=False):
@@ -305,13 +1135,11 @@ def set_perms(f, perms, recursive=False):
 
 def set_owner_group(f, owner, group, recursive=False):
     """set owner and group to a file"""
-    try:
-        owner_n = pwd.getpwnam(owner)[2]
-    except:
+    owner_n = users.get_id(owner)
+    if owner_n is None:
         owner_n = int(owner)
-    try:
-        group_n = grp.getgrnam(group)[2]
-    except:
+    group_n = groups.get_id(group)
+    if group_n is None:
         group_n = int(group)
     try:
         if recursive:
@@ -340,6 +1168,42 @@ def get_mount_points():
     return sorted(lst, reverse=True)
 
 
+_fstypes = {}    # st_dev -> filesystem type, see get_fstype
+
+def get_fstype(path):
+    """return the type of the filesystem where path is, as shown in
+    /proc/mounts, or '' if unknown.
+    Types are remembered by device, so /proc/mounts is only parsed the
+    first time a filesystem is seen"""
+
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        dev = None
+    else:
+        if dev in _fstypes:
+            return _fstypes[dev]
+    try:
+        buf = open('/proc/mounts').read()
+    except IOError:
+        return ''
+    path = os.path.realpath(path)
+    if isinstance(path, unicode):
+        path = encode(path)
+    mp_best, fstype = '', ''
+    for line in buf.splitlines():
+        es = line.split()
+        if len(es) < 3:
+            continue
+        mp = es[1].decode('string_escape') # spaces are escaped as \040
+        if (path == mp or path.startswith(mp.rstrip(os.sep) + os.sep)) \
+                and len(mp) >= len(mp_best):
+            mp_best, fstype = mp, es[2]
+    if dev is not None:
+        _fstypes[dev] = fstype
+    return fstype
+
+
 def get_mountpoint_for_file(f):
     # check mps
     mps = get_mount_points()
@@ -379,46 +1243,291 @@ def mkdtemp():
     return tempfile.mkdtemp()
 
 
+########################################################################
+##### directory snapshots
+MAX_SNAPSHOT_CHANGES = 1000
+READER_CHUNK_SIZE = 1000    # entries, ...
+READER_CHUNK_TIME = 0.05    # ... or seconds, whatever comes first
+
+
+class DirSnapshot(object):
+    """Files information of a directory, shared read-only by all the tabs
+    showing it. Each tab keeps its own sort order and selections.
+    Changes applied with update are logged, so the other tabs can replay
+    them on their sorted lists"""
+
+    def __init__(self, path, show_dotfiles, files_dict, pending, times):
+        self.path = path
+        self.show_dotfiles = show_dotfiles
+        self.files = files_dict
+        self.pending = pending # files not stat'ed yet
+        self.times = times     # directory (mtime, ctime) when read
+        self.read_time = time.time()
+        self.changes = []      # [(filename, old_value, new_value), ...]
+        self.serial = 0        # number of changes ever applied
+
+    def is_valid(self):
+        """the directory has not been modified since it was read"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        # modifications in the same clock tick as the reading go unnoticed
+        return (st.st_mtime, st.st_ctime) == self.times and \
+            self.read_time - st.st_ctime > 1
+
+    def copy(self):
+        """private copy, not shared with the other tabs"""
+        snap = DirSnapshot(self.path, self.show_dotfiles, self.files.copy(),
+                           self.pending.copy(), self.times)
+        snap.read_time = self.read_time
+        return snap
+
+    def update(self, fs):
+        """read the information of fs files again, logging the changes"""
+        for f in fs:
+            if f == os.pardir or (not self.show_dotfiles and f[0] == '.'):
+                continue
+            new = get_dir_entry(self.path, f)
+            old = self.files.get(f)
+            if new == old:
+                continue
+            self.pending.discard(f)
+            if new is None:
+                del self.files[f]
+            else:
+                self.files[f] = new
+            self.changes.append((f, old, new))
+            self.serial += 1
+        del self.changes[:-MAX_SNAPSHOT_CHANGES]
+
+    def get_changes(self, serial):
+        """return the changes applied after serial, or None if they are
+        not available anymore"""
+        n = self.serial - serial
+        if n > len(self.changes):
+            return None
+        return self.changes[len(self.changes)-n:]
+
+    def add_chunks(self, chunks):
+        """add the entries read by a DirReader, return the new names"""
+        new = []
+        for chunk in chunks:
+            for f, info, pending in chunk:
+                if info is None: # invalid encoding
+                    f = check_filename_encoding(self.path, f)
+                    info = get_dir_entry(self.path, f)
+                    if info is None:
+                        continue
+                if f not in self.files:
+                    new.append(f)
+                self.files[f] = info
+                if pending:
+                    self.pending.add(f)
+                else:
+                    self.pending.discard(f)
+        return new
+
+
+class DirReader(object):
+    """Read a directory in a background thread. Entries are collected in
+    chunks of (filename, fileinfo, pending) which the main thread gets
+    with get_chunks and adds to a DirSnapshot.
+    If lazy, files are not stat'ed as in get_dir_lazy: fileinfo is a
+    placeholder and pending is True. Names with invalid encoding have no
+    fileinfo, they must be checked in the main thread as user could be
+    asked.
+    notify() is called from the thread when a chunk is ready or reading
+    finishes"""
+
+    def __init__(self, path, show_dotfiles=1, lazy=True, notify=None):
+        self.path = path
+        self.show_dotfiles = show_dotfiles
+        self.lazy = lazy
+        self.notify = notify
+        self.done = False
+        self.error = None          # (strerror, errno) if reading failed
+        self.__chunks = []
+        self.__stop = False
+        self.__lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.__read)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def __read(self):
+        entries, t0 = [], time.time()
+        it = iter_dir(self.path)
+        try:
+            try:
+                for f, d_type in it:
+                    if self.__stop:
+                        break
+                    if not self.show_dotfiles and f[0] == '.':
+                        continue
+                    entries.append((f, d_type))
+                    if len(entries) >= READER_CHUNK_SIZE or \
+                            time.time()-t0 > READER_CHUNK_TIME:
+                        self.__add_chunk(entries)
+                        entries, t0 = [], time.time()
+                if not self.__stop:
+                    self.__add_chunk(entries)
+            except OSError, (err, strerror):
+                self.error = (strerror, err)
+        finally:
+            it.close()
+            self.done = True
+            if self.notify:
+                self.notify()
+
+    def __add_chunk(self, entries):
+        chunk, tostat = [], []
+        for f, d_type in entries:
+            typ = DTYPE2FTYPE.get(d_type)
+            if not isinstance(f, unicode):
+                chunk.append((f, None, False))
+            elif not self.lazy or typ is None or typ == FTYPE_LNK:
+                tostat.append(f)
+            else:
+                chunk.append((f, (typ, 0, '', '', 0, 0, 0), True))
+        for f, info in zip(tostat, get_dir_entries(self.path, tostat)):
+            # None if entry removed while reading the directory
+            if info is not None:
+                chunk.append((f, info, False))
+        self.__lock.acquire()
+        self.__chunks.append(chunk)
+        self.__lock.release()
+        if self.notify:
+            self.notify()
+
+    def get_chunks(self):
+        """return the chunks read since last call"""
+        self.__lock.acquire()
+        chunks, self.__chunks = self.__chunks, []
+        self.__lock.release()
+        return chunks
+
+    def wait(self, timeout):
+        """wait until the reading finishes or timeout seconds,
+        return True if finished"""
+        self.__thread.join(timeout)
+        return self.done
+
+    def stop(self):
+        """ask the thread to finish, entries not read yet are lost"""
+        self.__stop = True
+
+
+__snapshots = weakref.WeakValueDictionary() # only those used by some tab
+
+
+def get_dir_snapshot(path, show_dotfiles=1, lazy_threshold=0):
+    """return a DirSnapshot with the contents of path directory, shared
+    with the other tabs if it has not changed.
+    If lazy_threshold > 0, the files are read as in get_dir_lazy"""
+
+    snap = get_shared_dir_snapshot(path, show_dotfiles)
+    if snap is not None:
+        return snap
+    path = decode(os.path.abspath(path))
+    st = os.stat(path)
+    if lazy_threshold > 0:
+        nfiles, files_dict, pending = get_dir_lazy(path, show_dotfiles,
+                                                   lazy_threshold)
+    else:
+        nfiles, files_dict = get_dir(path, show_dotfiles)
+        pending = set()
+    snap = DirSnapshot(path, show_dotfiles, files_dict, pending,
+                       (st.st_mtime, st.st_ctime))
+    share_dir_snapshot(snap)
+    return snap
+
+
+def new_dir_snapshot(path, show_dotfiles=1):
+    """return a DirSnapshot of path with pardir only, the rest of files
+    to be added from a DirReader"""
+
+    path = decode(os.path.abspath(path))
+    st = os.stat(path)
+    files_dict = FileList()
+    links.forget_dir(path)
+    users.check()
+    groups.check()
+    if path != os.sep:
+        files_dict[os.pardir] = get_fileinfo(os.path.dirname(path), 1)
+    return DirSnapshot(path, show_dotfiles, files_dict, set(),
+                       (st.st_mtime, st.st_ctime))
+
+
+def get_shared_dir_snapshot(path, show_dotfiles=1):
+    """return the DirSnapshot of path used by other tab if it is still
+    valid, None otherwise"""
+
+    snap = __snapshots.get((decode(os.path.abspath(path)), show_dotfiles))
+    if snap is not None and snap.is_valid():
+        return snap
+    return None
+
+
+def share_dir_snapshot(snap):
+    __snapshots[(snap.path, snap.show_dotfiles)] = snap
+
+
+def forget_dir_snapshots():
+    """don't share the current snapshots anymore, the files could have
+    been modified without changing the directory times"""
+    __snapshots.clear()
+
+
 ########################################################################
 ##### sort
-def __do_sort(f_dict, sortmode, sort_mix_cases):
+NATURAL_SPLIT_RE = re.compile(r'(\d+)', re.UNICODE)
+
+def __natural_key(f):
+    """'file10.txt' -> ('file', 10, '.txt'), so it goes after 'file9.txt'"""
+    parts = NATURAL_SPLIT_RE.split(f)
+    parts[1::2] = map(int, parts[1::2])
+    return tuple(parts)
+
+
+SORT_KEYFUNCS = { 'lname': lambda f: f.lower(),
+                  'ext': lambda f: os.path.splitext(f)[1].lower(),
+                  'natural': __natural_key,
+                  'lnatural': lambda f: __natural_key(f.lower()) }
+
+
+def insert_sorted(names, files_dict, f, sortmode, sort_mix_dirs, sort_mix_cases):
+    """insert f in names, a list already sorted by sort_dir, keeping
+    the order. Only O(log n) comparisons are needed"""
+
     if sortmode == SORTTYPE_None:
-        names = f_dict.keys()
-    elif sortmode in (SORTTYPE_byName, SORTTYPE_byName_rev):
-        names = sorted(f_dict.keys(),
-                       key=lambda f: f.lower() if sort_mix_cases else f,
-                       reverse=sortmode==SORTTYPE_byName_rev)
-    elif sortmode in (SORTTYPE_bySize, SORTTYPE_bySize_rev):
-        names = sorted(f_dict.keys(),
-                       key=lambda f: f_dict[f][FT_SIZE],
-                       reverse=sortmode==SORTTYPE_bySize_rev)
-    elif sortmode in (SORTTYPE_byDate, SORTTYPE_byDate_rev):
-        names = sorted(f_dict.keys(),
-                       key=lambda f: f_dict[f][FT_MTIME],
-                       reverse=sortmode==SORTTYPE_byDate_rev)
-    if names.count(os.pardir) != 0: # move pardir to top
-        names.remove(os.pardir)
-        names.insert(0, os.pardir)
-    return names
+        names.append(f)
+        return
+    if not isinstance(files_dict, FileList):
+        files_dict = FileList(files_dict)
+    def key(f):
+        g, k1, k2 = files_dict.get_sort_key(f, sortmode, sort_mix_dirs,
+                                            sort_mix_cases)
+        return g, (k1, k2)
+    rev = sortmode in SORTTYPES_REVERSE
+    g, k = key(f)
+    lo = (names and names[0] == os.pardir) and 1 or 0
+    hi = len(names)
+    while lo < hi:
+        mid = int((lo+hi)/2)
+        gm, km = key(names[mid])
+        if gm < g or (gm == g and (rev and km >= k or not rev and km <= k)):
+            lo = mid + 1
+        else:
+            hi = mid
+    names.insert(lo, f)
 
 
 def sort_dir(files_dict, sortmode, sort_mix_dirs, sort_mix_cases):
     """return an array of files which are sorted by mode"""
 
-    d, f = {}, {}
-    if sort_mix_dirs:
-        f = files_dict
-        d1 = []
-    else:
-        for k, v in files_dict.items():
-            if v[FT_TYPE] in (FTYPE_DIR, FTYPE_LNK2DIR):
-                d[k] = v
-            else:
-                f[k] = v
-        d1 = __do_sort(d, sortmode, sort_mix_cases)
-    d2 = __do_sort(f, sortmode, sort_mix_cases)
-    d1.extend(d2)
-    return d1
+    if not isinstance(files_dict, FileList):
+        files_dict = FileList(files_dict)
+    return files_dict.sort(sortmode, sort_mix_dirs, sort_mix_cases)
 
 
 ########################################################################
@@ -490,7 +1599,9 @@ def copy_bulk(src, dest):
     if os.path.isdir(src):
         shutil.copytree(src, dest, symlinks=True)
     elif os.path.isfile(src):
-        shutil.copy2(src, dest)
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        copy_file(src, dest)
 
 
 def delete_bulk(path, ignore_errors=False):
@@ -506,7 +1617,8 @@ def delete_bulk(path, ignore_errors=False):
             os.unlink(path)
 
 
-def do_copy(filename, basepath, dest, rename_dir=False, check_fileexists=True):
+def do_copy(filename, basepath, dest, rename_dir=False, check_fileexists=True,
+            progress=None):
     src = os.path.join(basepath, filename)
     if os.path.exists(dest) and os.path.isdir(dest):
         if rename_dir:
@@ -514,9 +1626,13 @@ def do_copy(filename, basepath, dest, rename_dir=False, check_fileexists=True):
         dest = os.path.join(dest, filename)
     if os.path.exists(dest) and check_fileexists:
         return os.path.basename(dest)
-    if os.path.islink(src):
+    try:
+        lst = os.lstat(src)
+    except OSError:
+        lst = None
+    if lst is not None and stat.S_ISLNK(lst[stat.ST_MODE]):
         try:
-            do_create_link(os.readlink(src), dest)
+            do_create_link(links.get_target(src, lst), dest)
         except (IOError, os.error), (errno, strerror):
             return (strerror, errno)
     elif os.path.isdir(src):
@@ -539,7 +1655,7 @@ def do_copy(filename, basepath, dest, rename_dir=False, check_fileexists=True):
     else:
         if os.path.isfile(src): # stat.S_ISREG(os.lstat(src)[stat.ST_MODE])
             try:
-                shutil.copy2(src, dest)
+                copy_file(src, dest, progress=progress)
             except (IOError, os.error), (errno, strerror):
                 return (strerror, errno)
         else:
@@ -573,6 +1689,12 @@ def do_backup(f, path, backup_ext):
         copy_bulk(src, dest)
     except (IOError, os.error), (errno, strerror):
         return (strerror, errno)
+    except UnicodeError:
+        # remove the partial backup, names as bytes as some are invalid
+        fs_encoding = sys.getfilesystemencoding() or 'utf-8'
+        delete_bulk(dest.encode(fs_encoding) if isinstance(dest, unicode)
+                    else dest, ignore_errors=True)
+        return ('Files with invalid encoding, convert first', 0)
 
 
 def do_delete(f):
@@ -598,6 +1720,16 @@ def mkdir(path, newdir):
 ########################################################################
 ##### PathContents
 class PathContents(object):
+    """The files and directories in fs, with all their contents.
+    Contents are walked while they are processed, so the work can start
+    at once; a thread started by count() walks them too to know the
+    totals, complete is True when they are known.
+    Full paths are only built for the entries yielded: a directory being
+    walked keeps the names of its entries and their sizes in arrays.
+    After record(), the directories listed by next walk are remembered in
+    the same way, each path once, and the walks after it go through them
+    without listing the directories again"""
+
     def __init__(self, fs, basepath=None):
         """fs must be a list with relative path to files"""
         if not isinstance(fs, list) or not len(fs) > 0:
@@ -607,81 +1739,260 @@ class PathContents(object):
         self.basepath = os.path.abspath(basepath)
         if not os.path.isdir(self.basepath):
             raise TypeError, "basepath must be a valid directory or None"
-        self.__entries = []
+        self.prune = set()        # paths not to walk
+        self.__top = []           # (path, size, isdir)
         self.__errors = []
         for f in fs:
-            f = os.path.join(self.basepath, f)
             try:
-                if os.path.islink(f):
-                    self.__entries.append((f, 0))
-                else:
-                    self.__entries.append((f, os.path.getsize(f)))
+                f = os.path.join(self.basepath, f)
+            except UnicodeDecodeError:
+                raise UnicodeError
+            try:
+                st = os.lstat(f)
             except (IOError, os.error), (errno, strerror):
                 self.__errors.append((f, (strerror, errno)))
             else:
-                if os.path.isdir(f) and not os.path.islink(f):
-                    try:
-                        self.__fill_contents(f)
-                    except UnicodeDecodeError:
-                        raise UnicodeError
+                self.__top.append((f, self.__get_size(st),
+                                   stat.S_ISDIR(st.st_mode)))
+        self.__top.sort()
+        self.__top_sizes = dict((f, size) for f, size, isdir in self.__top)
+        self.__removed = set()    # paths not to yield, contents are walked
+        self.__removed_count = self.__removed_size = 0
+        self.__count = self.__size = 0 # updated by counting thread
+        self.__counter = None
+        self.__stop = False
+        self.__record = None      # path -> (names, sizes, dirs) recorded
+        self.__record_count = self.__record_size = 0
+        self.__record_started = self.__record_done = False
+        self.complete = False
         self.length = len(fs)
-        self.tlength = len(self.__entries)
-        self.tsize = sum([f[1] for f in self.__entries]) or 1
 
-    def __fill_contents(self, path):
-        for root, dirs, files in os.walk(path, topdown=False, onerror=self.__on_error):
-            for d in dirs:
-                fullpath = os.path.join(root, d)
-                try:
-                    if os.path.islink(fullpath):
-                        self.__entries.append((fullpath, 0))
-                    else:
-                        self.__entries.append((fullpath, os.path.getsize(fullpath)))
-                except (IOError, os.error), (errno, strerror):
-                    self.__errors.append((fullpath, (strerror, errno)))
-            for f in files:
-                fullpath = os.path.join(root, f)
-                try:
-                    if os.path.islink(fullpath):
-                        self.__entries.append((fullpath, 0))
-                    else:
-                        self.__entries.append((fullpath, os.path.getsize(fullpath)))
-                except (IOError, os.error), (errno, strerror):
-                    self.__errors.append((fullpath, (strerror, errno)))
-
-    def __on_error(self, exc):
-        # print '[Error %d] %s: %s' % (exc.errno, exc.strerror, exc.filename)
-        fullpath = os.path.join(self.basepath, exc.filename)
-        self.__errors.append((fullpath, (exc.strerror, exc.errno)))
+    def __get_size(self, st):
+        return 0 if stat.S_ISLNK(st.st_mode) else st.st_size
+
+    def __list_dir(self, path, onerror=None):
+        """return the names in directory path, sorted, or None"""
+        try:
+            names = os.listdir(path)
+        except (IOError, os.error), (errno, strerror):
+            if onerror:
+                onerror((path, (strerror, errno)))
+            return None
+        names.sort()
+        return names
+
+    def __walk(self, path, reverse=False, onerror=None):
+        """yield (path, size) of the contents of directory path, parents
+        before children or children before parents if reverse"""
+        names = self.__list_dir(path, onerror)
+        if not names:
+            return
+        sizes = array.array('d')
+        dirs = array.array('B')
+        if self.__record_started and not self.__record_done:
+            self.__record[path] = (names, sizes, dirs)
+        for i, name in enumerate(names):
+            try:
+                f = os.path.join(path, name)
+            except UnicodeDecodeError:
+                raise UnicodeError
+            if f in self.prune:
+                sizes.append(-1)  # skipped, names are kept sorted
+                dirs.append(False)
+                continue
+            try:
+                st = os.lstat(f)
+            except (IOError, os.error), (errno, strerror):
+                if onerror:
+                    onerror((f, (strerror, errno)))
+                sizes.append(-1)
+                dirs.append(False)
+                continue
+            sizes.append(self.__get_size(st))
+            dirs.append(stat.S_ISDIR(st.st_mode))
+            if not reverse and f not in self.__removed:
+                yield f, int(sizes[i])
+        for i, name in enumerate(names):
+            if sizes[i] < 0:
+                continue
+            f = os.path.join(path, name)
+            if dirs[i]:
+                for e in self.__walk(f, reverse, onerror):
+                    yield e
+            if reverse and f not in self.__removed:
+                yield f, int(sizes[i])
+
+    def __count_dir(self, path):
+        """count the contents of directory path"""
+        for name in self.__list_dir(path) or []:
+            if self.__stop:
+                break
+            f = os.path.join(path, name)
+            if f in self.prune:
+                continue
+            try:
+                st = os.lstat(f)
+            except (IOError, os.error):
+                continue
+            self.__count += 1
+            self.__size += self.__get_size(st)
+            if stat.S_ISDIR(st.st_mode):
+                self.__count_dir(f)
+
+    def __count_entries(self):
+        try:
+            for f, size, isdir in self.__top:
+                self.__count += 1
+                self.__size += size
+                if isdir:
+                    self.__count_dir(f)
+                if self.__stop:
+                    return
+        except (UnicodeError, IOError, os.error):
+            return # it will be found while walking
+        self.complete = True
+
+    def count(self):
+        """start counting the entries in background, if not yet"""
+        if self.__counter is None:
+            self.__counter = threading.Thread(target=self.__count_entries)
+            self.__counter.setDaemon(True)
+            self.__counter.start()
+
+    def stop(self):
+        """stop counting"""
+        self.__stop = True
+
+    def set_dest(self, dest):
+        """entries are going to be copied to dest, don't walk what is
+        created there in case it's inside the paths walked"""
+        dest = os.path.normpath(dest)
+        if os.path.isdir(dest):
+            for f, size, isdir in self.__top:
+                self.prune.add(os.path.join(dest, os.path.basename(f)))
+        else:
+            self.prune.add(dest)
 
     def __repr__(self):
         return u'PathContents[Base:"%s" with %d entries (Total: %d items, %.2f KB)]' % \
             (self.basepath, self.length, self.tlength, self.tsize/1024)
 
     @property
-    def entries(self, reverse=False):
-        return sorted(self.__entries, reverse=reverse)
+    def tlength(self):
+        """number of entries, only those counted yet if not complete"""
+        if self.__record_done:
+            return max(self.__record_count - self.__removed_count, 0)
+        return max(self.__count - self.__removed_count, 0)
+
+    @property
+    def tsize(self):
+        if self.__record_done:
+            return max(self.__record_size - self.__removed_size, 1)
+        return max(self.__size - self.__removed_size, 1)
+
+    @property
+    def entries(self):
+        return list(self.iter_walk())
 
     @property
     def errors(self):
-        return sorted(self.__errors)
+        """errors found, in the order they were"""
+        return self.__errors[:]
+
+    def record(self):
+        """remember the entries yielded by next walk, the walks after it
+        go through them only. So a move deletes what has been copied, not
+        what is found in the directories when deleting"""
+        self.__record = {}
+
+    def __iter_recording(self, walk):
+        for f, size in walk:
+            self.__record_count += 1
+            self.__record_size += size
+            yield f, size
+        self.__record_done = self.complete = True
+        self.stop()
+
+    def __walk_record(self, path, reverse=False, onerror=None):
+        """as __walk, but through the directories recorded"""
+        if path not in self.__record:
+            return
+        names, sizes, dirs = self.__record[path]
+        for i, name in enumerate(names):
+            if sizes[i] < 0:
+                continue
+            f = os.path.join(path, name)
+            if not reverse and f not in self.__removed:
+                yield f, int(sizes[i])
+        for i, name in enumerate(names):
+            if sizes[i] < 0:
+                continue
+            f = os.path.join(path, name)
+            if dirs[i]:
+                for e in self.__walk_record(f, reverse):
+                    yield e
+            if reverse and f not in self.__removed:
+                yield f, int(sizes[i])
 
     def iter_walk(self, reverse=False):
-        for e in sorted(self.__entries, reverse=reverse):
-            yield e
+        """yield (path, size) of all the entries, parents before children
+        or children before parents if reverse. Errors found are added to
+        errors, UnicodeError is raised if a name has invalid encoding.
+        If record() was called, the first walk is recorded and the next
+        ones go through the entries recorded, none if it didn't finish"""
+        if self.__record is None:
+            return self.__iter_walk(self.__walk, reverse)
+        elif self.__record_started:
+            if not self.__record_done:
+                return iter([])
+            return self.__iter_walk(self.__walk_record, reverse)
+        self.__record_started = True
+        return self.__iter_recording(self.__iter_walk(self.__walk, reverse))
+
+    def __iter_walk(self, walk, reverse=False):
+        onerror = self.__errors.append
+        for f, size, isdir in (reverse and self.__top[::-1] or self.__top):
+            if isdir and reverse:
+                for e in walk(f, reverse, onerror):
+                    yield e
+            if f not in self.__removed:
+                yield f, size
+            if isdir and not reverse:
+                for e in walk(f, reverse, onerror):
+                    yield e
+
+    def __get_walked_size(self, f):
+        """return the size of f as it was walked, None if unknown"""
+        if f in self.__top_sizes:
+            return self.__top_sizes[f]
+        path, name = os.path.split(f)
+        if self.__record is None or path not in self.__record:
+            return None
+        names, sizes, dirs = self.__record[path]
+        i = bisect.bisect_left(names, name)
+        if i < len(sizes) and names[i] == name and sizes[i] >= 0:
+            return int(sizes[i])
+        return None
 
     def remove_files(self, fs):
-        new = []
-        length = self.length
-        for f, s in self.__entries:
-            if f in fs:
-                length -= 1
-            else:
-                new.append((f, s))
-        self.__entries = new
-        self.length = (length > 0) and length or 0
-        self.tlength = len(self.__entries)
-        self.tsize = sum([f[1] for f in self.__entries]) or 1
-
+        """don't yield the entries in fs, the contents of directories are
+        still walked. Entries are taken from the totals, those not counted
+        yet will be. Sizes are those of the walk recorded, entries which
+        weren't recorded are lstat'ed"""
+        for f in fs:
+            if f in self.__removed:
+                continue
+            self.__removed.add(f)
+            if f in self.__top_sizes:
+                self.length -= 1
+            size = self.__get_walked_size(f)
+            if size is None:
+                try:
+                    size = self.__get_size(os.lstat(f))
+                except (IOError, os.error):
+                    size = 0
+            self.__removed_count += 1
+            self.__removed_size += size
+        self.length = max(self.length, 0)
 
 ########################################################################
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""inotify.py
+
+This module watches the directories shown in the tabs using linux inotify,
+so they can be updated with the changes instead of reading them again.
+"""
+
+
+import os
+import sys
+import struct
+import time
+import errno
+
+
+######################################################################
+##### constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 02000000
+IN_NONBLOCK = 04000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | \
+    IN_ONLYDIR
+RESCAN_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+DEBOUNCE_TIME = 0.1   # wait for this quiet time before applying changes...
+DEBOUNCE_MAX = 1.0    # ... but don't wait more than this in a burst
+
+
+######################################################################
+##### libc
+try:
+    if not sys.platform.startswith('linux'):
+        raise ImportError
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.argtypes = [ctypes.c_int]
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    _inotify_rm_watch = _libc.inotify_rm_watch
+    _inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+
+######################################################################
+##### Watcher
+class Watcher(object):
+    """Watch the directories of a set of tabs. Changed file names are
+    accumulated in tab.changes, and tab.rescan is set to True if the
+    listing can't be trusted anymore (queue overflow, dir removed...)"""
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fs_encoding = sys.getfilesystemencoding() or 'utf-8'
+        self.wds = {}       # path -> wd
+        self.tabs = {}      # wd -> [tab, ...]
+        self.first_event = self.last_event = 0
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+        self.wds, self.tabs = {}, {}
+
+    def watch(self, tab, path):
+        """start watching path for tab, stop watching its old path.
+        Return True if tab will be kept up to date"""
+        self.unwatch(tab)
+        tab.changes = set()
+        tab.rescan = False
+        bpath = path.encode(self.fs_encoding) if isinstance(path, unicode) else path
+        wd = _inotify_add_watch(self.fd, bpath, WATCH_MASK)
+        if wd < 0: # f.e. ENOSPC: too many watches
+            return False
+        self.wds[path] = wd
+        self.tabs.setdefault(wd, []).append(tab)
+        tab.watched = path
+        return True
+
+    def unwatch(self, tab):
+        path = getattr(tab, 'watched', None)
+        tab.watched = None
+        if path is None or path not in self.wds:
+            return
+        wd = self.wds[path]
+        tabs = self.tabs.get(wd, [])
+        if tab in tabs:
+            tabs.remove(tab)
+        if not tabs:
+            _inotify_rm_watch(self.fd, wd)
+            self.tabs.pop(wd, None)
+            del self.wds[path]
+
+    def __forget_wd(self, wd):
+        for tab in self.tabs.pop(wd, []):
+            tab.rescan = True
+            tab.watched = None
+        for path, w in self.wds.items():
+            if w == wd:
+                del self.wds[path]
+
+    def read_events(self):
+        """read events in queue and store them in the tabs.
+        Return the number of events read"""
+        n = 0
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, (err, strerror):
+                if err in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not buf:
+                break
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, i)
+                i += EVENT_HEADER.size
+                name = buf[i:i+length].rstrip('\0')
+                i += length
+                n += 1
+                if mask & IN_Q_OVERFLOW:
+                    for tabs in self.tabs.values():
+                        for tab in tabs:
+                            tab.rescan = True
+                    continue
+                if mask & RESCAN_MASK:
+                    self.__forget_wd(wd)
+                    continue
+                tabs = self.tabs.get(wd)
+                if not tabs or not name:
+                    continue
+                try:
+                    name = name.decode(self.fs_encoding)
+                except UnicodeDecodeError:
+                    # invalid encoding, let the full listing deal with it
+                    for tab in tabs:
+                        tab.rescan = True
+                    continue
+                for tab in tabs:
+                    tab.changes.add(name)
+        if n:
+            now = time.time()
+            if not self.first_event:
+                self.first_event = now
+            self.last_event = now
+        return n
+
+    def is_ready(self):
+        """debounce: True if there are events and they have stopped coming
+        for a while, or the burst is too long"""
+        if not self.first_event:
+            return False
+        now = time.time()
+        if now-self.last_event > DEBOUNCE_TIME or \
+                now-self.first_event > DEBOUNCE_MAX:
+            self.first_event = self.last_event = 0
+            return True
+        return False
+
+    def get_delay(self):
+        """seconds until is_ready could return True, None if no events"""
+        if not self.first_event:
+            return None
+        return max(min(self.last_event+DEBOUNCE_TIME,
+                       self.first_event+DEBOUNCE_MAX) - time.time(), 0)
+
+
+######################################################################
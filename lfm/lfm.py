@@ -47,6 +47,7 @@ import os, os.path
 import sys
 import time
 import datetime
+import itertools
 import getopt
 import logging
 import curses
@@ -61,12 +62,23 @@ import utils
 import vfs
 import messages
 import pyview
+import inotify
+import eventloop
 
 
 ######################################################################
 ##### Global variables
 LOG_FILE = os.path.join(os.getcwd(), 'lfm.log')
 MAX_TAB_HISTORY = 15
+BACKGROUND_LISTING_DELAY = 0.1  # read directory before showing it partially
+FRAME_TIME = 1.0/60             # max. screen updates rate when moving
+RESIZE_DELAY = 0.05             # wait for the end of a resize events burst
+QUIT_READERS_TIMEOUT = 2.0      # wait for background listings when quitting
+ROWS_CACHE_SIZE = 4096          # formatted rows kept per pane
+FILES_EXT_COLORS = { 'temp_files': 13, 'document_files': 14,
+                     'media_files': 15, 'archive_files': 16,
+                     'source_files': 17, 'graphics_files': 18,
+                     'data_files': 19 }
 
 
 ######################################################################
@@ -77,6 +89,17 @@ class Lfm(object):
     def __init__(self, win, prefs):
         self.win = win              # root window, needed for resizing
         self.prefs = prefs          # preferences
+        self.loading_display_time = 0
+        self.frame_time = 0         # last time the cursor movement was shown
+        self.loop = eventloop.EventLoop()   # waits for keys, events...
+        self.loop.add_reader(sys.stdin.fileno(), lambda: None) # keys
+        self.changes_timer = None
+        self.resize_timer = None
+        try:
+            self.watcher = inotify.Watcher()  # keeps tabs up to date
+            self.loop.add_reader(self.watcher.fileno(), self.watch_changes)
+        except OSError:
+            self.watcher = None
         self.init_ui()
         self.statusbar = StatusBar(self.maxh, self)   # statusbar
         self.cli = PowerCLI(self.maxh, self)          # powercli
@@ -137,8 +160,10 @@ class Lfm(object):
                 curses.init_pair(i+1, color_fg, color_bg)
 
 
-    def resize(self):
-        """resize windows"""
+    def resize(self, debounce=False):
+        """resize windows. Only the layout changes, directories are not
+        read again. If debounce, the screen is updated when the resize
+        events stop coming for a while"""
 
         h, w = self.win.getmaxyx()
         self.maxh, self.maxw = h, w
@@ -149,40 +174,125 @@ class Lfm(object):
         self.rpane.do_resize(h, w)
         self.statusbar.do_resize(h, w)
         self.cli.do_resize(h, w)
-        self.regenerate()
+        if self.resize_timer:
+            self.loop.cancel(self.resize_timer)
+            self.resize_timer = None
+        if debounce:
+            self.resize_timer = self.loop.call_later(RESIZE_DELAY,
+                                                     self.display_resized)
+        else:
+            self.display()
+
+
+    def display_resized(self):
+        self.resize_timer = None
         self.display()
 
 
     def display(self):
         """display/update both panes and status bar or powercli"""
 
-        self.lpane.display()
-        self.rpane.display()
+        self.lpane.display(update=False)
+        self.rpane.display(update=False)
         if self.cli.visible:
             self.cli.display()
         else:
-            self.statusbar.display()
+            self.statusbar.display(update=False)
+        curses.doupdate()
 
 
     def half_display(self):
         """display/update only active pane and status bar"""
 
-        self.act_pane.display()
+        self.act_pane.display(update=False)
         self.statusbar.display()
 
 
     def half_display_other(self):
         """display/update only non-active pane and status bar"""
 
-        self.noact_pane.display()
+        self.noact_pane.display(update=False)
         self.statusbar.display()
 
 
-    def regenerate(self):
+    def regenerate(self, force=False):
         """Rebuild panes' directories"""
 
-        self.lpane.regenerate()
-        self.rpane.regenerate()
+        if self.watcher:
+            self.watcher.read_events()
+        files.forget_dir_snapshots()
+        self.lpane.regenerate(force)
+        self.rpane.regenerate(force)
+
+
+    def resort(self):
+        """sort all tabs again after the sorting options have changed"""
+
+        for tab in self.lpane.tabs + self.rpane.tabs:
+            tab.resort()
+
+
+    def check_changes(self):
+        """update the tabs whose directories have changed.
+        Return True if some tab has been updated"""
+
+        if self.watcher is None:
+            return False
+        self.watcher.read_events()
+        if not self.watcher.is_ready():
+            return False
+        updated = False
+        tabs = self.lpane.tabs + self.rpane.tabs
+        if [tab for tab in tabs if tab.rescan]:
+            files.forget_dir_snapshots()
+        for tab in tabs:
+            # changes in loading tabs are applied when it finishes
+            if tab.reader is None and (tab.changes or tab.rescan):
+                tab.backup()
+                tab.regenerate()
+                tab.fix_limits()
+                tab.restore()
+                updated = True
+        return updated
+
+
+    def watch_changes(self):
+        """inotify events are ready to read or debounce time has passed"""
+
+        if self.changes_timer:
+            self.loop.cancel(self.changes_timer)
+            self.changes_timer = None
+        if self.check_changes():
+            self.display()
+        delay = self.watcher.get_delay()
+        if delay is not None:
+            self.changes_timer = self.loop.call_later(delay,
+                                                      self.watch_changes)
+
+
+    def do_background(self):
+        """add files read in background to their tabs, or load a bit more
+        of the files pending to stat in any tab.
+        Return True if there was something to do"""
+
+        tabs = self.lpane.tabs + self.rpane.tabs
+        loading = [tab for tab in tabs if tab.reader is not None]
+        if loading:
+            updated = False
+            for tab in loading:
+                if tab.load_chunks():
+                    updated = True
+            # don't redraw for every chunk, they come too fast
+            if updated and (time.time()-self.loading_display_time > 0.2 or
+                            not [tab for tab in tabs if tab.reader]):
+                self.display()
+                self.loading_display_time = time.time()
+            return updated
+        for tab in tabs:
+            if tab.pending:
+                tab.load_pending(maxtime=0.02)
+                return True
+        return False
 
 
     def quit_program(self, icode):
@@ -195,6 +305,19 @@ class Lfm(object):
             self.prefs.save()
         if self.prefs.options['save_history_at_exit']:
             pickle.dump(messages.history, file(messages.HISTORY_FILE, 'w'), -1)
+        # background readers must end before the interpreter is torn down
+        readers = [tab.reader for tab in self.lpane.tabs + self.rpane.tabs
+                   if tab.reader]
+        for reader in readers:
+            reader.stop()
+        t0 = time.time()
+        for reader in readers:
+            reader.wait(max(0, QUIT_READERS_TIMEOUT - (time.time()-t0)))
+        if self.watcher:
+            self.loop.remove_reader(self.watcher.fileno())
+            self.watcher.close()
+            self.watcher = None
+        self.loop.close()
         if icode == -1: # change directory
             return self.act_pane.act_tab.path
         else:           # exit, but don't change directory
@@ -227,6 +350,10 @@ class Lfm(object):
                 idx = self.act_pane.tabs.index(tab)
                 self.act_pane.act_tab = self.act_pane.tabs[idx-1]
                 self.act_pane.tabs.remove(tab)
+                if tab.reader:
+                    tab.reader.stop()
+                if self.watcher:
+                    self.watcher.unwatch(tab)
                 del tab
 
 
@@ -251,7 +378,7 @@ class StatusBar(object):
         self.win.mvwin(h-1, 0)
 
 
-    def display(self):
+    def display(self, update=True):
         """show status bar"""
 
         self.win.erase()
@@ -259,6 +386,7 @@ class StatusBar(object):
         maxw = self.app.maxw
         if len(adir.selections) > 0:
             if maxw >= 45:
+                adir.load_pending(adir.selections)
                 size = 0
                 for f in adir.selections:
                     size += adir.files[f][files.FT_SIZE]
@@ -275,15 +403,29 @@ class StatusBar(object):
                 else:
                     realpath = files.get_realpath(adir.path, filename,
                                                   adir.files[filename][files.FT_TYPE])
-                path = (len(realpath)>maxw-35) and \
-                    '~' + realpath[-(maxw-37):] or realpath
+                if adir.reader:
+                    # still reading the directory in background
+                    buf = 'Loading %d entries...' % len(adir.files)
+                    self.win.addstr(0, maxw-10-len(buf), buf, curses.A_BOLD)
+                    pw = maxw - 37 - len(buf)
+                elif adir.pending:
+                    # still loading files information in background
+                    nfiles = len(adir.files)
+                    done = 100 * (nfiles-len(adir.pending)) / nfiles
+                    self.win.addstr(0, maxw-16, '[%3d%%]' % done, curses.A_BOLD)
+                    pw = maxw - 43
+                else:
+                    pw = maxw - 35
+                path = (len(realpath)>pw) and '~' + realpath[-(pw-2):] or realpath
                 self.win.addstr(0, 20, 'Path: ' + utils.encode(path))
         if maxw > 10:
             try:
                 self.win.addstr(0, maxw-8, 'F1=Help')
             except:
                 pass
-        self.win.refresh()
+        self.win.noutrefresh()
+        if update:
+            curses.doupdate()
 
 
 ######################################################################
@@ -501,7 +643,7 @@ class PowerCLI(object):
                     if messages.confirm('Error running PowerCLI',
                                         'Do you want to stop now?') == 1:
                         break
-            tab.selections = []
+            tab.selections.clear()
         else:
             try:
                 cmd = self.__replace_cli(cmd_orig, tab, selected)
@@ -548,7 +690,10 @@ class Pane(object):
         self.win.keypad(1)
         if curses.has_colors():
             self.win.bkgd(curses.color_pair(2))
+        self.tabs_pad = curses.newpad(1, self.dims[1]+1)
+        self.tabs_pad.bkgd(curses.color_pair(12))
         self.__calculate_columns()
+        self.invalidate()
 
 
     def __calculate_dims(self):
@@ -576,30 +721,55 @@ class Pane(object):
         self.win.resize(self.dims[0], self.dims[1])
         self.win.mvwin(self.dims[2], self.dims[3])
         self.__calculate_columns()
+        self.win.erase()
+        self.tabs_pad = curses.newpad(1, self.dims[1]+1)
+        self.tabs_pad.bkgd(curses.color_pair(12))
+        self.invalidate()
         for tab in self.tabs:
             tab.fix_limits()
 
 
-    def display(self):
-        """display pane"""
+    def invalidate(self):
+        """forget what has been drawn, next display draws everything"""
+
+        self.rows_cache = {}
+        self.drawn_tabs = None
+        self.drawn_header = None
+        self.drawn_rows = {}        # row -> (buf, attr, fill_attr, sep_attr)
+        self.drawn_origin = None    # (tab, file_a) of drawn_rows
+        self.drawn_scrollbar = None
+
+
+    def display(self, update=True):
+        """display pane. Only the parts which have changed since last
+        time are drawn, and the screen is updated at once by doupdate.
+        Use update=False to draw more windows before updating"""
 
         if self.mode == PANE_MODE_HIDDEN:
             return
         if self.maxw < 65:
             return
+        tab = self.act_tab
+        if tab.pending:
+            tab.load_pending(tab.sorted[tab.file_a:tab.file_z+1])
         self.display_tabs()
+        self.display_header()
         self.display_files()
-        self.display_cursorbar()
+        self.display_scrollbar()
+        # what is on screen could have been overwritten by other windows,
+        # touch all so doupdate compares it with what the terminal shows,
+        # it only sends the differences
+        self.win.touchwin()
+        self.win.noutrefresh()
+        if update:
+            curses.doupdate()
 
 
     def display_tabs(self):
-        tabs = curses.newpad(1, self.dims[1]+1)
-        tabs.bkgd(curses.color_pair(12))
-        tabs.erase()
         w = self.dims[1] / 4
         if w < 10:
             w = 5
-        tabs.addstr(('[' + ' '*(w-2) + ']') * len(self.tabs))
+        labels = []
         for i, tab in enumerate(self.tabs):
             if w < 10:
                 path = '[ %d ]' % (i+1, )
@@ -612,99 +782,170 @@ class Pane(object):
                     path = '[%s~]' % path[:w-3]
                 else:
                     path = '[' + path + ' ' * (w-2-len(path)) + ']'
-            attr = (tab==self.act_tab) and curses.color_pair(10) or curses.color_pair(1)
-            tabs.addstr(0, i*w, utils.encode(path), attr)
-        tabs.refresh(0, 0, 0, self.dims[3],  1, self.dims[3]+self.dims[1]-1)
-
+            labels.append((path, tab==self.act_tab))
+        tabs = self.tabs_pad
+        if labels != self.drawn_tabs:
+            self.drawn_tabs = labels
+            tabs.erase()
+            tabs.addstr(('[' + ' '*(w-2) + ']') * len(self.tabs))
+            for i, (path, active) in enumerate(labels):
+                attr = active and curses.color_pair(10) or curses.color_pair(1)
+                tabs.addstr(0, i*w, utils.encode(path), attr)
+        tabs.touchwin()
+        tabs.noutrefresh(0, 0, 0, self.dims[3], 0, self.dims[3]+self.dims[1]-1)
+
+
+    def display_header(self):
+        if self.mode == PANE_MODE_FULL:
+            return
+        tab = self.act_tab
+        w = self.dims[1]
+        path = tab.vfs and vfs.join(tab) or tab.path
+        if tab.filter is not None:
+            path = u'%s [%s%s]' % (path, tab.filter.fuzzy and '~' or '',
+                                   tab.filter.text)
+        path = (len(path)>w-5) and '~' + path[-w+5:] or path
+        header = (path, self == self.app.act_pane)
+        if header == self.drawn_header:
+            return
+        self.drawn_header = header
+        if header[1]:
+            self.win.attrset(curses.color_pair(5))
+            attr = curses.color_pair(6) | curses.A_BOLD
+        else:
+            self.win.attrset(curses.color_pair(2))
+            attr = curses.color_pair(2)
+        self.win.box()
+        self.win.addstr(0, 2, utils.encode(path), attr)
+        self.win.addstr(1, 1, ' ' * (w-2), curses.color_pair(2))
+        self.win.addstr(1, 1,
+                        'Name'.center(self.pos_col1-2)[:self.pos_col1-2],
+                        curses.color_pair(2) | curses.A_BOLD)
+        self.win.addstr(1, self.pos_col1+2, 'Size',
+                        curses.color_pair(2) | curses.A_BOLD)
+        self.win.addstr(1, self.pos_col2+5, 'Date',
+                        curses.color_pair(2) | curses.A_BOLD)
+        self.win.addch(1, self.pos_col1, curses.ACS_VLINE)
+        self.win.addch(1, self.pos_col2, curses.ACS_VLINE)
+        # the box has been drawn over the rows separators and scrollbar
+        self.drawn_rows = {}
+        self.drawn_scrollbar = None
+
+
+    def __get_cursor_attrs(self):
+        """return the cursor bar attributes (not selected, selected),
+        or None if it is not shown"""
 
-    def get_filetypecolorpair(self, f, typ):
-        if typ == files.FTYPE_DIR:
-            return curses.color_pair(22)
-        elif typ == files.FTYPE_EXE:
-            return curses.color_pair(23)  | curses.A_BOLD
-        ext = os.path.splitext(f)[1].lower()
-        files_ext = self.app.prefs.files_ext
-        if ext in files_ext['temp_files']:
-            return curses.color_pair(13)
-        elif ext in files_ext['document_files']:
-            return curses.color_pair(14)
-        elif ext in files_ext['media_files']:
-            return curses.color_pair(15)
-        elif ext in files_ext['archive_files']:
-            return curses.color_pair(16)
-        elif ext in files_ext['source_files']:
-            return curses.color_pair(17)
-        elif ext in files_ext['graphics_files']:
-            return curses.color_pair(18)
-        elif ext in files_ext['data_files']:
-            return curses.color_pair(19)
+        if self == self.app.act_pane:
+            return (curses.color_pair(3),
+                    curses.color_pair(11) | curses.A_BOLD)
+        elif self.app.prefs.options['manage_otherpane']:
+            return (curses.color_pair(20), curses.color_pair(21))
         else:
-            return curses.color_pair(2)
+            return None
 
 
     def display_files(self):
         tab = self.act_tab
-        self.win.erase()
-
-        # calculate pane width, height and vertical start position
         w = self.dims[1]
         if self.mode != PANE_MODE_FULL:
-            h, y = self.maxh-5, 2
+            h, y, x, width = self.dims[0]-3, 2, 1, w-2
+            sep_attr = self.drawn_header[1] and curses.color_pair(5) or \
+                curses.color_pair(2)
         else:
-            h, y = self.maxh-2, 0
-
-        # headers
+            h, y, x, width = self.dims[0], 0, 0, w-1
+            sep_attr = None
+        cursor_attrs = self.__get_cursor_attrs()
+        low_bandwidth = self.app.prefs.options['low_bandwidth']
+        color_files = self.app.prefs.options['color_files'] and \
+            not low_bandwidth
+        if low_bandwidth:
+            self.scroll_files(tab, h, y, sep_attr)
+        self.drawn_origin = (tab, tab.file_a)
+        blank = ' ' * width
+        for i in xrange(h):
+            buf, fill, sep = '', curses.color_pair(2), sep_attr
+            attr = fill
+            j = tab.file_a + i
+            if j <= tab.file_z:
+                filename = tab.sorted[j]
+                buf, color = self.get_row(tab, filename)
+                # get file color
+                selected = filename in tab.selections
+                if j == tab.file_i and cursor_attrs is not None:
+                    attr = fill = sep = cursor_attrs[selected]
+                elif selected:
+                    attr = curses.color_pair(10) | curses.A_BOLD
+                elif color_files:
+                    attr = color
+            row = (buf, attr, fill, sep)
+            if self.drawn_rows.get(i) == row:
+                continue
+            self.drawn_rows[i] = row
+            buf, attr, fill, sep = row
+            self.win.addstr(y+i, x, blank, fill)
+            self.win.addstr(y+i, x, buf, attr)
+            if self.mode != PANE_MODE_FULL:
+                # vertical separators
+                self.win.addch(y+i, self.pos_col1, curses.ACS_VLINE, sep)
+                self.win.addch(y+i, self.pos_col2, curses.ACS_VLINE, sep)
+
+
+    def scroll_files(self, tab, h, y, sep_attr):
+        """if the rows drawn are still visible but in other place, scroll
+        them instead of drawing them again. Terminals can do it with
+        little output if the window is as wide as the screen"""
+
+        if not self.drawn_rows or self.drawn_origin is None or \
+                self.drawn_origin[0] != tab:
+            return
+        delta = tab.file_a - self.drawn_origin[1]
+        if delta == 0 or abs(delta) >= h:
+            return
+        self.win.idlok(1)
+        self.win.setscrreg(y, y+h-1)
+        self.win.scrollok(1)
+        self.win.scroll(delta)
+        self.win.scrollok(0)
+        self.win.setscrreg(0, self.dims[0]-1)
+        self.drawn_rows = dict([(i-delta, row)
+                                for i, row in self.drawn_rows.items()
+                                if 0 <= i-delta < h])
         if self.mode != PANE_MODE_FULL:
-            if self == self.app.act_pane:
-                self.win.attrset(curses.color_pair(5))
-                attr = curses.color_pair(6) | curses.A_BOLD
-            else:
-                self.win.attrset(curses.color_pair(2))
-                attr = curses.color_pair(2)
-            path = tab.vfs and vfs.join(tab) or tab.path
-            path = (len(path)>w-5) and '~' + path[-w+5:] or path
-            self.win.box()
-            self.win.addstr(0, 2, utils.encode(path), attr)
-            self.win.addstr(1, 1,
-                            'Name'.center(self.pos_col1-2)[:self.pos_col1-2],
-                            curses.color_pair(2) | curses.A_BOLD)
-            self.win.addstr(1, self.pos_col1+2, 'Size',
-                            curses.color_pair(2) | curses.A_BOLD)
-            self.win.addstr(1, self.pos_col2+5, 'Date',
-                            curses.color_pair(2) | curses.A_BOLD)
-        else:
-            if tab.nfiles > h:
-                self.win.vline(0, w-1, curses.ACS_VLINE, h)
-
-        # files
-        for i in xrange(tab.file_z - tab.file_a + 1):
-            filename = tab.sorted[i+tab.file_a]
-            # get file info
-            res = files.get_fileinfo_dict(tab.path, filename,
-                                          tab.files[filename])
-            # get file color
-            if tab.selections.count(filename):
-                attr = curses.color_pair(10) | curses.A_BOLD
-            else:
-                if self.app.prefs.options['color_files']:
-                    attr = self.get_filetypecolorpair(filename, tab.files[filename][files.FT_TYPE])
-                else:
-                    attr = curses.color_pair(2)
-            # show
-            if self.mode == PANE_MODE_FULL:
-                buf = tab.get_fileinfo_str_long(res, w)
-                self.win.addstr(i, 0, utils.encode(buf), attr)
-            else:
-                buf = tab.get_fileinfo_str_short(res, w, self.pos_col1)
-                self.win.addstr(i+2, 1, utils.encode(buf), attr)
+            # the new rows are blank, borders too
+            w = self.dims[1]
+            for i in xrange(h):
+                if i not in self.drawn_rows:
+                    self.win.addch(y+i, 0, curses.ACS_VLINE, sep_attr)
+                    self.win.addch(y+i, w-1, curses.ACS_VLINE, sep_attr)
 
-        # vertical separators
-        if self.mode != PANE_MODE_FULL:
-            self.win.vline(1, self.pos_col1, curses.ACS_VLINE, self.dims[0]-2)
-            self.win.vline(1, self.pos_col2, curses.ACS_VLINE, self.dims[0]-2)
 
-        # vertical scroll bar
+    def display_scrollbar(self):
+        tab = self.act_tab
+        w = self.dims[1]
+        if self.mode != PANE_MODE_FULL:
+            h, y = self.dims[0]-3, 2
+        else:
+            h, y = self.dims[0], 0
+        if self.app.prefs.options['low_bandwidth']:
+            # no scrollbar, it would change with every movement
+            if self.drawn_scrollbar is not None:
+                self.drawn_scrollbar = None
+                self.win.vline(y, w-1, self.mode == PANE_MODE_FULL and ' ' or
+                               curses.ACS_VLINE, h)
+            return
         y0, n = self.__calculate_scrollbar_dims(h, tab.nfiles, tab.file_i)
+        scrollbar = (y0, n, tab.file_a != 0, tab.nfiles > tab.file_a + h,
+                     tab.nfiles > h)
+        if scrollbar == self.drawn_scrollbar:
+            return
+        self.drawn_scrollbar = scrollbar
+        if self.mode != PANE_MODE_FULL:
+            self.win.vline(y, w-1, curses.ACS_VLINE, h)
+        elif tab.nfiles > h:
+            self.win.vline(0, w-1, curses.ACS_VLINE, h)
+        else:
+            self.win.vline(0, w-1, ' ', h)
         self.win.vline(y+y0, w-1, curses.ACS_CKBOARD, n)
         if tab.file_a != 0:
             self.win.vline(y, w-1, '^', 1)
@@ -715,7 +956,38 @@ class Pane(object):
             if (n == 1) and (y0 == h-1):
                 self.win.vline(h+y-2, w-1, curses.ACS_CKBOARD, n)
 
-        self.win.refresh()
+
+    def get_filetypecolorpair(self, f, typ):
+        if typ == files.FTYPE_DIR:
+            return curses.color_pair(22)
+        elif typ == files.FTYPE_EXE:
+            return curses.color_pair(23)  | curses.A_BOLD
+        typ = self.app.prefs.get_files_ext_type(f)
+        return curses.color_pair(FILES_EXT_COLORS.get(typ, 2))
+
+
+    def get_row(self, tab, filename):
+        """return the encoded row for filename and its color. Rows are
+        cached by file information until the pane is invalidated (resized,
+        mode or preferences changed), so scrolling only formats and colors
+        the rows which appear"""
+
+        values = tab.files[filename]
+        key = (filename, values)
+        try:
+            return self.rows_cache[key]
+        except KeyError:
+            pass
+        res = files.get_fileinfo_dict(tab.path, filename, values)
+        if self.mode == PANE_MODE_FULL:
+            buf = tab.get_fileinfo_str_long(res, self.dims[1])
+        else:
+            buf = tab.get_fileinfo_str_short(res, self.dims[1], self.pos_col1)
+        if len(self.rows_cache) >= ROWS_CACHE_SIZE:
+            self.rows_cache = {}
+        color = self.get_filetypecolorpair(filename, values[files.FT_TYPE])
+        row = self.rows_cache[key] = (utils.encode(buf), color)
+        return row
 
 
     def __calculate_scrollbar_dims(self, h, nels, i):
@@ -729,79 +1001,70 @@ class Pane(object):
         return y0, n
 
 
-    def display_cursorbar(self):
-        if self == self.app.act_pane:
-            attr_noselected = curses.color_pair(3)
-            attr_selected = curses.color_pair(11) | curses.A_BOLD
-        else:
-            if self.app.prefs.options['manage_otherpane']:
-                attr_noselected = curses.color_pair(20)
-                attr_selected = curses.color_pair(21)
-            else:
-                return
-        if self.mode == PANE_MODE_FULL:
-            cursorbar = curses.newpad(1, self.maxw)
-        else:
-            cursorbar = curses.newpad(1, self.dims[1]-1)
-        cursorbar.bkgd(curses.color_pair(3))
-        cursorbar.erase()
-
-        tab = self.act_tab
-        filename = tab.sorted[tab.file_i]
-        try:
-            tab.selections.index(filename)
-        except ValueError:
-            attr = attr_noselected
-        else:
-            attr = attr_selected
-
-        res = files.get_fileinfo_dict(tab.path, filename, tab.files[filename])
-        if self.mode == PANE_MODE_FULL:
-            buf = tab.get_fileinfo_str_long(res, self.maxw)
-            cursorbar.addstr(0, 0, utils.encode(buf), attr)
-            cursorbar.refresh(0, 0,
-                              tab.file_i % self.dims[0] + 1, 0,
-                              tab.file_i % self.dims[0] + 1, self.maxw-2)
-        else:
-            buf = tab.get_fileinfo_str_short(res, self.dims[1], self.pos_col1)
-            cursorbar.addstr(0, 0, utils.encode(buf), attr)
-            cursorbar.addch(0, self.pos_col1-1, curses.ACS_VLINE, attr)
-            cursorbar.addch(0, self.pos_col2-1, curses.ACS_VLINE, attr)
-            row = tab.file_i % (self.dims[0]-3) + 3
-            if self.mode == PANE_MODE_LEFT:
-                cursorbar.refresh(0, 0,
-                                  row, 1, row, int(self.maxw/2)-2)
-            else:
-                cursorbar.refresh(0, 0,
-                                  row, int(self.maxw/2)+1, row, self.maxw-2)
-
-
-    def regenerate(self):
+    def regenerate(self, force=False):
         """Rebuild tabs' directories, this is needed because panel
         could be changed"""
 
         for tab in self.tabs:
             tab.backup()
-            tab.regenerate()
+            tab.regenerate(force)
             tab.fix_limits()
             tab.restore()
 
 
+    def do_movements(self, ch):
+        """apply movement key ch and the ones queued after it, waiting
+        for more of them until it's time to show the next frame.
+        Return what must be updated, as actions"""
+
+        rets = set()
+        while True:
+            rets.add(actions.do(self.act_tab, ch))
+            ch = self.win.getch()
+            if ch == -1:
+                wait = self.app.frame_time + FRAME_TIME - time.time()
+                if wait <= 0:
+                    break
+                self.app.loop.run_once(wait)
+                ch = self.win.getch()
+                if ch == -1:
+                    break
+            if not actions.is_movement(ch):
+                curses.ungetch(ch)
+                break
+        self.app.frame_time = time.time()
+        rets.discard(RET_NO_UPDATE)
+        if len(rets) > 1:
+            return None
+        return rets and rets.pop() or RET_NO_UPDATE
+
+
     def manage_keys(self):
         self.win.nodelay(1)
         while True:
             ch = self.win.getch()
             if ch == -1:       # no key pressed
-                # curses.napms(1)
-                time.sleep(0.05)
+                if self.app.do_background():
+                    # there is more to do, don't wait
+                    self.app.statusbar.display()
+                    self.app.loop.run_once(0)
+                    continue
+                if self.app.watcher:
+                    # events could have been read while regenerating
+                    self.app.watch_changes()
                 curses.doupdate()
+                # wait for a key, a directory change, a timer...
+                self.app.loop.run_once()
                 continue
             # print 'key: \'%s\' <=> %c <=> 0x%X <=> %d' % \
             #       (curses.keyname(ch), ch & 255, ch, ch)
             # messages.win('Keyboard hitted:',
             #              'key: \'%s\' <=> %c <=> 0x%X <=> %d' % \
             #              (curses.keyname(ch), ch & 255, ch, ch))
-            ret = actions.do(self.act_tab, ch)
+            if actions.is_movement(ch):
+                ret = self.do_movements(ch)
+            else:
+                ret = actions.do(self.act_tab, ch)
             if ret is None:
                 self.app.display()
             elif ret == RET_NO_UPDATE:
@@ -822,9 +1085,21 @@ class Vfs(object):
     def __init__(self):
         self.path = ''
         self.nfiles = 0
+        self.snapshot = None   # files information, shared with other tabs
+        self.serial = 0        # snapshot changes already applied
+        self.reader = None     # DirReader if directory is still being read
+        self.wanted_file = None # file to put cursor on when read
         self.files = []
-        self.sorted = []
-        self.selections = []
+        self.pending = set()   # files not stat'ed yet
+        self.sorted = []       # files shown, sorted
+        self.filter = None     # NameFilter, if not all files are shown
+        self.selections = files.Selections()
+        self.listing_opts = None
+        self.file_i = self.file_a = self.file_z = 0
+        # inotify
+        self.watched = None    # path watched for changes
+        self.changes = set()   # files changed since last update
+        self.rescan = False    # changes lost, full read needed
         self.sort_mode = 0
         # vfs variables
         self.vfs = ''          # vfs? if not -> blank string
@@ -836,18 +1111,60 @@ class Vfs(object):
 
     def init_dir(self, path):
         old_path = self.path if self.path and not self.vfs else ''
+        app = self.pane.app
         try:
-            app = self.pane.app
-            self.nfiles, self.files = files.get_dir(path, app.prefs.options['show_dotfiles'])
+            if app.watcher:
+                # watch before reading so no change is lost
+                app.watcher.watch(self, os.path.abspath(path))
+            show_dotfiles = app.prefs.options['show_dotfiles']
             sortmode = app.prefs.options['sort']
             sort_mix_dirs = app.prefs.options['sort_mix_dirs']
             sort_mix_cases = app.prefs.options['sort_mix_cases']
+            lazy_threshold = app.prefs.options['lazy_listing_threshold']
+            namesort = sortmode in files.SORTTYPES_BYNAME
+            # if sorted by name, stat only what we need to sort, the rest
+            # when shown or in background
+            snapshot = files.get_shared_dir_snapshot(path, show_dotfiles)
+            reader = None
+            if snapshot is None and app.prefs.options['background_listing']:
+                snapshot = files.new_dir_snapshot(path, show_dotfiles)
+                reader = files.DirReader(snapshot.path, show_dotfiles,
+                                         namesort and lazy_threshold > 0,
+                                         app.loop.post)
+                if reader.wait(BACKGROUND_LISTING_DELAY):
+                    if reader.error:
+                        raise OSError(reader.error[1], reader.error[0])
+                    snapshot.add_chunks(reader.get_chunks())
+                    files.share_dir_snapshot(snapshot)
+                    reader = None
+                else:
+                    # show what has been read, the rest will come later
+                    snapshot.add_chunks(reader.get_chunks())
+            elif snapshot is None:
+                snapshot = files.get_dir_snapshot(path, show_dotfiles,
+                                                  namesort and lazy_threshold)
+            if self.reader:
+                self.reader.stop()
+            self.reader = reader
+            self.wanted_file = None
+            self.snapshot = snapshot
+            self.serial = self.snapshot.serial
+            self.files = self.snapshot.files
+            self.pending = self.snapshot.pending
+            self.nfiles = len(self.files)
+            if self.pending and reader is None and \
+                    (not namesort or self.nfiles <= lazy_threshold):
+                self.load_pending()
+            self.filter = None
             self.sorted = files.sort_dir(self.files, sortmode,
                                          sort_mix_dirs, sort_mix_cases)
             self.sort_mode = sortmode
+            self.listing_opts = self.get_listing_opts()
             self.path = os.path.abspath(path)
-            self.selections = []
+            self.selections = files.Selections()
         except (IOError, OSError), (errno, strerror):
+            if app.watcher:
+                self.rescan = True # old listing is not watched anymore
             if len(self.history) > 0:
                 self.history.pop()
             return (strerror, errno)
@@ -867,6 +1184,231 @@ class Vfs(object):
         raise NotImplementedError
 
 
+    def get_listing_opts(self):
+        options = self.pane.app.prefs.options
+        return (options['show_dotfiles'], options['sort'],
+                options['sort_mix_dirs'], options['sort_mix_cases'])
+
+
+    def is_uptodate(self):
+        """True if changes in directory are being tracked by inotify and
+        the listing can be updated from them"""
+
+        return self.watched == self.path and not self.rescan and \
+            self.listing_opts == self.get_listing_opts()
+
+
+    def update_files(self, fs):
+        """update the information of fs files in the snapshot, and apply
+        its changes (also those made by other tabs) to the listing"""
+
+        self.snapshot.update(fs)
+        changes = self.snapshot.get_changes(self.serial)
+        self.serial = self.snapshot.serial
+        show_dotfiles, sortmode, sort_mix_dirs, sort_mix_cases = self.listing_opts
+        if changes is None:
+            # too many changes to replay, sort again
+            self.set_sorted(files.sort_dir(self.files, sortmode,
+                                           sort_mix_dirs, sort_mix_cases))
+            self.selections.intersection_update(self.files)
+            return
+        allsorted = self.get_all_sorted()
+        resort = sortmode not in files.SORTTYPES_BYNAME
+        dirtypes = (files.FTYPE_DIR, files.FTYPE_LNK2DIR)
+        changed = {}
+        for f, old, new in changes:
+            changed[f] = (changed.get(f, (old, ))[0], new)
+        # remove all the moved files first, so the rest remains sorted
+        # with the current values while inserting
+        toinsert = []
+        for f, (old, new) in changed.iteritems():
+            if old is not None:
+                if new is not None and not resort and \
+                        (old[files.FT_TYPE] in dirtypes) == \
+                        (new[files.FT_TYPE] in dirtypes):
+                    continue
+                allsorted.remove(f)
+                if self.filter is not None and f in self.sorted:
+                    self.sorted.remove(f)
+                if new is None:
+                    self.selections.discard(f)
+            if new is not None:
+                toinsert.append(f)
+        for f in toinsert:
+            files.insert_sorted(allsorted, self.files, f,
+                                sortmode, sort_mix_dirs, sort_mix_cases)
+        if self.filter is not None:
+            self.filter.names_changed()
+            for f in self.filter.filter_names(toinsert):
+                files.insert_sorted(self.sorted, self.files, f,
+                                    sortmode, sort_mix_dirs, sort_mix_cases)
+            if not self.sorted:
+                self.set_filter(u'')
+        self.nfiles = len(self.sorted)
+
+
+    def load_chunks(self):
+        """add the files read in background to the listing, at the end
+        until the reading finishes and everything is sorted.
+        Return True if there was something new"""
+
+        reader = self.reader
+        done = reader.done
+        new = self.snapshot.add_chunks(reader.get_chunks())
+        if self.filter is not None:
+            self.filter.names.extend(new)
+            new = self.filter.extend(new)
+        self.sorted.extend(new)
+        self.nfiles = len(self.sorted)
+        if self.wanted_file is not None:
+            if self.file_i != 0:  # user has moved
+                self.wanted_file = None
+            elif self.wanted_file in self.files:
+                self.file_i = self.sorted.index(self.wanted_file)
+                self.wanted_file = None
+        if done:
+            self.finish_loading()
+        else:
+            self.fix_limits()
+        return bool(new) or done
+
+
+    def finish_loading(self, stopped=False):
+        """sort the files when the reading in background finishes"""
+
+        reader, self.reader = self.reader, None
+        self.wanted_file = None
+        if stopped:
+            reader.stop()
+            self.snapshot.add_chunks(reader.get_chunks())
+        filename_old = self.sorted[self.file_i]
+        show_dotfiles, sortmode, sort_mix_dirs, sort_mix_cases = self.listing_opts
+        if self.pending and sortmode not in files.SORTTYPES_BYNAME:
+            self.load_pending() # sorting mode changed while reading
+        self.set_sorted(files.sort_dir(self.files, sortmode,
+                                       sort_mix_dirs, sort_mix_cases))
+        self.file_i = self.sorted.index(filename_old)
+        if not stopped and not reader.error:
+            # complete, it can be used by other tabs now
+            files.share_dir_snapshot(self.snapshot)
+        if self.changes and self.is_uptodate():
+            changes, self.changes = self.changes, set()
+            self.update_files(changes)
+            if filename_old in self.sorted:
+                self.file_i = self.sorted.index(filename_old)
+        self.fix_limits()
+        if reader.error and not stopped:
+            messages.error('Cannot read directory\n%s: %s (%d)' % \
+                               (self.path, reader.error[0], reader.error[1]))
+
+
+    def resort(self):
+        """sort the listing again with current options, in memory"""
+
+        self.listing_opts = (self.listing_opts[0], ) + \
+            self.get_listing_opts()[1:]
+        if self.reader is not None:
+            return # sorted when the reading finishes
+        show_dotfiles, sortmode, sort_mix_dirs, sort_mix_cases = self.listing_opts
+        if self.pending and sortmode not in files.SORTTYPES_BYNAME:
+            self.load_pending()
+        filename_old = self.sorted[self.file_i]
+        self.set_sorted(files.sort_dir(self.files, sortmode,
+                                       sort_mix_dirs, sort_mix_cases))
+        self.sort_mode = sortmode
+        self.file_i = self.sorted.index(filename_old)
+        self.fix_limits()
+
+
+    def get_all_sorted(self):
+        """return the whole sorted listing, also the files which are not
+        shown because of the filter"""
+
+        return self.sorted if self.filter is None else self.filter.names
+
+
+    def set_sorted(self, names):
+        """set the whole sorted listing, and filter it if needed"""
+
+        self.sorted = names
+        if self.filter is not None:
+            self.filter.names = names
+            self.filter.names_changed()
+            sorted = self.filter.set_text(self.filter.text, self.filter.fuzzy)
+            if sorted: # else there is no pardir to show, forget filter
+                self.sorted = sorted
+            else:
+                self.filter = None
+        self.nfiles = len(self.sorted)
+
+
+    def set_filter(self, text, fuzzy=False):
+        """show only the files whose name matches text, see NameFilter.
+        An empty text shows all of them again, without reading anything.
+        Return False if nothing matches, the filter is not changed then"""
+
+        # sorted is empty if the last matching file has been removed
+        filename_old = self.sorted[self.file_i] \
+            if 0 <= self.file_i < len(self.sorted) else None
+        if not text:
+            if self.filter is not None:
+                self.sorted, self.filter = self.filter.names, None
+        else:
+            flt = self.filter or files.NameFilter(self.sorted)
+            text_old, fuzzy_old = flt.text, flt.fuzzy
+            sorted = flt.set_text(text, fuzzy)
+            if not sorted:
+                if self.filter is not None:
+                    flt.set_text(text_old, fuzzy_old)
+                return False
+            self.filter, self.sorted = flt, sorted
+        self.nfiles = len(self.sorted)
+        try:
+            self.file_i = self.sorted.index(filename_old)
+        except ValueError:
+            # first match
+            self.file_i = (self.nfiles > 1 and self.sorted[0] == os.pardir) \
+                and 1 or 0
+        self.fix_limits()
+        return True
+
+
+    def stop_loading(self):
+        """stop reading the directory in background, keep what was read"""
+
+        if self.reader is not None:
+            self.finish_loading(stopped=True)
+
+
+    def detach_snapshot(self):
+        """use a private copy of the files information, to modify it"""
+
+        self.snapshot = self.snapshot.copy()
+        self.serial = self.snapshot.serial
+        self.files = self.snapshot.files
+        self.pending = self.snapshot.pending
+
+
+    def load_pending(self, fs=None, maxtime=None):
+        """stat files not loaded yet: those in fs, or all of them,
+        or as many as possible in maxtime seconds"""
+
+        if fs is None:
+            if maxtime is None:
+                fs = list(self.pending)
+            else:
+                fs = list(itertools.islice(self.pending, 1000))
+        else:
+            fs = [f for f in fs if f in self.pending]
+        t0 = time.time()
+        for i in xrange(0, len(fs), 100):
+            chunk = fs[i:i+100]
+            files.stat_dir_entries(self.snapshot.path, self.files, chunk)
+            self.pending.difference_update(chunk)
+            if maxtime is not None and time.time()-t0 > maxtime:
+                break
+
+
     def enter_dir(self, filename):
         if self.vfs:
             if self.path == self.base and filename == os.pardir:
@@ -924,9 +1466,11 @@ class Vfs(object):
         del self.old_vfs
 
 
-    def regenerate(self):
+    def regenerate(self, force=False):
         """Rebuild tabs' directories"""
 
+        if self.reader is not None and not force:
+            return # changes are applied when the reading finishes
         path = self.path
         if path != os.sep and path[-1] == os.sep:
             path = path[:-1]
@@ -939,21 +1483,26 @@ class Vfs(object):
             pvfs, base, vbase = self.vfs, self.base, self.vbase
             self.init_dir(self.path)
             self.vfs, self.base, self.vbase = pvfs, base, vbase
-            self.selections = []
+            self.selections.clear()
+        elif not force and self.is_uptodate():
+            # only apply the changes notified by inotify
+            changes, self.changes = self.changes, set()
+            self.update_files(changes)
         else:
             filename_old = self.sorted[self.file_i]
-            selections_old = self.selections[:]
+            selections_old = self.selections
+            filter_old = self.filter
             pvfs, base, vbase = self.vfs, self.base, self.vbase
             self.init_dir(self.path)
             self.vfs, self.base, self.vbase = pvfs, base, vbase
+            if filter_old is not None:
+                self.set_filter(filter_old.text, filter_old.fuzzy)
             try:
                 self.file_i = self.sorted.index(filename_old)
             except ValueError:
                 self.file_i = 0
-            self.selections = selections_old[:]
-            for f in self.selections:
-                if f not in self.sorted:
-                    self.selections.remove(f)
+            self.selections = selections_old
+            self.selections.intersection_update(self.files)
 
 
     def refresh(self):
@@ -1029,6 +1578,8 @@ class TabVfs(Vfs):
                 self.file_i = self.sorted.index(old_file)
             except ValueError:
                 self.file_i = 0
+                if self.reader and not err:
+                    self.wanted_file = old_file # not read yet
         else:
             self.file_i = 0
         self.fix_limits()
@@ -1042,7 +1593,15 @@ class TabVfs(Vfs):
             height = self.pane.dims[0]
         else:
             height = self.pane.dims[0] - 3
-        self.file_a = int(self.file_i/height) * height
+        if self.pane.app.prefs.options['low_bandwidth']:
+            # scroll by lines, only the new rows must be sent
+            if self.file_i < self.file_a:
+                self.file_a = self.file_i
+            elif self.file_i >= self.file_a + height:
+                self.file_a = self.file_i - height + 1
+            self.file_a = max(0, min(self.file_a, self.nfiles-height))
+        else:
+            self.file_a = int(self.file_i/height) * height
         self.file_z = min(self.file_a+height-1, self.nfiles-1)
 
 
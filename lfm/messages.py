@@ -157,7 +157,7 @@ def notyet(title):
 
 ######################################################################
 class ProgressBarWindowBase(object):
-    """Window with 1 or 2 ProgressBar"""
+    """Window with 1, 2 or 3 ProgressBar"""
 
     def __init__(self, title, footer, bd_att, bd_bg, pb_att, pb_bg,
                  waitkey=True, num_pb=1):
@@ -168,8 +168,10 @@ class ProgressBarWindowBase(object):
             footer = footer[:w-4]
         if num_pb == 1:
             h, pb_width = 7, w-10
-        else:
+        elif num_pb == 2:
             h, pb_width = 8, w-17
+        else: # and a line for speed and remaining time
+            h, pb_width = 10, w-17
         self.h, self.w = h, w
         self.bd_att, self.pb_att = bd_att, pb_att
         self.progressbars = []
@@ -265,9 +267,15 @@ class ProgressBarWindow2(ProgressBarWindowBase):
         self.update(text, percent1, percent2, idx_str)
 
     def update(self, text, percent1, percent2, idx_str):
+        """percents are None while they are being estimated"""
         win = self.update_common(text, idx_str)
-        win.addstr(self.h-4, self.w-7, '%3d' % percent1)
-        win.addstr(self.h-3, self.w-7, '%3d' % percent2)
+        if percent1 is None:
+            win.addstr(self.h-4, self.w-7, '  ?')
+            win.addstr(self.h-3, self.w-7, '  ?')
+            percent1 = percent2 = 0
+        else:
+            win.addstr(self.h-4, self.w-7, '%3d' % percent1)
+            win.addstr(self.h-3, self.w-7, '%3d' % percent2)
         w1 = percent1 * (self.w-18) / 100
         pb1 = self.progressbars[0]
         pb1.erase()
@@ -281,6 +289,57 @@ class ProgressBarWindow2(ProgressBarWindowBase):
         win.refresh()
 
 
+class ProgressBarWindow3(ProgressBarWindowBase):
+    """Progress of current file, total bytes and count, with speed in
+    MB/s and remaining time"""
+
+    labels = ('File', 'Bytes', 'Count')
+
+    def __init__(self, title, footer, bd_att, bd_bg, pb_att, pb_bg, waitkey=True):
+        super(ProgressBarWindow3, self).__init__(title, footer, bd_att, bd_bg,
+                                                 pb_att, pb_bg, waitkey, 3)
+        self.x0 = int((app.maxw-self.w)/2) + 9
+        self.x1 = self.x0 + self.w - 19
+
+    def show(self, text='', percent0=0, percent1=0, percent2=0, idx_str='',
+             rate=None, avg_rate=None, eta=None):
+        win = self.show_common()
+        for i, label in enumerate(self.labels):
+            win.addstr(self.h-6+i, 2, label.ljust(self.w-10) + '[   %]')
+        self.update(text, percent0, percent1, percent2, idx_str,
+                    rate, avg_rate, eta)
+
+    def update(self, text, percent0, percent1, percent2, idx_str,
+               rate=None, avg_rate=None, eta=None):
+        """percent1 and percent2 are None while they are being estimated,
+        rates in bytes/s and eta in seconds are None if not known yet"""
+        win = self.update_common(text, idx_str)
+        for i, percent in enumerate((percent0, percent1, percent2)):
+            if percent is None:
+                win.addstr(self.h-6+i, self.w-7, '  ?')
+                percent = 0
+            else:
+                win.addstr(self.h-6+i, self.w-7, '%3d' % percent)
+            pb = self.progressbars[i]
+            pb.erase()
+            pb.addstr(0, 0, ' ' * (percent * (self.w-18) / 100),
+                      self.pb_att | curses.A_BOLD)
+            pb.refresh(0, 0, self.y0+i, self.x0, self.y0+i+1, self.x1)
+        if rate is None:
+            speed = 'Speed:  ?'
+        else:
+            speed = 'Speed: %.1f MB/s (avg %.1f MB/s)' % \
+                (rate/1048576, avg_rate/1048576)
+        if eta is None:
+            left = 'Left: ?'
+        else:
+            eta = int(eta)
+            left = 'Left: %d:%02d:%02d' % (eta/3600, eta/60%60, eta%60)
+        w = self.w - 4 - len(left)
+        win.addstr(self.h-3, 2, speed[:w].ljust(w) + left)
+        win.refresh()
+
+
 ######################################################################
 def get_a_key(title, question):
     """show a window returning key pressed"""
@@ -1568,6 +1627,9 @@ class ChangePerms(object):
         self.group_old = self.group[:]
         self.recursive = True
         self.i, self.n, self.entry_i, self.w = i, n, 0, w
+        # users and groups lists are only needed if asked, load in background
+        files.users.preload()
+        files.groups.preload()
 
 
     def show_btns(self):
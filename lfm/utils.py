@@ -12,6 +12,7 @@ import sys
 import time
 import signal
 import select
+import struct
 import cPickle
 import curses
 
@@ -24,6 +25,11 @@ from __init__ import sysprogs, g_encoding
 ##### module variables
 app = None
 
+# seconds between progress reports from the child
+PROGRESS_INTERVAL = 0.2
+# files sent to the child at once
+BATCH_SIZE = 1000
+
 # first common codecs, to avoid slow down decoding
 codecs_list = [g_encoding,  'utf-8', 'latin-1', 'ascii']
 # if program is too slow due to too many encodings to try,
@@ -39,25 +45,38 @@ codecs_list += sorted(cds.keys())
 ######################################################################
 ##### InterProcess Communication
 class IPC(object):
+    """Messages through a pipe. Every message is pickled in binary format
+    and sent after its length, so it's read with 2 calls"""
+
+    header = struct.Struct('!I')
+
     def __init__(self):
         pipe_r, pipe_w = os.pipe()
         self.rfd = os.fdopen(pipe_r, 'rb', 0)
         self.wfd = os.fdopen(pipe_w, 'wb', 0)
 
     def send(self, buf):
-        cPickle.dump(buf, self.wfd)
-        # time.sleep(0.01)
-        cPickle.dump(None, self.wfd)
-
-    def receive(self):
-        ready = select.select([self.rfd], [], [], 0.001) # 0.01
+        data = cPickle.dumps(buf, cPickle.HIGHEST_PROTOCOL)
+        self.wfd.write(IPC.header.pack(len(data)) + data)
+
+    def __read(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.rfd.read(size-len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def receive(self, timeout=0.001):
+        """wait for a message up to timeout seconds, forever if None"""
+        ready = select.select([self.rfd], [], [], timeout)
         if self.rfd in ready[0]:
             try:
-                buf = cPickle.load(self.rfd)
+                size = IPC.header.unpack(self.__read(IPC.header.size))[0]
+                buf = cPickle.loads(self.__read(size))
             except:
                 return -1, 'Error unmarshaling'
-            if buf is None:
-                return 0, None
             try:
                 arg1, arg2 = buf
             except:
@@ -87,6 +106,8 @@ class ProcessLoopBase(object):
         self.filename = ''         # current filename
         self.file_i = 0            # index to current item
         self.cursor_i = 0          # index to cursor animation step
+        self.t_progress = 0        # last progress report, in child
+        self.batch_i = 0           # index to current item of batch, in child
         self.init_gui()
 
     def init_gui(self):
@@ -96,6 +117,8 @@ class ProcessLoopBase(object):
             dlg = messages.ProgressBarWindow
         elif self.processloop_type == 2:
             dlg = messages.ProgressBarWindow2
+        elif self.processloop_type == 3:
+            dlg = messages.ProgressBarWindow3
         self.dlg = dlg(self.action, 'Press Ctrl-C to stop',
                        curses.color_pair(1), curses.color_pair(1),
                        curses.color_pair(20), curses.color_pair(4),
@@ -147,9 +170,13 @@ class ProcessLoopBase(object):
             elif status == 1: # stopped and continued by user
                 self.show_win()
             self.animate_cursor()
-            # check response
+            # check response, wake up on keys too
+            select.select([self.c2p.rfd, sys.stdin], [], [], 0.1)
             code, buf = self.c2p.receive()
             if code == 1:
+                if buf[0] == 'progress':
+                    self.update_progress(buf[1])
+                    continue
                 return buf
             elif code == -1:
                 return ('internal_error', buf)
@@ -163,13 +190,18 @@ class ProcessLoopBase(object):
     def process_response(self, result):
         raise NotImplementedError # in final class
 
+    def update_progress(self, progress):
+        pass # progress reports from child, if any
+
     def exec_file(self, args):
         # update progress dialog
         self.show_win()
         # send data to child
         self.p2c.send(('exec', args))
         # wait for answer and process it
-        ans, result = self.wait_for_answer()
+        return self.process_answer(*self.wait_for_answer())
+
+    def process_answer(self, ans, result):
         if ans == 'stopped_by_user':
             return -1
         elif ans == 'internal_error':
@@ -222,7 +254,7 @@ class ProcessLoopBase(object):
         while True:
             # wait for command to execute
             while True:
-                code, buf = self.p2c.receive()
+                code, buf = self.p2c.receive(None)
                 if code == 1:
                     break
                 elif code == -1:
@@ -235,9 +267,12 @@ class ProcessLoopBase(object):
             if cmd == 'quit':
                 break
             elif cmd == 'exec':
-                res = self.func(*args)
+                res = self.run_func(args)
                 self.c2p.send(('result', res))
                 continue
+            elif cmd == 'batch':
+                self.run_batch(args)
+                continue
             else:
                 result = ('error', 'Child: Bad command from parent')
                 self.c2p.send(('result', result))
@@ -246,12 +281,44 @@ class ProcessLoopBase(object):
         # time.sleep(.25) # time to let parent get return value
         os._exit(0)
 
+    def run_func(self, args):
+        """run in child"""
+        return self.func(*args)
+
+    def run_batch(self, batch):
+        """run in child: run func with the args in batch back to back.
+        Stop at the first result which needs the parent (overwrite, error...)
+        and answer ('batch', (index, result)), or (len(batch), None) if all
+        went fine. Meanwhile progress is reported every PROGRESS_INTERVAL"""
+        for self.batch_i, args in enumerate(batch):
+            res = self.run_func(args)
+            if res is not None:
+                self.c2p.send(('batch', (self.batch_i, res)))
+                return
+            self.batch_i += 1
+            self.send_progress()
+        self.c2p.send(('batch', (len(batch), None)))
+
+    def send_progress(self):
+        """run in child: send ('progress', (index in batch, get_progress()))
+        if last report is old enough"""
+        now = time.time()
+        if now - self.t_progress < PROGRESS_INTERVAL:
+            return
+        self.c2p.send(('progress', (self.batch_i, self.get_progress(now))))
+        self.t_progress = now
+
+    def get_progress(self, now):
+        """run in child: progress information added to the report"""
+        return None
+
 
 ######################################################################
 ##### Process Loop Base Class, 1 progressbar
 class ProcessLoopBase_1(ProcessLoopBase):
+    processloop_type = 1
+
     def __init__(self, action='', func=None, lst=[], *args):
-        self.processloop_type = 1
         super(ProcessLoopBase_1, self).__init__(action, func, *args)
         self.lst = lst
         self.length = len(lst)
@@ -386,57 +453,256 @@ class ProcessLoopBackup(ProcessLoopBase_1):
 ######################################################################
 ##### Process Loop Base Class, 2 progressbar
 class ProcessLoopBase_2(ProcessLoopBase):
+    processloop_type = 2
+
     def __init__(self, action='', func=None, pc=None, *args):
-        self.processloop_type = 2
         super(ProcessLoopBase_2, self).__init__(action, func, *args)
         self.pc = pc            # PathContents
         self.filesize_aggr = 0  # partial sum of processed files
+        self.filesize = 0       # size of current file
+        self.batch = None       # (files sent to child, file_i, filesize_aggr)
+        self.t_shown = 0        # last time the dialog was drawn
 
     def show_win(self):
         filename = self.filename.replace(self.pc.basepath+os.sep, '')
-        perc_size = 100 * self.filesize_aggr / self.pc.tsize
-        perc_count = 100 * self.file_i / self.pc.tlength
-        idx_str = '%d/%d' % (self.file_i, self.pc.tlength)
+        if self.pc.complete:
+            perc_size = min(100 * self.filesize_aggr / self.pc.tsize, 100)
+            perc_count = min(100 * self.file_i / max(self.pc.tlength, 1), 100)
+            idx_str = '%d/%d' % (self.file_i, self.pc.tlength)
+        else:
+            # still counting the files
+            perc_size = perc_count = None
+            idx_str = '%d/...' % self.file_i
         if self.dlg.ishidden:
             self.dlg.show(filename, perc_size, perc_count, idx_str)
         else:
             self.dlg.update(filename, perc_size, perc_count, idx_str)
 
-    def run(self):
-        for filename, err in self.pc.errors:
+    def show_errors(self, errors):
+        for filename, err in errors:
             self.show_parent()
             messages.error('Cannot %s\n' % self.action.lower() +
                            filename + ': %s (%s)' % err)
+
+    def needs_confirmation(self):
+        """True if ask_confirmation could ask the user, so the files
+        before must be processed first"""
+        return False
+
+    def set_batch_position(self, i):
+        """files before batch[i] have been processed, it's the current"""
+        files, file_i, filesize_aggr = self.batch
+        self.file_i = file_i + min(i+1, len(files))
+        self.filesize_aggr = filesize_aggr + \
+            sum([size for f, size in files[:i+1]])
+        if i < len(files):
+            self.filename, self.filesize = files[i]
+        else:
+            self.filesize = 0   # all done, none is being processed
+
+    def update_progress(self, progress):
+        i, data = progress
+        if self.batch is not None:
+            self.set_batch_position(i)
+        self.show_win()
+
+    def batch_failed(self, files):
+        """files, a list of (filename, filesize), may have not been
+        processed because the child failed"""
+        pass
+
+    def exec_batch(self, files):
+        """send files, a list of (filename, filesize), to the child, which
+        processes them back to back and only comes back to report progress,
+        at end, or with a result which needs the parent: overwrite, error..."""
+        while files:
+            args = []
+            for self.filename, self.filesize in files:
+                args.append(self.prepare_args())
+            self.batch = (files, self.file_i, self.filesize_aggr)
+            self.set_batch_position(0)
+            if self.dlg.ishidden or time.time()-self.t_shown > PROGRESS_INTERVAL:
+                self.show_win()
+                self.t_shown = time.time()
+            self.p2c.send(('batch', args))
+            ans, result = self.wait_for_answer()
+            if ans != 'batch':
+                if ans != 'stopped_by_user':
+                    # child failed, the files after the last progress
+                    # reported could have not been processed
+                    self.batch_failed(files[self.file_i-self.batch[1]-1:])
+                self.batch = None
+                return self.process_answer(ans, result)
+            i, res = result
+            self.set_batch_position(i)
+            self.batch = None
+            if i < len(files) and self.process_response(res) == -1:
+                return -1
+            files = files[i+1:]
+        return 0
+
+    def run(self):
+        errors = self.pc.errors
+        self.show_errors(errors)
         if ProcessLoopBase.run_pre(self) == -1:
             return
-        for self.filename, filesize in self.pc.iter_walk(reverse=self.rev):
+        self.pc.count()
+        files = []              # (filename, filesize) not sent to child yet
+        walk = self.pc.iter_walk(reverse=self.rev)
+        invalid_encoding = False
+        while True:
+            try:
+                filename, filesize = walk.next()
+            except StopIteration:
+                break
+            except UnicodeError:
+                invalid_encoding = True
+                break
+            if len(files) >= BATCH_SIZE or \
+                    (files and self.needs_confirmation()):
+                batch, files = files, []
+                if self.exec_batch(batch) == -1:
+                    self.ret = -1   # stopped by user
+                    break
+            self.filename = filename
             ret = self.ask_confirmation()
             if ret == -1:
                 break
             elif ret == 0:
                 continue
-            self.file_i += 1
-            self.filesize_aggr += filesize
-            args = self.prepare_args()
-            ret = self.exec_file(args)
-            if ret == -1:
-                self.ret = -1   # stopped by user
-                break
+            files.append((filename, filesize))
+        # those found before the end, or the name with invalid encoding
+        if files and self.exec_batch(files) == -1:
+            self.ret = -1   # stopped by user
+        if invalid_encoding:
+            self.ret = -1
+            self.show_parent()
+            messages.error('Cannot %s\n' % self.action.lower() +
+                           'Files with invalid encoding, convert first')
+        if self.ret == -1:
+            self.pc.stop()
         ProcessLoopBase.run_post(self)
+        # errors found while walking the directories
+        self.show_errors(self.pc.errors[len(errors):])
         return self.return_data()
 
 
 ##### Process Loop Copy
 class ProcessLoopCopy(ProcessLoopBase_2):
+    """The child reports the bytes copied of big files while it copies
+    them, at most every PROGRESS_INTERVAL seconds"""
+
+    processloop_type = 3
+
     def __init__(self, action='', func=None, pc=None, *args):
         super(ProcessLoopCopy, self).__init__(action, func, pc, *args)
         self.rev = False
+        pc.set_dest(args[0])
         self.overwrite_all = not app.prefs.confirmations['overwrite']
         self.overwrite_none = False
+        self.file_bytes = 0     # bytes copied of current file
+        self.rate = self.avg_rate = None
+        # in child
+        self.bytes_done = 0     # bytes copied of files finished
+        self.t_copying = 0      # seconds copying, without stops and dialogs
+        self.t_mark = None      # last time added to t_copying, while copying
+        self.continued = False  # stopped and continued since t_mark
+        self.t_last = self.bytes_last = 0 # t_copying and bytes at last report
+
+    def show_win(self):
+        filename = self.filename.replace(self.pc.basepath+os.sep, '')
+        if self.filesize:
+            perc_file = min(100 * self.file_bytes / self.filesize, 100)
+        else:
+            perc_file = 0
+        done = self.filesize_aggr - self.filesize + self.file_bytes
+        eta = None
+        if self.pc.complete:
+            perc_size = min(100 * done / self.pc.tsize, 100)
+            perc_count = min(100 * self.file_i / max(self.pc.tlength, 1), 100)
+            idx_str = '%d/%d' % (self.file_i, self.pc.tlength)
+            if self.avg_rate:
+                eta = max(self.pc.tsize - done, 0) / self.avg_rate
+        else:
+            # still counting the files
+            perc_size = perc_count = None
+            idx_str = '%d/...' % self.file_i
+        args = (filename, perc_file, perc_size, perc_count, idx_str,
+                self.rate, self.avg_rate, eta)
+        if self.dlg.ishidden:
+            self.dlg.show(*args)
+        else:
+            self.dlg.update(*args)
+
+    def exec_file(self, args):
+        self.file_bytes = 0
+        return super(ProcessLoopCopy, self).exec_file(args)
+
+    def set_batch_position(self, i):
+        self.file_bytes = 0
+        super(ProcessLoopCopy, self).set_batch_position(i)
+
+    def update_progress(self, progress):
+        i, data = progress
+        if self.batch is not None:
+            self.set_batch_position(i)
+        self.file_bytes, total, self.rate, self.avg_rate = data
+        self.show_win()
+
+    def child_process(self):
+        # the time stopped by the user must not count as copying time
+        signal.signal(signal.SIGCONT, self.__continued)
+        signal.siginterrupt(signal.SIGCONT, False)
+        super(ProcessLoopCopy, self).child_process()
+
+    def __continued(self, signum, frame):
+        self.continued = True
+
+    def add_copying_time(self, now):
+        """run in child: add the time since t_mark to copying time, unless
+        the child has been stopped meanwhile"""
+        if not self.continued:
+            self.t_copying += now - self.t_mark
+        self.t_mark, self.continued = now, False
+
+    def run_func(self, args):
+        """run in child"""
+        self.t_mark, self.continued = time.time(), False
+        res = self.func(*args, progress=self.copy_progress)
+        self.add_copying_time(time.time())
+        self.t_mark = None
+        self.bytes_done += self.file_bytes
+        self.file_bytes = 0
+        return res
+
+    def copy_progress(self, file_bytes):
+        """run in child, while a file is being copied"""
+        self.file_bytes = file_bytes
+        self.send_progress()
+
+    def get_progress(self, now):
+        """run in child: bytes copied of current file and in total, speed
+        since last report and average, in bytes/s. Only the time spent
+        copying is measured, not the time stopped or between batches"""
+        continued = self.continued
+        if self.t_mark is not None:
+            self.add_copying_time(now)
+        total = self.bytes_done + self.file_bytes
+        if not continued or self.rate is None:
+            # if stopped, the time of bytes copied since last report is lost
+            self.rate = (total-self.bytes_last) / \
+                max(self.t_copying-self.t_last, 1e-6)
+        avg_rate = total / max(self.t_copying, 1e-6)
+        self.t_last, self.bytes_last = self.t_copying, total
+        return self.file_bytes, total, self.rate, avg_rate
 
     def ask_confirmation(self):
         return 1
 
+    def batch_failed(self, files):
+        # returned as not copied, so a move doesn't delete them
+        self.ret.extend([f for f, size in files])
+
     def prepare_args(self):
         if self.pc.basepath == os.sep:
             filename = self.filename.replace(self.pc.basepath, '')
@@ -492,6 +758,9 @@ class ProcessLoopDelete(ProcessLoopBase_2):
         self.rev = True
         self.delete_all = not app.prefs.confirmations['delete']
 
+    def needs_confirmation(self):
+        return not self.delete_all
+
     def ask_confirmation(self):
         if self.delete_all:
             return 2
@@ -873,12 +1142,12 @@ def do_compress_uncompress_file(filename, path, typ):
 
 def compress_uncompress_file(tab, typ):
     if tab.selections:
-        fs = tab.selections[:]
+        fs = list(tab.selections)
     else:
         fs = [tab.sorted[tab.file_i]]
     ProcessLoopUnCompress('Un/Compress file', do_compress_uncompress_file,
                           fs, tab.path, typ).run()
-    tab.selections = []
+    tab.selections.clear()
     app.regenerate()
 
 
@@ -908,12 +1177,12 @@ def uncompress_dir(tab, dest=None, is_tmp=False):
     if dest is None:
         dest = tab.path
     if tab.selections:
-        fs = tab.selections[:]
+        fs = list(tab.selections)
     else:
         fs = [tab.sorted[tab.file_i]]
     ProcessLoopUnCompress('Uncompress file', do_uncompress_dir,
                           fs, tab.path, dest, is_tmp).run()
-    tab.selections = []
+    tab.selections.clear()
 
 
 # compress directory: tar and gzip, bzip2
@@ -942,12 +1211,12 @@ def compress_dir(tab, typ, dest=None, is_tmp=False):
     if dest is None:
         dest = tab.path
     if tab.selections:
-        fs = tab.selections[:]
+        fs = list(tab.selections)
     else:
         fs = [tab.sorted[tab.file_i]]
     ProcessLoopUnCompress('Compress file', do_compress_dir,
                           fs, tab.path, typ, dest, is_tmp).run()
-    tab.selections = []
+    tab.selections.clear()
 
 
 ######################################################################
@@ -54,7 +54,7 @@ setup(name = 'lfm',
       classifiers = filter(None, classifiers.split("\n")),
       py_modules = ['lfm/__init__', 'lfm/lfm', 'lfm/messages', 'lfm/files',
                     'lfm/actions', 'lfm/compress', 'lfm/utils', 'lfm/vfs',
-                    'lfm/config', 'lfm/pyview'],
+                    'lfm/config', 'lfm/pyview', 'lfm/inotify', 'lfm/eventloop'],
       scripts = ['lfm/lfm', 'lfm/pyview'],
       data_files = [('share/doc/lfm', DOC_FILES),
                     ('share/man/man1', MAN_FILES)]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""test_config.py
+
+Tests for the files_ext lookup in config.py.
+
+Usage:\tpython -m unittest discover -s tests
+"""
+
+
+import os, os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lfm'))
+import files # before config, they import each other
+import config
+
+
+######################################################################
+class FilesExtTest(unittest.TestCase):
+    def setUp(self):
+        self.cfg = config.Config()
+
+    def set_files_ext(self, **kwargs):
+        self.cfg.files_ext = kwargs
+        self.cfg.compile_files_ext()
+
+    def test_defaults(self):
+        get = self.cfg.get_files_ext_type
+        self.assertEqual(get(u'readme.txt'), 'document_files')
+        self.assertEqual(get(u'lfm.py'), 'source_files')
+        self.assertEqual(get(u'a.tar.gz'), 'archive_files')
+        self.assertEqual(get(u'lfm.py~'), 'temp_files')
+        self.assertEqual(get(u'.bak'), None)
+        self.assertEqual(get(u'readme'), None)
+        self.assertEqual(get(u'py'), None)
+
+    def test_case(self):
+        self.set_files_ext(archive_files=('.Z', ), source_files=('.c', ),
+                           temp_files=('CORE*', ))
+        get = self.cfg.get_files_ext_type
+        self.assertEqual(get(u'a.z'), 'archive_files')
+        self.assertEqual(get(u'A.Z'), 'archive_files')
+        self.assertEqual(get(u'B.C'), 'source_files')
+        self.assertEqual(get(u'core.123'), 'temp_files')
+        self.assertEqual(get(u'Core'), 'temp_files')
+
+    def test_suffixes(self):
+        """extensions with dots or without them are suffixes"""
+        self.set_files_ext(temp_files=('~', ), archive_files=('.tar.gz', ),
+                           data_files=('.gz', ))
+        get = self.cfg.get_files_ext_type
+        self.assertEqual(get(u'a.tar.gz'), 'archive_files')
+        self.assertEqual(get(u'a.TAR.GZ'), 'archive_files')
+        self.assertEqual(get(u'atar.gz'), 'data_files')
+        self.assertEqual(get(u'a.gz'), 'data_files')
+        self.assertEqual(get(u'a.txt~'), 'temp_files')
+        self.assertEqual(get(u'a~.txt'), None)
+
+    def test_globs(self):
+        self.set_files_ext(temp_files=('core*', '#*#'),
+                           source_files=('makefile*', '*.[ch]'))
+        get = self.cfg.get_files_ext_type
+        self.assertEqual(get(u'core'), 'temp_files')
+        self.assertEqual(get(u'core.42'), 'temp_files')
+        self.assertEqual(get(u'acore'), None)
+        self.assertEqual(get(u'#notes#'), 'temp_files')
+        self.assertEqual(get(u'Makefile.am'), 'source_files')
+        self.assertEqual(get(u'a.h'), 'source_files')
+        self.assertEqual(get(u'a.x'), None)
+
+    def test_priority(self):
+        """the first type in FILES_EXT_TYPES wins, no matter if matched
+        by extension or by pattern"""
+        self.set_files_ext(temp_files=('.py', '*.old.*'),
+                           document_files=('.txt', ),
+                           source_files=('.py', '.txt', 'test_*'),
+                           data_files=('.old', ))
+        get = self.cfg.get_files_ext_type
+        self.assertEqual(get(u'a.py'), 'temp_files')
+        self.assertEqual(get(u'a.txt'), 'document_files')
+        self.assertEqual(get(u'a.old.txt'), 'temp_files')
+        self.assertEqual(get(u'test_a.txt'), 'document_files')
+        self.assertEqual(get(u'test_a'), 'source_files')
+        self.assertEqual(get(u'a.old'), 'data_files')
+
+
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
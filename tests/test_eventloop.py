@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""test_eventloop.py
+
+Tests for the main loop in eventloop.py.
+
+Usage:\tpython -m unittest discover -s tests
+"""
+
+
+import os, os.path
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lfm'))
+import eventloop
+
+
+######################################################################
+class EventLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = eventloop.EventLoop()
+        self.calls = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def callback(self, name):
+        return lambda: self.calls.append(name)
+
+    def test_timers_order(self):
+        self.loop.call_later(0.03, self.callback('c'))
+        self.loop.call_later(0.01, self.callback('a'))
+        self.loop.call_later(0.01, self.callback('b'))
+        self.loop.call_later(10, self.callback('late'))
+        t0 = time.time()
+        while len(self.calls) < 3 and time.time()-t0 < 5:
+            self.loop.run_once()
+        # same time, in the order they were added
+        self.assertEqual(self.calls, ['a', 'b', 'c'])
+        self.assertTrue(time.time()-t0 >= 0.03)
+
+    def test_cancel(self):
+        timer = self.loop.call_later(0, self.callback('cancelled'))
+        self.loop.call_later(0.01, self.callback('a'))
+        self.loop.cancel(timer)
+        self.loop.run_once(1)
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(self.loop.timers, [])
+
+    def test_cancelled_timer_doesnt_wake_up(self):
+        """a cancelled timer doesn't shorten the wait"""
+        self.loop.cancel(self.loop.call_later(0, self.callback('x')))
+        t0 = time.time()
+        self.loop.run_once(0.05)
+        self.assertTrue(time.time()-t0 >= 0.04)
+        self.assertEqual(self.calls, [])
+
+    def test_timeout(self):
+        t0 = time.time()
+        self.loop.run_once(0.05)
+        self.assertTrue(0.04 <= time.time()-t0 < 1)
+        # a timer before the timeout wakes it up earlier
+        self.loop.call_later(0.01, self.callback('a'))
+        t0 = time.time()
+        self.loop.run_once(5)
+        self.assertTrue(time.time()-t0 < 1)
+        self.assertEqual(self.calls, ['a'])
+        t0 = time.time()
+        self.loop.run_once(0)
+        self.assertTrue(time.time()-t0 < 0.5)
+
+    def test_reader(self):
+        rfd, wfd = os.pipe()
+        try:
+            self.loop.add_reader(rfd, lambda: self.calls.append(os.read(rfd, 1)))
+            os.write(wfd, 'x')
+            self.loop.run_once(1)
+            self.assertEqual(self.calls, ['x'])
+            self.loop.remove_reader(rfd)
+            os.write(wfd, 'y')
+            self.loop.run_once(0.01)
+            self.assertEqual(self.calls, ['x'])
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def test_post_from_thread(self):
+        """posted callbacks run in the loop thread, which wakes up"""
+        def post():
+            time.sleep(0.05)
+            self.loop.post(lambda: self.calls.append(
+                    threading.current_thread().name))
+        thread = threading.Thread(target=post)
+        thread.start()
+        t0 = time.time()
+        self.loop.run_once(5)
+        thread.join()
+        self.assertTrue(time.time()-t0 < 1)
+        self.assertEqual(self.calls, [threading.current_thread().name])
+
+    def test_post_many(self):
+        """many posts before the loop runs don't block nor get lost"""
+        for i in xrange(100000):
+            self.loop.post()
+        self.loop.post(self.callback('a'))
+        self.loop.run_once(1)
+        self.assertEqual(self.calls, ['a'])
+        t0 = time.time()
+        self.loop.run_once(0.05)
+        self.assertTrue(time.time()-t0 >= 0.04) # pipe is empty again
+
+    def test_post_after_close(self):
+        self.loop.close()
+        self.loop.post(self.callback('a'))
+        self.loop = eventloop.EventLoop()
+
+
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,784 @@
+# -*- coding: utf-8 -*-
+
+"""test_files.py
+
+Tests for files.py.
+
+Usage:\tpython -m unittest discover -s tests
+"""
+
+
+import os, os.path
+import sys
+import errno
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lfm'))
+import files
+
+
+######################################################################
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix=u'lfm-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def create(self, *names):
+        """create files, or directories if name ends with /"""
+        for f in names:
+            f = os.path.join(self.path, f)
+            if f.endswith(os.sep):
+                os.makedirs(f)
+            else:
+                if not os.path.isdir(os.path.dirname(f)):
+                    os.makedirs(os.path.dirname(f))
+                open(f, 'w').write(os.path.basename(f))
+
+
+######################################################################
+class GetDirTest(TempDirTestCase):
+    def test_iter_dir(self):
+        self.create(u'a', u'b/', u'.c')
+        os.symlink(u'a', os.path.join(self.path, u'l'))
+        entries = dict(files.iter_dir(self.path))
+        self.assertEqual(sorted(entries), sorted(os.listdir(self.path)))
+        if entries[u'b'] != files.DT_UNKNOWN:
+            self.assertEqual(entries[u'b'], files.DT_DIR)
+            self.assertEqual(entries[u'l'], files.DT_LNK)
+
+    def test_get_dir(self):
+        self.create(u'a', u'b/', u'.c')
+        n, fs = files.get_dir(self.path)
+        self.assertEqual(n, 4)
+        self.assertEqual(fs[u'b'][files.FT_TYPE], files.FTYPE_DIR)
+        self.assertEqual(fs[u'a'][files.FT_SIZE], 1)
+        n, fs = files.get_dir(self.path, show_dotfiles=0)
+        self.assertEqual(sorted(fs.keys()), [os.pardir, u'a', u'b'])
+
+    def test_get_dir_lstat_fails(self):
+        """entries which can't be lstat'ed are shown as unknown"""
+        self.create(u'a', u'b')
+        get_dir_entry = files.get_dir_entry
+        files.get_dir_entry = lambda path, f: \
+            None if f == u'b' else get_dir_entry(path, f)
+        try:
+            n, fs = files.get_dir(self.path)
+        finally:
+            files.get_dir_entry = get_dir_entry
+        self.assertEqual(n, 3)
+        self.assertEqual(fs[u'b'][files.FT_TYPE], files.FTYPE_UNKNOWN)
+
+
+######################################################################
+def entry(typ=files.FTYPE_REG, size=0, mtime=0, owner=u'root', rdev=0):
+    return (typ, 0644, owner, u'root', size, mtime, rdev)
+
+
+class FileListTest(unittest.TestCase):
+    def test_dict(self):
+        fl = files.FileList({u'a': entry(size=10), u'b': entry(owner=u'me')})
+        fl[u'dev'] = entry(files.FTYPE_CDEV, rdev=0x103)
+        fl[u'a'] = entry(size=2**40, mtime=5)
+        self.assertEqual(len(fl), 3)
+        self.assertEqual(fl[u'a'], entry(size=2**40, mtime=5))
+        self.assertEqual(fl[u'b'][files.FT_OWNER], u'me')
+        self.assertEqual(fl[u'dev'][files.FT_RDEV], 0x103)
+        self.assertEqual(fl.get(u'c'), None)
+        self.assertEqual(sorted(fl.keys()), [u'a', u'b', u'dev'])
+        self.assertEqual(dict(fl.items())[u'b'], entry(owner=u'me'))
+
+    def test_delete(self):
+        """deleted rows are compacted when holes are too many"""
+        fl = files.FileList()
+        for i in xrange(10):
+            fl[u'f%d' % i] = entry(size=i, rdev=i)
+        for i in range(0, 10, 2) + [1]:
+            del fl[u'f%d' % i]
+        self.assertFalse(u'f0' in fl)
+        self.assertEqual(len(fl.names), len(fl))
+        self.assertEqual(sorted(fl.keys()), [u'f3', u'f5', u'f7', u'f9'])
+        for f in fl:
+            i = int(f[1:])
+            self.assertEqual(fl[f], entry(size=i, rdev=i))
+
+    def test_copy(self):
+        fl = files.FileList({u'a': entry(), u'b': entry()})
+        new = fl.copy()
+        new[u'a'] = entry(size=1)
+        del new[u'b']
+        self.assertEqual(fl[u'a'], entry())
+        self.assertTrue(u'b' in fl)
+        self.assertEqual(new.sort(files.SORTTYPE_byName, 0, 0), [u'a'])
+
+    def test_sort(self):
+        fl = files.FileList({os.pardir: entry(files.FTYPE_DIR),
+                             u'b': entry(size=1, mtime=3),
+                             u'A': entry(size=3, mtime=2),
+                             u'c': entry(size=2, mtime=1),
+                             u'd': entry(files.FTYPE_DIR, size=4096),
+                             u'x': entry()})
+        del fl[u'x']
+        self.assertEqual(fl.sort(files.SORTTYPE_byName, 0, 0),
+                         [os.pardir, u'd', u'A', u'b', u'c'])
+        self.assertEqual(fl.sort(files.SORTTYPE_byName, 1, 1),
+                         [os.pardir, u'A', u'b', u'c', u'd'])
+        self.assertEqual(fl.sort(files.SORTTYPE_byName_rev, 0, 0),
+                         [os.pardir, u'd', u'c', u'b', u'A'])
+        self.assertEqual(fl.sort(files.SORTTYPE_bySize, 0, 0),
+                         [os.pardir, u'd', u'b', u'c', u'A'])
+        self.assertEqual(fl.sort(files.SORTTYPE_byDate_rev, 1, 0),
+                         [os.pardir, u'b', u'A', u'c', u'd'])
+
+
+######################################################################
+class SortTest(unittest.TestCase):
+    NAMES = [u'file10.txt', u'file9.txt', u'File2.TXT', u'file1.c',
+             u'readme', u'a.tar.gz', u'b.C', u'v1.10', u'v1.9', u'v1.9a']
+
+    def setUp(self):
+        self.fl = files.FileList()
+        for i, f in enumerate(self.NAMES):
+            self.fl[f] = entry(size=i % 3, mtime=i % 4)
+        self.fl[u'dir1'] = entry(files.FTYPE_DIR)
+        self.fl[u'dir10'] = entry(files.FTYPE_DIR)
+        self.fl[u'dir9'] = entry(files.FTYPE_DIR)
+        self.fl[os.pardir] = entry(files.FTYPE_DIR)
+
+    def test_natural(self):
+        self.assertEqual(self.fl.sort(files.SORTTYPE_byNatural, 0, 0),
+                         [os.pardir, u'dir1', u'dir9', u'dir10', u'File2.TXT',
+                          u'a.tar.gz', u'b.C', u'file1.c', u'file9.txt',
+                          u'file10.txt', u'readme', u'v1.9', u'v1.9a',
+                          u'v1.10'])
+        self.assertEqual(self.fl.sort(files.SORTTYPE_byNatural, 0, 1)[4:8],
+                         [u'a.tar.gz', u'b.C', u'file1.c', u'File2.TXT'])
+
+    def test_extension(self):
+        self.assertEqual(self.fl.sort(files.SORTTYPE_byExt, 1, 0),
+                         [os.pardir, u'dir1', u'dir10', u'dir9', u'readme',
+                          u'v1.10', u'v1.9', u'v1.9a', u'b.C', u'file1.c',
+                          u'a.tar.gz', u'File2.TXT', u'file10.txt',
+                          u'file9.txt'])
+
+    def test_insert_sorted(self):
+        """inserting keeps the order sort_dir gives, in all modes"""
+        for sortmode in xrange(1, 11):
+            for mix_dirs in (0, 1):
+                for mix_cases in (0, 1):
+                    fl = files.FileList()
+                    fl[os.pardir] = self.fl[os.pardir]
+                    names = [os.pardir]
+                    for f in self.fl:
+                        if f != os.pardir:
+                            fl[f] = self.fl[f]
+                            files.insert_sorted(names, fl, f, sortmode,
+                                                mix_dirs, mix_cases)
+                    self.assertEqual(names, files.sort_dir(fl, sortmode,
+                                                           mix_dirs, mix_cases),
+                                     (sortmode, mix_dirs, mix_cases))
+
+
+######################################################################
+class SelectionsTest(unittest.TestCase):
+    def test_order(self):
+        sel = files.Selections([u'c', u'a'])
+        sel.add(u'b')
+        sel.add(u'c')
+        sel.toggle(u'a')
+        sel.toggle(u'd')
+        self.assertEqual(list(sel), [u'c', u'b', u'd'])
+        self.assertEqual(len(sel), 3)
+        self.assertTrue(u'b' in sel)
+        self.assertFalse(u'a' in sel)
+        sel.discard(u'x')
+        sel.add(u'a')
+        self.assertEqual(list(sel), [u'c', u'b', u'd', u'a'])
+
+    def test_many_discarded(self):
+        sel = files.Selections([u'f%d' % i for i in xrange(100)])
+        sel.difference_update([u'f%d' % i for i in xrange(0, 100, 3)])
+        sel.intersection_update(set([u'f%d' % i for i in xrange(50)]))
+        self.assertEqual(list(sel), [u'f%d' % i for i in xrange(50) if i % 3])
+        new = sel.copy()
+        new.clear()
+        self.assertEqual(len(new), 0)
+        self.assertEqual(len(sel), 33)
+
+    def test_matching(self):
+        names = [os.pardir, u'a.py', u'b.py', u'.c.py', u'd.txt']
+        self.assertEqual(files.match_names(names, u'*.py'), [u'a.py', u'b.py'])
+        self.assertEqual(files.match_names(names, u'.*'), [u'.c.py'])
+        self.assertEqual(files.match_names(names, u'*'),
+                         [u'a.py', u'b.py', u'd.txt'])
+        sel = files.Selections([u'd.txt'])
+        sel.add_matching(names, u'*.py')
+        self.assertEqual(list(sel), [u'd.txt', u'a.py', u'b.py'])
+        sel.discard_matching(names, u'a*')
+        self.assertEqual(list(sel), [u'd.txt', u'b.py'])
+
+
+######################################################################
+class NameFilterTest(unittest.TestCase):
+    NAMES = [os.pardir, u'Makefile', u'README', u'files.py', u'lfm.py',
+             u'messages.py', u'Pyview.py', u'utils.pyc']
+
+    def setUp(self):
+        self.nf = files.NameFilter(self.NAMES)
+
+    def test_substring(self):
+        self.assertEqual(self.nf.set_text(u'py'),
+                         [os.pardir, u'files.py', u'lfm.py', u'messages.py',
+                          u'Pyview.py', u'utils.pyc'])
+        self.assertEqual(self.nf.set_text(u'py'), self.nf.set_text(u'PY'))
+        self.assertEqual(self.nf.set_text(u'.py'),
+                         [os.pardir, u'files.py', u'lfm.py', u'messages.py',
+                          u'Pyview.py', u'utils.pyc'])
+        self.assertEqual(self.nf.set_text(u'.pyc'), [os.pardir, u'utils.pyc'])
+        # deleting characters widens again
+        self.assertEqual(self.nf.set_text(u'm'),
+                         [os.pardir, u'Makefile', u'README', u'lfm.py',
+                          u'messages.py'])
+        self.assertEqual(self.nf.set_text(u''), self.NAMES)
+
+    def test_glob(self):
+        self.assertEqual(self.nf.set_text(u'*.py'),
+                         [os.pardir, u'files.py', u'lfm.py', u'messages.py',
+                          u'Pyview.py'])
+        self.assertEqual(self.nf.set_text(u'?fm*'), [os.pardir, u'lfm.py'])
+
+    def test_fuzzy(self):
+        self.assertEqual(self.nf.set_text(u'fp', fuzzy=True),
+                         [os.pardir, u'files.py', u'lfm.py'])
+        self.assertEqual(self.nf.set_text(u'fp'), [os.pardir])
+        self.assertEqual(self.nf.set_text(u'msp', fuzzy=True),
+                         [os.pardir, u'messages.py'])
+
+    def test_filter_names(self):
+        self.nf.set_text(u'read')
+        self.assertEqual(self.nf.filter_names([os.pardir, u'a', u'readme']),
+                         [os.pardir, u'readme'])
+
+
+######################################################################
+class CopyTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.src = os.path.join(self.path, u'src')
+        self.dest = os.path.join(self.path, u'dest')
+        self.data = os.urandom(3*files.COPY_BUFSIZE + 17)
+        open(self.src, 'wb').write(self.data)
+        os.chmod(self.src, 0640)
+        os.utime(self.src, (1000000000, 1200000000))
+
+    def check_copy(self):
+        self.assertEqual(open(self.dest, 'rb').read(), self.data)
+        st_src, st_dest = os.stat(self.src), os.stat(self.dest)
+        self.assertEqual(st_dest.st_mode, st_src.st_mode)
+        self.assertEqual(int(st_dest.st_mtime), 1200000000)
+
+    def test_engines(self):
+        for engine in files.COPY_ENGINES:
+            progress = []
+            n = files.copy_file(self.src, self.dest, (engine, ),
+                                progress.append)
+            self.assertEqual(n, len(self.data))
+            self.check_copy()
+            if progress or engine == 'readinto':
+                self.assertEqual(progress[-1], len(self.data))
+            os.unlink(self.dest)
+
+    def test_fallback(self):
+        """engines which can't copy are skipped"""
+        fdin = os.open(self.src, os.O_RDONLY)
+        fdout = os.open(self.dest, os.O_WRONLY | os.O_CREAT)
+        try:
+            self.assertEqual(files.copy_data(fdin, fdout,
+                                             ('unknown', 'readinto')),
+                             (len(self.data), 'readinto'))
+            self.assertRaises(OSError, files.copy_data, fdin, fdout,
+                              ('unknown', ))
+        finally:
+            os.close(fdin)
+            os.close(fdout)
+
+    def test_proc_file(self):
+        """files which say size 0 but have contents are read"""
+        n = files.copy_file(u'/proc/self/status', self.dest)
+        self.assertTrue(n > 0)
+        self.assertEqual(os.path.getsize(self.dest), n)
+
+    def test_do_copy(self):
+        self.create(u'd/f', u'dest/')
+        os.symlink(u'f', os.path.join(self.path, u'd/l'))
+        destdir = os.path.join(self.path, u'dest')
+        for f in (u'src', u'd', u'd/f', u'd/l'):
+            self.assertEqual(files.do_copy(f, self.path, destdir), None)
+        self.assertEqual(open(os.path.join(destdir, u'src'), 'rb').read(),
+                         self.data)
+        self.assertEqual(os.readlink(os.path.join(destdir, u'd/l')), u'f')
+        # existing files are not overwritten unless told
+        self.assertEqual(files.do_copy(u'd/f', self.path, destdir), u'f')
+        open(os.path.join(self.path, u'd/f'), 'w').write('new')
+        self.assertEqual(files.do_copy(u'd/f', self.path, destdir,
+                                       check_fileexists=False), None)
+        self.assertEqual(open(os.path.join(destdir, u'd/f')).read(), 'new')
+        self.assertEqual(files.do_copy(u'd/f', self.path,
+                                       os.path.join(self.path, u'd/f'),
+                                       check_fileexists=False)[1], 0)
+        self.assertTrue(isinstance(files.do_copy(u'missing', self.path,
+                                                 destdir), tuple))
+
+    def test_same_file(self):
+        """a file copied onto itself through a link is not truncated"""
+        self.create(u'd/f')
+        os.symlink(u'd', os.path.join(self.path, u'l'))
+        os.link(self.src, os.path.join(self.path, u'hard'))
+        self.assertEqual(files.do_copy(u'f', os.path.join(self.path, u'd'),
+                                       os.path.join(self.path, u'l'),
+                                       check_fileexists=False),
+                         ('Source and destination are the same file', 0))
+        self.assertEqual(open(os.path.join(self.path, u'd/f')).read(), u'f')
+        self.assertEqual(files.do_copy(u'src', self.path,
+                                       os.path.join(self.path, u'hard'),
+                                       check_fileexists=False)[1], 0)
+        self.assertEqual(open(self.src, 'rb').read(), self.data)
+
+    def test_do_backup(self):
+        self.create(u'd/f')
+        self.assertEqual(files.do_backup(u'd', self.path, u'.bak'), None)
+        self.assertEqual(os.listdir(os.path.join(self.path, u'd.bak')),
+                         [u'f'])
+        self.assertEqual(files.do_backup(u'd', self.path, u'.bak'),
+                         ('File exists', 0))
+        # names with invalid encoding are found while copying
+        invalid = os.path.join(self.path.encode('utf-8'), 'd', 'a\xff')
+        open(invalid, 'w')
+        try:
+            self.assertEqual(files.do_backup(u'd', self.path, u'.old')[1], 0)
+            self.assertFalse(os.path.exists(os.path.join(self.path,
+                                                         u'd.old')))
+        finally:
+            os.unlink(invalid)
+
+    def test_do_delete(self):
+        self.create(u'd/f')
+        d = os.path.join(self.path, u'd')
+        os.symlink(d, os.path.join(self.path, u'l'))
+        self.assertEqual(files.do_delete(os.path.join(self.path, u'l')), None)
+        self.assertEqual(files.do_delete(d)[1], errno.ENOTEMPTY)
+        self.assertEqual(files.do_delete(os.path.join(d, u'f')), None)
+        self.assertEqual(files.do_delete(d), None)
+        self.assertEqual(sorted(os.listdir(self.path)), [u'src'])
+
+
+######################################################################
+class LinkCacheTest(TempDirTestCase):
+    def test_retargeted_link(self):
+        self.create(u'a', u'b/')
+        l = os.path.join(self.path, u'l')
+        os.symlink(u'a', l)
+        files.get_dir(self.path)
+        self.assertEqual(files.get_realpath(self.path, u'l', files.FTYPE_LNK),
+                         u'-> a')
+        os.unlink(l)
+        os.symlink(u'b', l)
+        self.assertEqual(files.get_realpath(self.path, u'l', files.FTYPE_LNK),
+                         u'-> b')
+        self.assertEqual(files.get_linkpath(self.path, u'l'),
+                         os.path.join(self.path, u'b'))
+        target, st, dangling = files.links.get(l)
+        self.assertTrue(os.path.isdir(os.path.join(self.path, target)))
+        self.assertFalse(dangling)
+
+
+######################################################################
+class FsTypeTest(unittest.TestCase):
+    def test_cached_by_device(self):
+        fstype = files.get_fstype(u'/proc')
+        self.assertEqual(fstype, 'proc')
+        def no_open(*args):
+            raise AssertionError('/proc/mounts read again')
+        files.open = no_open
+        try:
+            self.assertEqual(files.get_fstype(u'/proc/self'), 'proc')
+        finally:
+            del files.open
+
+    def test_missing_path(self):
+        self.assertTrue(isinstance(files.get_fstype(u'/nonexistent/x'), str))
+
+
+######################################################################
+class DirSnapshotTest(TempDirTestCase):
+    def tearDown(self):
+        files.forget_dir_snapshots()
+        TempDirTestCase.tearDown(self)
+
+    def test_update(self):
+        self.create(u'a', u'b')
+        snap = files.get_dir_snapshot(self.path)
+        self.assertEqual(snap.serial, 0)
+        self.create(u'c')
+        os.unlink(os.path.join(self.path, u'a'))
+        snap.update([u'a', u'b', u'c', u'missing', os.pardir])
+        self.assertEqual(snap.serial, 2)
+        self.assertEqual(sorted(snap.files), [os.pardir, u'b', u'c'])
+        changes = snap.get_changes(0)
+        self.assertEqual([(f, old is None, new is None)
+                          for f, old, new in changes],
+                         [(u'a', False, True), (u'c', True, False)])
+        self.assertEqual(snap.get_changes(1), changes[1:])
+        self.assertEqual(snap.get_changes(2), [])
+
+    def test_log_truncated(self):
+        """too old changes are forgotten, None means read it all again"""
+        self.create(u'a')
+        snap = files.get_dir_snapshot(self.path)
+        max_changes = files.MAX_SNAPSHOT_CHANGES
+        files.MAX_SNAPSHOT_CHANGES = 3
+        try:
+            for i in range(5):
+                open(os.path.join(self.path, u'a'), 'w').write('x'*(i+2))
+                snap.update([u'a'])
+        finally:
+            files.MAX_SNAPSHOT_CHANGES = max_changes
+        self.assertEqual(snap.serial, 5)
+        self.assertEqual(len(snap.changes), 3)
+        self.assertEqual(snap.get_changes(1), None)
+        self.assertEqual(snap.get_changes(2), snap.changes)
+        self.assertEqual(snap.get_changes(4)[0][2][files.FT_SIZE], 6)
+
+    def test_copy(self):
+        self.create(u'a')
+        snap = files.get_dir_snapshot(self.path)
+        private = snap.copy()
+        self.create(u'b')
+        private.update([u'b'])
+        self.assertTrue(u'b' in private.files)
+        self.assertFalse(u'b' in snap.files)
+        self.assertEqual(snap.serial, 0)
+
+    def test_shared(self):
+        self.create(u'a')
+        snap = files.get_dir_snapshot(self.path)
+        # modifications just after reading are not trusted
+        self.assertEqual(files.get_shared_dir_snapshot(self.path), None)
+        snap.read_time += 2
+        self.assertTrue(files.get_dir_snapshot(self.path) is snap)
+        self.assertTrue(files.get_dir_snapshot(self.path, 0) is not snap)
+        self.create(u'b')
+        os.utime(self.path, (0, 0))
+        self.assertEqual(files.get_shared_dir_snapshot(self.path), None)
+        snap = files.get_dir_snapshot(self.path)
+        snap.read_time += 2
+        files.forget_dir_snapshots()
+        self.assertEqual(files.get_shared_dir_snapshot(self.path), None)
+
+
+######################################################################
+class DirReaderTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.chunk_size = files.READER_CHUNK_SIZE
+        files.READER_CHUNK_SIZE = 10
+
+    def tearDown(self):
+        files.READER_CHUNK_SIZE = self.chunk_size
+        TempDirTestCase.tearDown(self)
+
+    def read(self, lazy=True, show_dotfiles=1):
+        notified = []
+        reader = files.DirReader(self.path, show_dotfiles, lazy,
+                                 lambda: notified.append(1))
+        self.assertTrue(reader.wait(5))
+        return reader, notified
+
+    def test_chunks(self):
+        self.create(*[u'f%02d' % i for i in range(25)] + [u'd/', u'.h'])
+        os.symlink(u'd', os.path.join(self.path, u'l'))
+        reader, notified = self.read()
+        self.assertEqual(reader.error, None)
+        chunks = reader.get_chunks()
+        self.assertEqual(reader.get_chunks(), [])
+        self.assertTrue(len(chunks) >= 3)
+        self.assertEqual(len(notified), len(chunks)+1)
+        entries = dict((f, (info, pending))
+                       for chunk in chunks for f, info, pending in chunk)
+        self.assertEqual(len(entries), 28)
+        # links are always stat'ed, to know what they point to
+        self.assertEqual(entries[u'l'][0][files.FT_TYPE],
+                         files.FTYPE_LNK2DIR)
+        self.assertFalse(entries[u'l'][1])
+        if files.iter_dir(self.path).next()[1] != files.DT_UNKNOWN:
+            self.assertTrue(entries[u'f00'][1])
+        reader, notified = self.read(lazy=False, show_dotfiles=0)
+        entries = [(f, pending) for chunk in reader.get_chunks()
+                   for f, info, pending in chunk]
+        self.assertEqual(len(entries), 27)
+        self.assertFalse([f for f, pending in entries if pending])
+
+    def test_add_chunks(self):
+        self.create(u'a', u'b', u'c')
+        snap = files.new_dir_snapshot(self.path)
+        self.assertEqual(snap.files.keys(), [os.pardir])
+        reader, notified = self.read()
+        chunks = reader.get_chunks()
+        self.assertEqual(sorted(snap.add_chunks(chunks)), [u'a', u'b', u'c'])
+        self.assertEqual(len(snap.files), 4)
+        # added again, nothing is new and all is stat'ed now
+        reader, notified = self.read(lazy=False)
+        self.assertEqual(snap.add_chunks(reader.get_chunks()), [])
+        self.assertEqual(snap.pending, set())
+        self.assertEqual(snap.files[u'a'][files.FT_SIZE], 1)
+
+    def test_stop(self):
+        """nothing is read after stop, what was read is kept"""
+        self.create(*[u'f%02d' % i for i in range(50)])
+        chunks = []
+        def notify():
+            reader.stop()
+            chunks.extend(reader.get_chunks())
+        start = threading.Event()
+        reader = files.DirReader(self.path, notify=lambda: start.wait(5) and
+                                 notify())
+        start.set()
+        self.assertTrue(reader.wait(5))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(len(chunks[0]), files.READER_CHUNK_SIZE)
+        self.assertEqual(reader.get_chunks(), [])
+        self.assertEqual(reader.error, None)
+
+    def test_error(self):
+        reader = files.DirReader(os.path.join(self.path, u'missing'))
+        self.assertTrue(reader.wait(5))
+        self.assertTrue(reader.done)
+        self.assertEqual(reader.error[1], errno.ENOENT)
+        self.assertEqual(reader.get_chunks(), [])
+
+
+######################################################################
+class NameCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.db = [('root', 'x', 0), ('daemon', 'x', 1)]
+        self.loading = threading.Event()
+        self.release = threading.Event()
+        def getall():
+            db = self.db
+            self.loading.set()
+            self.release.wait(5)
+            return db
+        self.cache = files.NameCache(self.byid, self.byname, getall,
+                                     '/nonexistent')
+
+    def byid(self, id_):
+        for e in self.db:
+            if e[2] == id_:
+                return e
+        raise KeyError(id_)
+
+    def byname(self, name):
+        for e in self.db:
+            if e[0] == name:
+                return e
+        raise KeyError(name)
+
+    def test_lookups(self):
+        self.assertEqual(self.cache.get_name(1), 'daemon')
+        self.assertEqual(self.cache.get_name(7), u'7')
+        self.assertEqual(self.cache.get_id('root'), 0)
+        self.assertEqual(self.cache.get_id('nobody'), None)
+        self.db = [('root', 'x', 0), ('daemon', 'x', 7)]
+        self.assertEqual(self.cache.get_name(7), u'7') # cached
+        self.cache.clear()
+        self.assertEqual(self.cache.get_name(7), 'daemon')
+
+    def test_clear_while_loading(self):
+        """a load started before clear is not stored"""
+        self.cache.preload()
+        self.loading.wait(5)
+        self.db = [('root', 'x', 0), ('new', 'x', 2)]
+        self.cache.clear()
+        self.release.set()
+        self.assertEqual(self.cache.get_all(), ['root', 'new'])
+
+
+######################################################################
+class PathContentsTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.src = os.path.join(self.path, u'src')
+        self.dest = os.path.join(self.path, u'dest')
+        os.mkdir(self.dest)
+        self.create(u'src/a/1', u'src/a/2', u'src/a/b/3', u'src/c')
+
+    def relpaths(self, entries):
+        return [f.replace(self.src+os.sep, '') for f, size in entries]
+
+    def test_walk_order(self):
+        pc = files.PathContents([u'c', u'a'], self.src)
+        self.assertEqual(self.relpaths(pc.iter_walk()),
+                         [u'a', u'a/1', u'a/2', u'a/b', u'a/b/3', u'c'])
+        self.assertEqual(self.relpaths(pc.iter_walk(reverse=True)),
+                         [u'c', u'a/1', u'a/2', u'a/b/3', u'a/b', u'a'])
+        self.assertEqual(pc.length, 2)
+
+    def test_count(self):
+        pc = files.PathContents([u'a', u'c'], self.src)
+        pc.count()
+        for i in xrange(500):
+            if pc.complete:
+                break
+            time.sleep(0.01)
+        self.assertTrue(pc.complete)
+        self.assertEqual(pc.tlength, 6)
+        self.assertEqual(pc.tsize, 1+1+1+1 +
+                         2*os.lstat(os.path.join(self.src, u'a')).st_size)
+
+    def test_set_dest_inside(self):
+        """copying a directory inside itself doesn't walk the copy"""
+        pc = files.PathContents([u'a'], self.src)
+        pc.set_dest(os.path.join(self.src, u'a', u'b'))
+        walked = []
+        for f, size in pc.iter_walk():
+            walked.append(f)
+            files.do_copy(f.replace(self.src+os.sep, ''), self.src,
+                          os.path.join(self.src, u'a', u'b'))
+        self.assertEqual(self.relpaths([(f, 0) for f in walked]),
+                         [u'a', u'a/1', u'a/2', u'a/b', u'a/b/3'])
+
+    def test_remove_files(self):
+        """only the entries given are removed, not directory contents"""
+        pc = files.PathContents([u'a', u'c'], self.src)
+        pc.remove_files([os.path.join(self.src, f) for f in (u'a/b', u'c')])
+        self.assertEqual(self.relpaths(pc.iter_walk()),
+                         [u'a', u'a/1', u'a/2', u'a/b/3'])
+        self.assertEqual(self.relpaths(pc.iter_walk(reverse=True)),
+                         [u'a/1', u'a/2', u'a/b/3', u'a'])
+        self.assertEqual(pc.length, 1)
+
+    def test_remove_files_totals(self):
+        """totals are right whether counting had finished or not"""
+        rm = [os.path.join(self.src, f) for f in (u'a/b', u'a/1')]
+        size_b = os.lstat(rm[0]).st_size
+        for counted in (True, False):
+            pc = files.PathContents([u'a', u'c'], self.src)
+            if counted:
+                pc.count()
+                while not pc.complete:
+                    time.sleep(0.01)
+            pc.remove_files(rm)
+            pc.remove_files(rm[:1])
+            pc.count()
+            while not pc.complete:
+                time.sleep(0.01)
+            self.assertEqual(pc.tlength, 4)
+            self.assertEqual(pc.tsize, 1+1+1 +
+                             os.lstat(os.path.join(self.src, u'a')).st_size)
+
+    def test_record(self):
+        """recorded walks go through the directories listed, in the same
+        order, an unfinished one yields nothing"""
+        pc = files.PathContents([u'c', u'a'], self.src)
+        pc.record()
+        walk = pc.iter_walk()
+        walk.next()
+        self.assertEqual(list(pc.iter_walk()), [])
+        pc = files.PathContents([u'c', u'a'], self.src)
+        pc.record()
+        entries = list(pc.iter_walk())
+        self.assertEqual(pc.tlength, 6)
+        listdir = os.listdir
+        os.listdir = None
+        try:
+            self.assertEqual(list(pc.iter_walk()), entries)
+            self.assertEqual(self.relpaths(pc.iter_walk(reverse=True)),
+                             [u'c', u'a/1', u'a/2', u'a/b/3', u'a/b', u'a'])
+        finally:
+            os.listdir = listdir
+
+    def test_remove_files_recorded(self):
+        """sizes of the entries removed are taken from the walk"""
+        pc = files.PathContents([u'a', u'c'], self.src)
+        pc.record()
+        list(pc.iter_walk())
+        size = pc.tsize
+        rm = [os.path.join(self.src, f) for f in (u'c', u'a/b/3', u'a/x')]
+        lstat = os.lstat
+        def no_lstat(f):
+            if f != rm[2]:
+                raise AssertionError('%s lstat\'ed again' % f)
+            return lstat(f)
+        os.lstat = no_lstat
+        try:
+            pc.remove_files(rm)
+        finally:
+            os.lstat = lstat
+        self.assertEqual(pc.tlength, 3)
+        self.assertEqual(pc.tsize, size-2)
+        self.assertEqual(pc.length, 1)
+
+    def move(self, fs, during_copy=None):
+        """copy fs to dest and delete them, like actions.move"""
+        pc = files.PathContents(fs, self.src)
+        pc.record()
+        failed = []
+        for f, size in pc.iter_walk():
+            if during_copy:
+                during_copy(f)
+            res = files.do_copy(f.replace(self.src+os.sep, ''), self.src,
+                                self.dest)
+            if res is not None:
+                failed.append(f)
+        pc.remove_files(failed)
+        for f, size in pc.iter_walk(reverse=True):
+            files.do_delete(f)
+        return pc
+
+    def test_move(self):
+        self.move([u'a', u'c'])
+        self.assertEqual(os.listdir(self.src), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, u'a'))),
+                         [u'1', u'2', u'b'])
+        self.assertEqual(open(os.path.join(self.dest, u'a/b/3')).read(), '3')
+
+    def test_move_created_while_copying(self):
+        """files created in the source while moving are not deleted"""
+        def create(f):
+            if f.endswith(u'a/b/3'):
+                self.create(u'src/a/new', u'src/a/b/new')
+        self.move([u'a'], create)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, u'a/new')))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.src, u'a'))),
+                         [u'b', u'new'])
+        self.assertEqual(os.listdir(os.path.join(self.src, u'a/b')), [u'new'])
+
+    def test_move_dir_not_copied(self):
+        """a directory which failed is kept, its contents are moved"""
+        pc = files.PathContents([u'a'], self.src)
+        pc.record()
+        for f, size in pc.iter_walk():
+            if f != os.path.join(self.src, u'a/b'):
+                files.do_copy(f.replace(self.src+os.sep, ''), self.src,
+                              self.dest)
+            else:
+                os.mkdir(os.path.join(self.dest, u'a/b'))
+        pc.remove_files([os.path.join(self.src, u'a/b')])
+        self.assertEqual(pc.tlength, 4)
+        for f, size in pc.iter_walk(reverse=True):
+            files.do_delete(f)
+        self.assertEqual(sorted(os.listdir(self.src)), [u'a', u'c'])
+        self.assertEqual(os.listdir(os.path.join(self.src, u'a')), [u'b'])
+        self.assertEqual(os.listdir(os.path.join(self.src, u'a/b')), [])
+        self.assertEqual(os.listdir(os.path.join(self.dest, u'a/b')), [u'3'])
+
+
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""test_lfm.py
+
+Tests for the listings in lfm.py, without curses.
+
+Usage:\tpython -m unittest discover -s tests
+"""
+
+
+import os, os.path
+import sys
+import fcntl
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lfm'))
+import files
+import config
+import inotify
+import lfm
+
+
+######################################################################
+class FakePrefs(object):
+    def __init__(self):
+        self.options = dict(config.options)
+        self.options['background_listing'] = 0
+        self.options['lazy_listing_threshold'] = 0
+
+
+class FakeApp(object):
+    def __init__(self):
+        self.prefs = FakePrefs()
+        self.watcher = None
+
+
+class FakePane(object):
+    def __init__(self, app):
+        self.app = app
+        self.mode = lfm.PANE_MODE_FULL
+        self.dims = (20, 80)
+
+
+class TabTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix=u'lfm-test-')
+        self.app = FakeApp()
+
+    def tearDown(self):
+        files.forget_dir_snapshots()
+        shutil.rmtree(self.path)
+
+    def create(self, *names):
+        for f in names:
+            open(os.path.join(self.path, f), 'w').write(f)
+
+    def new_tab(self):
+        tab = lfm.TabVfs(FakePane(self.app))
+        self.assertEqual(tab.init(self.path), None)
+        return tab
+
+
+######################################################################
+class FilterTest(TabTestCase):
+    def test_filter(self):
+        self.create(u'a1', u'a2', u'b')
+        tab = self.new_tab()
+        self.assertTrue(tab.set_filter(u'a'))
+        self.assertEqual(tab.sorted, [os.pardir, u'a1', u'a2'])
+        self.assertTrue(tab.set_filter(u'a2'))
+        self.assertEqual(tab.sorted, [os.pardir, u'a2'])
+        self.assertTrue(tab.set_filter(u''))
+        self.assertEqual(tab.sorted, [os.pardir, u'a1', u'a2', u'b'])
+
+    def test_update_files_filtered(self):
+        self.create(u'a1', u'a2', u'b')
+        tab = self.new_tab()
+        tab.set_filter(u'a')
+        tab.file_i = 2
+        os.unlink(os.path.join(self.path, u'a2'))
+        self.create(u'a3', u'c')
+        tab.update_files([u'a2', u'a3', u'c'])
+        self.assertEqual(tab.sorted, [os.pardir, u'a1', u'a3'])
+        self.assertEqual(tab.filter.names, [os.pardir, u'a1', u'a3',
+                                            u'b', u'c'])
+
+    def test_update_files_last_match_removed(self):
+        """without pardir, as in /, the filter is dropped when the
+        last matching file is removed"""
+        self.create(u'a', u'b')
+        tab = self.new_tab()
+        tab.detach_snapshot()
+        del tab.snapshot.files[os.pardir]
+        tab.files = tab.snapshot.files
+        tab.sorted = [u'a', u'b']
+        tab.set_filter(u'a')
+        self.assertEqual(tab.sorted, [u'a'])
+        os.unlink(os.path.join(self.path, u'a'))
+        tab.update_files([u'a'])
+        self.assertEqual(tab.filter, None)
+        self.assertEqual(tab.sorted, [u'b'])
+        self.assertEqual(tab.file_i, 0)
+
+
+######################################################################
+class FakeTab(object):
+    pass
+
+
+class WatcherTest(TabTestCase):
+    def setUp(self):
+        TabTestCase.setUp(self)
+        try:
+            self.watcher = inotify.Watcher()
+        except OSError:
+            self.skipTest('inotify not available')
+
+    def tearDown(self):
+        self.watcher.close()
+        TabTestCase.tearDown(self)
+
+    def test_events(self):
+        tab = FakeTab()
+        self.assertTrue(self.watcher.watch(tab, self.path))
+        self.assertEqual(self.watcher.read_events(), 0)
+        self.assertEqual(self.watcher.get_delay(), None)
+        self.create(u'a', u'b')
+        os.rename(os.path.join(self.path, u'a'), os.path.join(self.path, u'c'))
+        os.unlink(os.path.join(self.path, u'b'))
+        self.assertTrue(self.watcher.read_events() > 0)
+        # names are coalesced
+        self.assertEqual(tab.changes, set([u'a', u'b', u'c']))
+        self.assertFalse(tab.rescan)
+        self.assertTrue(self.watcher.get_delay() <= inotify.DEBOUNCE_TIME)
+
+    def test_unwatch(self):
+        tab1, tab2 = FakeTab(), FakeTab()
+        self.watcher.watch(tab1, self.path)
+        self.watcher.watch(tab2, self.path)
+        self.watcher.unwatch(tab1)
+        self.create(u'a')
+        self.watcher.read_events()
+        self.assertEqual(tab1.changes, set())
+        self.assertEqual(tab2.changes, set([u'a']))
+        self.assertEqual(tab1.watched, None)
+
+    def test_dir_removed(self):
+        tab = FakeTab()
+        d = os.path.join(self.path, u'd')
+        os.mkdir(d)
+        self.watcher.watch(tab, d)
+        os.rmdir(d)
+        self.watcher.read_events()
+        self.assertTrue(tab.rescan)
+        self.assertEqual(tab.watched, None)
+        self.assertEqual(self.watcher.wds, {})
+
+    def test_overflow(self):
+        """queue overflow makes every tab read its directory again"""
+        tab1, tab2 = FakeTab(), FakeTab()
+        self.watcher.watch(tab1, self.path)
+        self.watcher.watch(tab2, self.path)
+        wd = self.watcher.wds[self.path]
+        # feed the events through a pipe, as the kernel would
+        rfd, wfd = os.pipe()
+        fcntl.fcntl(rfd, fcntl.F_SETFL, os.O_NONBLOCK)
+        os.close(self.watcher.fd)
+        self.watcher.fd = rfd
+        name = u'f'.encode('utf-8').ljust(16, '\0')
+        os.write(wfd, inotify.EVENT_HEADER.pack(wd, inotify.IN_CREATE, 0,
+                                                len(name)) + name +
+                 inotify.EVENT_HEADER.pack(-1, inotify.IN_Q_OVERFLOW, 0, 0))
+        os.close(wfd)
+        self.assertEqual(self.watcher.read_events(), 2)
+        for tab in (tab1, tab2):
+            self.assertEqual(tab.changes, set([u'f']))
+            self.assertTrue(tab.rescan)
+
+
+class UpdateFilesTest(TabTestCase):
+    def setUp(self):
+        TabTestCase.setUp(self)
+        try:
+            self.app.watcher = inotify.Watcher()
+        except OSError:
+            self.skipTest('inotify not available')
+
+    def tearDown(self):
+        self.app.watcher.close()
+        TabTestCase.tearDown(self)
+
+    def regenerate(self, tab):
+        self.app.watcher.read_events()
+        tab.regenerate()
+
+    def test_create_delete_rename(self):
+        self.create(u'b', u'd')
+        tab = self.new_tab()
+        self.assertTrue(tab.is_uptodate())
+        snapshot = tab.snapshot
+        self.create(u'a', u'c')
+        os.unlink(os.path.join(self.path, u'd'))
+        os.rename(os.path.join(self.path, u'b'), os.path.join(self.path, u'e'))
+        os.mkdir(os.path.join(self.path, u'z'))
+        self.regenerate(tab)
+        # applied as changes, not read again
+        self.assertTrue(tab.snapshot is snapshot)
+        self.assertEqual(tab.changes, set())
+        self.assertEqual(tab.sorted, [os.pardir, u'z', u'a', u'c', u'e'])
+        self.assertEqual(tab.nfiles, 5)
+        self.assertEqual(sorted(tab.files), sorted(tab.sorted))
+
+    def test_modified(self):
+        """files which change their sorting key are moved"""
+        self.app.prefs.options['sort'] = files.SORTTYPE_bySize
+        self.create(u'a', u'bb', u'ccc')
+        tab = self.new_tab()
+        self.assertEqual(tab.sorted, [os.pardir, u'a', u'bb', u'ccc'])
+        open(os.path.join(self.path, u'a'), 'w').write('aaaa')
+        self.regenerate(tab)
+        self.assertEqual(tab.sorted, [os.pardir, u'bb', u'ccc', u'a'])
+
+    def test_selections(self):
+        self.create(u'a', u'b')
+        tab = self.new_tab()
+        tab.selections.add(u'a')
+        tab.selections.add(u'b')
+        os.unlink(os.path.join(self.path, u'a'))
+        self.regenerate(tab)
+        self.assertEqual(list(tab.selections), [u'b'])
+
+    def test_replay(self):
+        """changes made by other tab in the snapshot are coalesced"""
+        self.create(u'a', u'b')
+        tab = self.new_tab()
+        self.create(u'c')
+        tab.snapshot.update([u'c'])
+        os.unlink(os.path.join(self.path, u'c'))
+        os.unlink(os.path.join(self.path, u'a'))
+        tab.snapshot.update([u'c', u'a'])
+        self.create(u'a')
+        tab.snapshot.update([u'a'])
+        tab.update_files([])
+        self.assertEqual(tab.sorted, [os.pardir, u'a', u'b'])
+        self.assertEqual(tab.serial, tab.snapshot.serial)
+
+    def test_rescan(self):
+        """the directory is read again if changes have been lost"""
+        self.create(u'a')
+        tab = self.new_tab()
+        snapshot = tab.snapshot
+        self.create(u'b')
+        self.app.watcher.read_events()
+        tab.changes.clear()
+        tab.rescan = True
+        self.assertFalse(tab.is_uptodate())
+        files.forget_dir_snapshots()
+        tab.regenerate()
+        self.assertFalse(tab.snapshot is snapshot)
+        self.assertEqual(tab.sorted, [os.pardir, u'a', u'b'])
+        self.assertTrue(tab.is_uptodate())
+
+
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
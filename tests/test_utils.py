@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+"""test_utils.py
+
+Tests for the process loops in utils.py.
+
+Usage:\tpython -m unittest discover -s tests
+"""
+
+
+import os, os.path
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lfm'))
+import files # before utils, they import each other
+import utils
+
+
+######################################################################
+class IPCTest(unittest.TestCase):
+    def setUp(self):
+        self.ipc = utils.IPC()
+
+    def tearDown(self):
+        self.ipc.close()
+
+    def test_send_receive(self):
+        self.assertEqual(self.ipc.receive(), (0, None))
+        self.ipc.send(('result', (u'ñ', 2)))
+        self.ipc.send(('batch', (3, None)))
+        self.assertEqual(self.ipc.receive(), (1, ('result', (u'ñ', 2))))
+        self.assertEqual(self.ipc.receive(), (1, ('batch', (3, None))))
+        self.assertEqual(self.ipc.receive(), (0, None))
+
+    def test_large_message(self):
+        """messages bigger than the pipe buffer are read whole"""
+        args = [(u'file%d' % i, u'/tmp/path', True) for i in xrange(20000)]
+        sender = threading.Thread(target=self.ipc.send, args=(('batch', args), ))
+        sender.start()
+        code, buf = self.ipc.receive(None)
+        sender.join()
+        self.assertEqual(code, 1)
+        self.assertEqual(buf, ('batch', args))
+
+    def test_bad_message(self):
+        self.ipc.wfd.write(utils.IPC.header.pack(3) + 'bad')
+        self.assertEqual(self.ipc.receive(), (-1, 'Error unmarshaling'))
+        self.ipc.send(('one', 'two', 'three'))
+        self.assertEqual(self.ipc.receive(), (-1, 'Malformed response'))
+
+
+######################################################################
+class Clock(object):
+    """replaces the time module"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        utils.time = self.clock
+
+    def tearDown(self):
+        utils.time = time
+        self.loop.c2p.close()
+
+    def messages(self):
+        msgs = []
+        while True:
+            code, buf = self.loop.c2p.receive()
+            if code != 1:
+                return msgs
+            msgs.append(buf)
+
+
+######################################################################
+class RunBatchTest(ClockTestCase):
+    def setUp(self):
+        ClockTestCase.setUp(self)
+        self.loop = utils.ProcessLoopBase.__new__(utils.ProcessLoopBase)
+        self.loop.c2p = utils.IPC()
+        self.loop.t_progress = 0
+        self.done = []
+
+    def func(self, f):
+        self.done.append(f)
+        self.clock.now += 0.1
+        if f == 'error':
+            return ('Permission denied', 13)
+
+    def test_batch(self):
+        self.loop.func = self.func
+        self.loop.run_batch([('a', ), ('b', ), ('c', ), ('d', )])
+        self.assertEqual(self.done, ['a', 'b', 'c', 'd'])
+        # progress every PROGRESS_INTERVAL, after the files done
+        self.assertEqual(self.messages(),
+                         [('progress', (1, None)), ('progress', (3, None)),
+                          ('batch', (4, None))])
+
+    def test_batch_stops_at_result(self):
+        self.loop.func = self.func
+        self.loop.run_batch([('a', ), ('error', ), ('c', )])
+        self.assertEqual(self.done, ['a', 'error'])
+        self.assertEqual(self.messages()[-1],
+                         ('batch', (1, ('Permission denied', 13))))
+
+
+######################################################################
+class CopyProgressTest(ClockTestCase):
+    def setUp(self):
+        ClockTestCase.setUp(self)
+        self.loop = utils.ProcessLoopCopy.__new__(utils.ProcessLoopCopy)
+        self.loop.c2p = utils.IPC()
+        self.loop.t_progress = self.loop.batch_i = 0
+        self.loop.file_bytes = self.loop.bytes_done = 0
+        self.loop.t_copying = self.loop.t_last = self.loop.bytes_last = 0
+        self.loop.t_mark, self.loop.continued, self.loop.rate = None, False, None
+        self.loop.func = self.copy
+
+    def copy(self, size, progress=None):
+        """copy 1 MB/s, with a report every second"""
+        for i in xrange(size):
+            self.clock.now += 1
+            progress(i + 1)
+
+    def test_rate_while_copying(self):
+        self.loop.run_func((3, ))
+        progress = [buf[1][1] for buf in self.messages()]
+        self.assertEqual(progress, [(1, 1, 1, 1), (2, 2, 1, 1), (3, 3, 1, 1)])
+
+    def test_rate_without_time_between_files(self):
+        """time spent out of copy, in dialogs for example, doesn't count"""
+        self.loop.run_func((2, ))
+        self.clock.now += 100
+        self.loop.run_func((2, ))
+        progress = [buf[1][1] for buf in self.messages()]
+        self.assertEqual(progress[-1], (2, 4, 1, 1))
+
+    def test_rate_without_time_stopped(self):
+        """time stopped by the user doesn't count, only the bytes copied
+        since last report lose their time"""
+        def stopped(size, progress=None):
+            for i in xrange(size):
+                self.clock.now += 1
+                if i == 1:
+                    self.clock.now += 100
+                    self.loop.continued = True   # as SIGCONT handler
+                progress(i + 1)
+        self.loop.func = stopped
+        self.loop.run_func((3, ))
+        progress = [buf[1][1] for buf in self.messages()]
+        self.assertEqual(progress[-1][:3], (3, 3, 1))
+        self.assertTrue(progress[-1][3] >= 1)
+
+
+######################################################################
+class BatchPositionTest(unittest.TestCase):
+    def test_end_of_batch(self):
+        loop = utils.ProcessLoopCopy.__new__(utils.ProcessLoopCopy)
+        loop.batch = ([(u'/a', 10), (u'/b', 20)], 5, 100)
+        loop.file_bytes = 0
+        loop.set_batch_position(1)
+        self.assertEqual((loop.file_i, loop.filesize_aggr, loop.filesize),
+                         (7, 130, 20))
+        loop.file_bytes = 15
+        loop.set_batch_position(2)
+        self.assertEqual((loop.file_i, loop.filesize_aggr, loop.filesize,
+                          loop.file_bytes), (7, 130, 0, 0))
+        # bytes done shown by show_win
+        self.assertEqual(loop.filesize_aggr - loop.filesize + loop.file_bytes,
+                         130)
+
+
+######################################################################
+class FailedBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = utils.messages.error
+        utils.messages.error = lambda msg: None
+        loop = self.loop = utils.ProcessLoopCopy.__new__(utils.ProcessLoopCopy)
+        loop.action, loop.ret = 'Move', []
+        loop.file_i = loop.filesize_aggr = loop.t_shown = 0
+        loop.batch = None
+        loop.dlg = utils.messages.ProgressBarWindow3.__new__(
+            utils.messages.ProgressBarWindow3)
+        loop.dlg.ishidden = False
+        loop.show_win = loop.show_parent = lambda: None
+        loop.prepare_args = lambda: (loop.filename, )
+        loop.p2c = self
+        self.sent = []
+
+    def tearDown(self):
+        utils.messages.error = self.saved
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def test_child_error(self):
+        """files not known to be processed are returned as not copied"""
+        answers = [('batch', (1, u'/b')), ('error', 'Child died')]
+        def wait_for_answer():
+            if len(self.sent) == 2:
+                self.loop.update_progress((1, (0, 0, None, None)))
+            return answers.pop(0)
+        self.loop.wait_for_answer = wait_for_answer
+        self.loop.process_response = lambda res: 0
+        files = [(u'/a', 1), (u'/b', 1), (u'/c', 1), (u'/d', 1), (u'/e', 1)]
+        self.assertEqual(self.loop.exec_batch(files), 0)
+        # /c was done when the child reported, /d is the current
+        self.assertEqual(self.loop.ret, [u'/d', u'/e'])
+
+    def test_stopped(self):
+        self.loop.wait_for_answer = lambda: ('stopped_by_user', None)
+        self.assertEqual(self.loop.exec_batch([(u'/a', 1)]), -1)
+        self.assertEqual(self.loop.ret, [])
+
+
+######################################################################
+class Walk(object):
+    """PathContents with n files, then a name with invalid encoding"""
+    basepath = u'/'
+    errors = []
+
+    def __init__(self, n, invalid=True):
+        self.n, self.invalid = n, invalid
+
+    def count(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def iter_walk(self, reverse=False):
+        for i in xrange(self.n):
+            yield u'/f%d' % i, 1
+        if self.invalid:
+            raise UnicodeError
+
+
+class Loop(utils.ProcessLoopBase_2):
+    action = 'Test'
+    rev = False
+
+    def __init__(self, pc, fail=False):
+        self.pc, self.fail = pc, fail
+        self.ret, self.sent = [], []
+
+    def exec_batch(self, files):
+        self.sent.append(files)
+        if self.fail:
+            raise UnicodeError
+        return 0
+
+    def ask_confirmation(self):
+        return 1
+
+    def show_parent(self):
+        pass
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (utils.ProcessLoopBase.run_pre,
+                      utils.ProcessLoopBase.run_post, utils.messages.error)
+        utils.ProcessLoopBase.run_pre = lambda self: None
+        utils.ProcessLoopBase.run_post = lambda self: None
+        self.errors = []
+        utils.messages.error = self.errors.append
+
+    def tearDown(self):
+        utils.ProcessLoopBase.run_pre, utils.ProcessLoopBase.run_post, \
+            utils.messages.error = self.saved
+
+    def test_invalid_encoding(self):
+        """files found before the invalid name are sent once"""
+        loop = Loop(Walk(utils.BATCH_SIZE + 1))
+        self.assertEqual(loop.run(), -1)
+        self.assertEqual([len(files) for files in loop.sent],
+                         [utils.BATCH_SIZE, 1])
+        self.assertEqual(len(self.errors), 1)
+
+    def test_error_processing_batch(self):
+        """an error while sending a batch is not taken as a bad name"""
+        loop = Loop(Walk(3, invalid=False), fail=True)
+        self.assertRaises(UnicodeError, loop.run)
+        self.assertEqual(len(loop.sent), 1)
+        self.assertEqual(self.errors, [])
+
+
+######################################################################
+if __name__ == '__main__':
+    unittest.main()